@@ -0,0 +1,94 @@
+# coding: utf-8
+
+"""Labels and calendar features of the prediction model, vectorized versus
+the former pandas implementations
+
+Run without any database:
+
+    python benchmarks/bench_features.py --rows 1000000
+
+The input is a regular grid of availability (stations x 10-minute buckets),
+as given by `stats.build_features`. For each step, the script checks that the
+outputs are identical and reports the best duration of `n` runs:
+
+- add_future: set_index / shift(freq) / merge of the whole frame, versus the
+  shift of the (station, date) keys on the time grid;
+- complete_data: three `.apply` over the rows, versus integer arithmetic on
+  the epoch minutes.
+"""
+
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from jitenshea.stats import add_future, complete_data
+
+
+def legacy_add_future(df, frequency):
+    df = df.set_index(["ts", "station_id"])
+    label = df["probability"].copy()
+    label.name = "future"
+    label = (label.reset_index(level=1)
+             .shift(-1, freq=frequency)
+             .reset_index()
+             .set_index(["ts", "station_id"]))
+    df = df.merge(label, left_index=True, right_index=True)
+    df.reset_index(level=1, inplace=True)
+    return df
+
+
+def legacy_complete_data(df):
+    df = df.copy()
+    df['day'] = df['ts'].apply(lambda x: x.weekday())
+    df['hour'] = df['ts'].apply(lambda x: x.hour)
+    df['minute'] = df['ts'].apply(lambda x: x.minute)
+    return df
+
+
+def availability(rows, stations=400):
+    buckets = rows // stations
+    ts = pd.date_range('2018-01-01', periods=buckets, freq='10min')
+    rng = np.random.default_rng(0)
+    bikes = rng.integers(0, 20, stations * buckets).astype(np.float32)
+    return pd.DataFrame({"station_id": np.repeat(np.arange(stations), buckets),
+                         "ts": np.tile(ts, stations),
+                         "nb_bikes": bikes,
+                         "nb_stands": 20 - bikes,
+                         "probability": bikes / 20})
+
+
+def best_duration(func, number):
+    durations = []
+    for _ in range(number):
+        tic = time.perf_counter()
+        result = func()
+        durations.append(time.perf_counter() - tic)
+    return min(durations), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--rows", type=int, default=1000000, help="number of rows")
+    parser.add_argument("--freq", default="30min", help="prediction frequency")
+    parser.add_argument("-n", "--number", type=int, default=3, help="number of runs")
+    args = parser.parse_args()
+
+    df = availability(args.rows)
+    steps = [('add_future', lambda: legacy_add_future(df, args.freq),
+              lambda: add_future(df, args.freq)),
+             ('complete_data', lambda: legacy_complete_data(df),
+              lambda: complete_data(df))]
+    print("{} rows".format(len(df)))
+    print("{:<16}{:>12}{:>14}{:>10}".format('step', 'pandas s', 'vectorized s', 'speedup'))
+    for name, legacy, vectorized in steps:
+        legacy_s, expected = best_duration(legacy, args.number)
+        vectorized_s, result = best_duration(vectorized, args.number)
+        pd.testing.assert_frame_equal(result, expected)
+        print("{:<16}{:>12.3f}{:>14.3f}{:>9.1f}x".format(name, legacy_s, vectorized_s,
+                                                         legacy_s / vectorized_s))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# coding: utf-8
+
+"""GeoJSON built in Python versus built by PostGIS
+
+Run against the database of the configuration file:
+
+    python benchmarks/bench_geojson.py -n 50
+
+For each GeoJSON listing of the Web API and each city, the script reports the
+mean duration of `n` responses, from the query to the JSON text:
+
+- python: the rows are fetched, converted to dicts, to features (see
+  `controller.station_geojson`) then encoded;
+- postgis: the FeatureCollection is built by `json_agg` and `ST_AsGeoJSON`
+  and fetched as a text, sent as is by the Web API.
+"""
+
+import json
+import time
+import argparse
+from datetime import datetime, timedelta
+
+from jitenshea import controller, queries
+
+
+def _default(obj):
+    return obj.isoformat()
+
+
+def listings(city):
+    """(name, query parameters, Python GeoJSON builder) of each listing
+    """
+    min_date = datetime.now() - timedelta(days=2)
+    ids = controller.get_station_ids(city)
+    return [
+        ('stations', {'after': '', 'limit': None},
+         lambda rows: controller.station_geojson(
+             rows, feature_list=['id', 'name', 'address', 'city', 'nb_stands'])),
+        ('latest_availability', {'after': '', 'limit': None, 'min_date': min_date},
+         lambda rows: controller.station_geojson(
+             rows, feature_list=['id', 'name', 'timestamp', 'nb_bikes', 'nb_stands'])),
+        ('station_clusters', {'ids': [str(x) for x in ids]},
+         controller.clustered_station_geojson),
+    ]
+
+
+def python_geojson(name, city, params, build):
+    rows = queries.execute(name, city, **params).dicts()
+    return json.dumps(build(rows), default=_default)
+
+
+def postgis_geojson(name, city, params):
+    return queries.execute(name + '_geojson', city, **params)[0][0]
+
+
+def mean_duration(func, number):
+    func()
+    tic = time.perf_counter()
+    for _ in range(number):
+        result = func()
+    return 1000 * (time.perf_counter() - tic) / number, len(result)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--city", action='append', choices=queries.CITIES,
+                        help="city (default: all of them)")
+    parser.add_argument("-n", "--number", type=int, default=50,
+                        help="number of responses of each listing")
+    args = parser.parse_args()
+
+    columns = ('city', 'listing', 'python ms', 'postgis ms', 'python kB', 'postgis kB')
+    print("{:<10}{:<22}{:>12}{:>12}{:>12}{:>12}".format(*columns))
+    for city in args.city or queries.CITIES:
+        for name, params, build in listings(city):
+            python_ms, python_size = mean_duration(
+                lambda: python_geojson(name, city, params, build), args.number)
+            postgis_ms, postgis_size = mean_duration(
+                lambda: postgis_geojson(name, city, params), args.number)
+            print("{:<10}{:<22}{:>12.3f}{:>12.3f}{:>12.1f}{:>12.1f}".format(
+                city, name, python_ms, postgis_ms,
+                python_size / 1024, postgis_size / 1024))
+
+
+if __name__ == '__main__':
+    main()
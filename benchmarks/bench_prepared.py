@@ -0,0 +1,116 @@
+# coding: utf-8
+
+"""Planning time saved by the prepared statements of the Web API queries
+
+Run against the database of the configuration file:
+
+    python benchmarks/bench_prepared.py --city lyon -n 200
+
+For each query, the script reports:
+
+- the planning time given by `EXPLAIN (ANALYZE, SUMMARY)` for the bound
+  statement and for the EXECUTE of the prepared statement (once the generic
+  plan is cached, i.e. after five executions);
+- the mean duration of `n` executions with `text()` and with the prepared
+  statement, on the same connection.
+"""
+
+import re
+import time
+import argparse
+from datetime import timedelta
+
+from jitenshea import queries
+from jitenshea.iodb import db
+
+
+PLANNING = re.compile(r"Planning Time: ([\d.]+) ms")
+
+
+def sample_params(conn, city):
+    """Bound parameters of each query, from the latest data of `city`
+    """
+    ids = [row[0] for row in conn.execute(
+        "SELECT id FROM {}.station ORDER BY id LIMIT 10".format(city))]
+    stop = conn.execute("SELECT max(timestamp) FROM {}.timeseries".format(city)).scalar()
+    date = conn.execute("SELECT max(date) FROM {}.daily_transaction".format(city)).scalar()
+    lon, lat = conn.execute("SELECT avg(st_x(geom)), avg(st_y(geom)) FROM {}.station"
+                            .format(city)).fetchone()
+    start = stop - timedelta(days=1)
+    spatial = {'min_date': start, 'min_bikes': 1}
+    return {
+        'stations': {'limit': 20, 'after': ''},
+        'specific_stations': {'ids': ids},
+        'station_ids': {},
+        'daily': {'ids': ids, 'start': date - timedelta(days=7), 'stop': date},
+        'daily_stations_by_value': {'order_reference_date': date, 'limit': 10,
+                                    'after_value': float('inf'), 'after_id': '',
+                                    'start': date - timedelta(days=7), 'stop': date},
+        'timeseries': {'ids': ids, 'start': start, 'stop': stop},
+        'current_values': {'ids': ids, 'start': start, 'stop': stop},
+        'prediction': {'ids': ids, 'freq': '1H', 'start': start, 'stop': stop,
+                       'values_num': 1},
+        'latest_availability': {'min_date': start, 'after': '', 'limit': 20},
+        'nearest_stations': dict(spatial, lon=lon, lat=lat, n=5),
+        'stations_within': dict(spatial, xmin=lon - 0.01, ymin=lat - 0.01,
+                                xmax=lon + 0.01, ymax=lat + 0.01),
+    }
+
+
+def planning_time(conn, sql, params):
+    rset = conn.exec_driver_sql("EXPLAIN (ANALYZE, SUMMARY) " + sql, params)
+    for row in rset:
+        match = PLANNING.search(row[0])
+        if match:
+            return float(match.group(1))
+    return float('nan')
+
+
+def mean_duration(func, number):
+    tic = time.perf_counter()
+    for _ in range(number):
+        func()
+    return 1000 * (time.perf_counter() - tic) / number
+
+
+def bench(conn, name, city, params, number):
+    statement = queries.statement(name, city)
+    prepared_name, prepare, execute = queries.prepare_statement(name, city)
+    # the driver-level SQL of the bound statement
+    compiled = statement.compile(dialect=conn.dialect)
+    text_sql = compiled.string
+    conn.exec_driver_sql(prepare)
+    try:
+        for _ in range(6):
+            conn.exec_driver_sql(execute, params).fetchall()
+        return {
+            'query': name,
+            'planning text': planning_time(conn, text_sql, params),
+            'planning prepared': planning_time(conn, execute, params),
+            'text ms': mean_duration(
+                lambda: conn.execute(statement, **params).fetchall(), number),
+            'prepared ms': mean_duration(
+                lambda: conn.exec_driver_sql(execute, params).fetchall(), number),
+        }
+    finally:
+        conn.exec_driver_sql("DEALLOCATE {}".format(prepared_name))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--city", default="lyon", choices=queries.CITIES)
+    parser.add_argument("-n", "--number", type=int, default=100,
+                        help="number of executions of each query")
+    args = parser.parse_args()
+
+    columns = ('query', 'planning text', 'planning prepared', 'text ms', 'prepared ms')
+    print("{:<26}{:>16}{:>20}{:>12}{:>14}".format(*columns))
+    with db('read', args.city).connect() as conn:
+        for name, params in sample_params(conn, args.city).items():
+            result = bench(conn, name, args.city, params, args.number)
+            print("{query:<26}{planning text:>16.3f}{planning prepared:>20.3f}"
+                  "{text ms:>12.3f}{prepared ms:>14.3f}".format(**result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# coding: utf-8
+
+"""Peak memory of the extraction of the training data
+
+Run against the database of the configuration file:
+
+    python benchmarks/bench_training_memory.py --city lyon --days 90
+
+Each extraction runs in a fresh process, which reports its peak RSS and its
+duration, from the query to the features (see `stats.build_features`):
+
+- dataframe: `read_sql_query` of the whole window (DISTINCT, ORDER BY,
+  float64 values and string ids), then the resampling of the DataFrame;
+- streamed: chunks of compact arrays from a server-side cursor, accumulated
+  into a cube (see `features.extract`).
+"""
+
+import time
+import argparse
+import multiprocessing
+from datetime import date, timedelta
+
+import pandas as pd
+
+from jitenshea import features, queries
+from jitenshea.iodb import db
+from jitenshea.stats import build_features
+
+
+QUERY = ("SELECT DISTINCT id AS station_id, timestamp AS ts, "
+         "available_bikes AS nb_bikes, available_stands AS nb_stands, "
+         "available_bikes::float / (available_bikes::float "
+         "+ available_stands::float) AS probability "
+         "FROM {schema}.timeseries "
+         "WHERE timestamp >= %(start)s "
+         "AND timestamp < %(stop)s "
+         "AND (available_bikes > 0 OR available_stands > 0) "
+         "AND (status = 'open')"
+         "ORDER BY id, timestamp;")
+
+
+def dataframe(city, start, stop, freq):
+    df = pd.io.sql.read_sql_query(QUERY.format(schema=city), db('analytics', city),
+                                  params={"start": start, "stop": stop})
+    df.station_id = df.station_id.astype(int)
+    return build_features(df, freq)
+
+
+def streamed(city, start, stop, freq):
+    return build_features(features.extract(city, start, stop, freq), freq)
+
+
+def measure(mode, city, start, stop, freq, queue):
+    tic = time.perf_counter()
+    df = globals()[mode](city, start, stop, freq)
+    queue.put((len(df), time.perf_counter() - tic, features.peak_rss()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--city", default="lyon", choices=queries.CITIES)
+    parser.add_argument("--days", type=int, default=90, help="training window")
+    parser.add_argument("--freq", default="10T", help="time resampling frequency")
+    args = parser.parse_args()
+
+    stop = date.today()
+    start = stop - timedelta(args.days)
+    context = multiprocessing.get_context('spawn')
+    print("{:<12}{:>12}{:>12}{:>14}".format('mode', 'rows', 'seconds', 'peak RSS MiB'))
+    for mode in ('dataframe', 'streamed'):
+        queue = context.Queue()
+        process = context.Process(target=measure,
+                                  args=(mode, args.city, start, stop, args.freq, queue))
+        process.start()
+        rows, duration, peak = queue.get()
+        process.join()
+        print("{:<12}{:>12}{:>12.1f}{:>14.1f}".format(mode, rows, duration, peak / 2**20))
+
+
+if __name__ == '__main__':
+    main()
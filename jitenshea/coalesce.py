@@ -0,0 +1,319 @@
+# coding: utf-8
+
+"""Coalesce concurrent identical calls into a single in-flight computation
+
+When a new snapshot lands, every open dashboard asks for the same data at the
+same time. A `SingleFlight` group lets the first caller (the leader) run the
+computation while the other callers with the same key wait for its result.
+
+With the advisory lock mode, the leader also takes a PostgreSQL advisory lock
+derived from the key. A worker process which cannot get the lock polls it,
+without keeping a connection of the pool, until the other worker releases it,
+then reads its result from a shared directory. This directory must be private
+to the user of the workers, since the results are pickled.
+
+The followers get a copy of the result: a caller may modify it. The handover
+files are swept once no follower may still wait for them.
+"""
+
+import os
+import copy
+import stat
+import time
+import pickle
+import hashlib
+import threading
+from functools import wraps
+
+import daiquiri
+
+from jitenshea import config
+from jitenshea.iodb import db
+
+
+logger = daiquiri.getLogger(__name__)
+
+_GROUPS = {}
+# seconds between two attempts of a follower to take the advisory lock
+LOCK_POLL_INTERVAL = 0.05
+# age in seconds of the handover files removed by `sweep`: a follower reads
+# the file within a poll interval after its write
+HANDOVER_TTL = 60
+
+
+def _settings():
+    """Read the coalescing options from the configuration file
+
+    Returns
+    -------
+    tuple
+        (advisory_lock, shared_dir)
+    """
+    if config is None or not config.has_section('coalescing'):
+        return False, None
+    section = config['coalescing']
+    advisory_lock = section.getboolean('advisory_lock', fallback=False)
+    shared_dir = section.get('shared_dir') or None
+    if advisory_lock and shared_dir is None:
+        raise ValueError("The [coalescing] 'shared_dir' option is required "
+                         "with the advisory lock mode")
+    return advisory_lock, shared_dir
+
+
+def private_dir(path):
+    """Create the directory `path` if needed, readable and writable by the
+    current user only
+
+    Raises
+    ------
+    PermissionError
+        If `path` is not a directory of the current user, or if other users
+    may access it
+    """
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    info = os.lstat(path)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.geteuid():
+        raise PermissionError("'{}' is not a directory of the current user".format(path))
+    if info.st_mode & 0o077:
+        raise PermissionError("'{}' is accessible by other users, "
+                              "expected the mode 0700".format(path))
+    return path
+
+
+def sweep(shared_dir, max_age=HANDOVER_TTL):
+    """Remove the handover files of `shared_dir` older than `max_age` seconds,
+    and the temporary files left by a dead process
+
+    Returns
+    -------
+    int
+        Number of removed files
+    """
+    now = time.time()
+    removed = 0
+    for entry in os.scandir(shared_dir):
+        if '.pickle' not in entry.name or not entry.is_file(follow_symlinks=False):
+            continue
+        if now - entry.stat().st_mtime > max_age:
+            try:
+                os.remove(entry.path)
+                removed += 1
+            except FileNotFoundError:
+                pass
+    return removed
+
+
+def _freeze(value):
+    """Turn lists and dicts into hashable objects to build a call key
+    """
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(x) for x in value)
+    if isinstance(value, dict):
+        return tuple(sorted((k, _freeze(v)) for k, v in value.items()))
+    return value
+
+
+def lock_id(key):
+    """Signed 64-bits integer used as PostgreSQL advisory lock id for `key`
+    """
+    digest = hashlib.blake2b(repr(key).encode('utf-8'), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)
+
+
+class _Call:
+    """In-flight computation shared by the leader and its followers
+    """
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.followers = 0
+
+
+class SingleFlight:
+    """Group of calls where identical concurrent calls share one computation
+
+    Parameters
+    ----------
+    name : str
+        Name of the group, used in the metrics
+    advisory_lock : bool
+        Coalesce the calls across the worker processes with a PostgreSQL
+        advisory lock
+    shared_dir : str
+        Private directory used to hand over the results between the worker
+        processes, required with `advisory_lock`, see `private_dir`
+    """
+    def __init__(self, name, advisory_lock=False, shared_dir=None):
+        if advisory_lock and shared_dir is None:
+            raise ValueError("A shared directory is required with the advisory lock")
+        self.name = name
+        self.advisory_lock = advisory_lock
+        self.shared_dir = shared_dir
+        self._swept = time.time()
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.metrics = {'calls': 0, 'executed': 0, 'coalesced': 0,
+                        'shared': 0, 'errors': 0}
+
+    def _count(self, metric):
+        with self._lock:
+            self.metrics[metric] += 1
+
+    def do(self, key, func, *args, **kwargs):
+        """Call `func(*args, **kwargs)` unless an identical call is in flight
+
+        Parameters
+        ----------
+        key : hashable
+            Identify identical calls
+        func : callable
+
+        Returns
+        -------
+        The result of the leader call, copied if it is shared with other
+        callers
+        """
+        with self._lock:
+            self.metrics['calls'] += 1
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+            else:
+                call.followers += 1
+                self.metrics['coalesced'] += 1
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return copy.deepcopy(call.result)
+        try:
+            if self.advisory_lock:
+                call.result = self._across_workers(key, func, *args, **kwargs)
+            else:
+                call.result = self._execute(func, *args, **kwargs)
+        except Exception as exc:
+            call.error = exc
+            self._count('errors')
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        # no follower can join once the call is done: the original result is
+        # only read, by the copies
+        if call.followers:
+            return copy.deepcopy(call.result)
+        return call.result
+
+    def _execute(self, func, *args, **kwargs):
+        self._count('executed')
+        return func(*args, **kwargs)
+
+    def _handover_path(self, lockid):
+        fname = '{}-{:x}.pickle'.format(self.name, lockid & (2**64 - 1))
+        return os.path.join(private_dir(self.shared_dir), fname)
+
+    def write_handover(self, path, result):
+        """Write the result of a call for the other worker processes, in a
+        file readable by the current user only
+        """
+        tmppath = path + '.{}'.format(os.getpid())
+        fd = os.open(tmppath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as fobj:
+            pickle.dump(result, fobj, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmppath, path)
+        now = time.time()
+        if now - self._swept > HANDOVER_TTL:
+            self._swept = now
+            sweep(self.shared_dir)
+
+    def read_handover(self, path, since):
+        """Result written by another worker process since the timestamp
+        `since`, None if there is not any
+
+        Returns
+        -------
+        tuple
+            (result,) or None
+        """
+        try:
+            info = os.lstat(path)
+        except FileNotFoundError:
+            return None
+        if (not stat.S_ISREG(info.st_mode) or info.st_uid != os.geteuid()
+                or info.st_mtime < since):
+            return None
+        with open(path, 'rb') as fobj:
+            return (pickle.load(fobj),)
+
+    def _across_workers(self, key, func, *args, **kwargs):
+        """Coalesce the call with the other worker processes
+
+        The worker which gets the advisory lock computes the result and writes
+        it into the shared directory. The others poll the lock, without
+        holding a connection between two attempts, and read the result if it
+        was written while they were waiting.
+        """
+        lockid = lock_id((self.name, key))
+        path = self._handover_path(lockid)
+        since = time.time()
+        waited = False
+        while True:
+            # the advisory locks are taken on the primary, shared by all the workers
+            with db('write').connect() as conn:
+                if conn.execute("SELECT pg_try_advisory_lock(%(id)s)", id=lockid).scalar():
+                    try:
+                        handover = self.read_handover(path, since) if waited else None
+                        if handover is not None:
+                            logger.debug("waited %.3fs for the lock '%s'",
+                                         time.time() - since, self.name)
+                            self._count('shared')
+                            return handover[0]
+                        result = self._execute(func, *args, **kwargs)
+                        self.write_handover(path, result)
+                        return result
+                    finally:
+                        conn.execute("SELECT pg_advisory_unlock(%(id)s)", id=lockid)
+            waited = True
+            time.sleep(LOCK_POLL_INTERVAL)
+
+    def stats(self):
+        """Metrics of the group
+
+        'avoided' is the number of computations saved by the coalescing.
+        """
+        with self._lock:
+            metrics = dict(self.metrics)
+        metrics['avoided'] = metrics['coalesced'] + metrics['shared']
+        return metrics
+
+
+def coalesce(func):
+    """Decorator to coalesce the concurrent identical calls of `func`
+
+    The arguments of the calls build the key which identifies identical calls.
+    """
+    advisory_lock, shared_dir = _settings()
+    group = SingleFlight(func.__name__, advisory_lock, shared_dir)
+    _GROUPS[group.name] = group
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = (_freeze(args), _freeze(kwargs))
+        return group.do(key, func, *args, **kwargs)
+    wrapper.group = group
+    return wrapper
+
+
+def stats():
+    """Metrics for each coalesced function
+
+    Returns
+    -------
+    dict
+        function name -> metrics
+    """
+    return {name: group.stats() for name, group in _GROUPS.items()}
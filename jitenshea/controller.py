@@ -4,16 +4,32 @@
 """
 
 
+import os
+import json
+import time
+
 import daiquiri
 
 from itertools import groupby
 from datetime import datetime, timedelta
 from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import pandas as pd
 
-from jitenshea.stats import find_cluster
+from jitenshea import config, metrics, stream
+from jitenshea.stats import build_features, find_cluster, score_features
+from jitenshea import queries
 from jitenshea.iodb import db
+from jitenshea.coalesce import coalesce
+from jitenshea.cube import StationCube
+from jitenshea.hexgrid import hex_geojson
+from jitenshea.pagination import decode_cursor, encode_cursor, next_cursor
+from jitenshea.registry import MODELS
+from jitenshea.spatial import IndexCache
+from jitenshea.tiles import (TileCache, check_tile, tile_envelope, tile_lonlat_bounds,
+                             EXTENT, BUFFER)
 
 
 logger = daiquiri.getLogger(__name__)
@@ -21,6 +37,39 @@ logger = daiquiri.getLogger(__name__)
 CITIES = ('bordeaux',
           'lyon')
 TimeWindow = namedtuple('TimeWindow', ['start', 'stop', 'order_reference_date'])
+# run the independent queries of a request concurrently
+EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='controller')
+
+
+class RawJSON(str):
+    """JSON text built by the database, sent as is by the Web API
+    """
+
+
+def postgis_geojson():
+    """Whether the GeoJSON responses are built by PostGIS, see the 'geojson'
+    option of the [database] section
+    """
+    if config is None or not config.has_section('database'):
+        return False
+    return config['database'].get('geojson', fallback='python') == 'postgis'
+
+
+def _postgis_geojson(name, city, kind=None, limit=None, **params):
+    """FeatureCollection of the query `name`, built by PostGIS
+
+    With a listing `kind`, the cursor of the next page is added as the 'next'
+    foreign member, without parsing the text.
+    """
+    if kind is not None:
+        params['limit'] = limit
+    geojson, count, last_id = queries.execute(name + '_geojson', city, **params)[0]
+    if kind is None:
+        return RawJSON(geojson)
+    cursor = None
+    if limit is not None and count == limit:
+        cursor = encode_cursor(kind, last_id)
+    return RawJSON('{}, "next": {}}}'.format(geojson[:-1], json.dumps(cursor)))
 
 
 def processing_daily_data(rset, window):
@@ -153,7 +202,15 @@ def cities():
                       'stations': 174}]}
 
 
-def stations(city, limit, geojson):
+def _after_id(kind, cursor):
+    """Station id after which a page of the listing `kind` starts
+    """
+    if cursor is None:
+        return ''
+    return decode_cursor(cursor, kind)[0]
+
+
+def stations(city, limit, geojson, cursor=None):
     """List of bicycle stations
 
     Parameters
@@ -161,21 +218,26 @@ def stations(city, limit, geojson):
     city : string
     limit : int
     geojson : boolean
+    cursor : str
+        Cursor of the page, given by the 'next' key of the previous page
 
     Returns
     -------
     list
         a list of dict, one dict by bicycle station
     """
-    query = _query_stations(city, limit)
-    eng = db()
-    rset = eng.execute(query)
-    keys = rset.keys()
-    result = [dict(zip(keys, row)) for row in rset]
+    after = _after_id('stations', cursor)
+    if geojson and postgis_geojson():
+        return _postgis_geojson('stations', city, 'stations', limit, after=after)
+    result = queries.execute('stations', city, limit=limit, after=after).dicts()
+    cursor = next_cursor('stations', result, limit, lambda x: (x['id'],))
     if geojson:
-        return station_geojson(result,
-                               feature_list=['id', 'name', 'address', 'city', 'nb_stands'])
-    return {"data": result}
+        with metrics.timed('compute'):
+            geodata = station_geojson(result,
+                                      feature_list=['id', 'name', 'address', 'city', 'nb_stands'])
+        geodata["next"] = cursor
+        return geodata
+    return {"data": result, "next": cursor}
 
 
 def specific_stations(city, ids):
@@ -191,86 +253,10 @@ def specific_stations(city, ids):
     list of dict
         One dict by bicycle station
     """
-    query = _query_stations(city, 1).replace("LIMIT 1", 'WHERE id IN %(id_list)s')
-    eng = db()
-    rset = eng.execute(query, id_list=tuple(str(x) for x in ids)).fetchall()
+    rset = queries.execute('specific_stations', city, ids=[str(x) for x in ids])
     if not rset:
         return []
-    return {"data": [dict(zip(x.keys(), x)) for x in rset]}
-
-
-def _query_stations(city, limit=20):
-    """Query to get the list of bicycle stations
-
-    Parameters
-    ----------
-    city : str
-    limit : int
-
-    Returns
-    -------
-    str
-    """
-    return """SELECT id
-      ,name
-      ,address
-      ,city
-      ,nb_stations as nb_stands
-      ,st_x(geom) as x
-      ,st_y(geom) as y
-    FROM {schema}.station
-    LIMIT {limit}
-    """.format(schema=city,
-               limit=limit)
-
-
-def daily_query(city):
-    """SQL query to get daily transactions according to the city
-    """
-    if city not in ('bordeaux', 'lyon'):
-        raise ValueError("City '{}' not supported.".format(city))
-    return """SELECT id
-           ,number AS value
-           ,date
-           ,name
-        FROM {schema}.{table} AS X
-        LEFT JOIN {schema}.{station} AS Y using(id)
-        WHERE id IN %(id_list)s AND date >= %(start)s AND date <= %(stop)s
-        ORDER BY id,date""".format(schema=city,
-                                   table='daily_transaction',
-                                   station='station')
-
-
-def daily_query_stations(city, limit, order_by='station'):
-    """SQL query to get daily transactions for all stations
-    """
-    if city not in ('bordeaux', 'lyon'):
-        raise ValueError("City '{}' not supported.".format(city))
-    if order_by == 'station':
-        order_by = 'id'
-    if order_by == 'value':
-        order_by = 'number DESC'
-    return """WITH station AS (
-            SELECT id
-              ,row_number() over (partition by null order by {order_by}) AS rank
-            FROM {schema}.{table}
-            WHERE date = %(order_reference_date)s
-            ORDER BY {order_by}
-            LIMIT {limit}
-            )
-        SELECT S.id
-          ,D.number AS value
-          ,D.date
-          ,Y.name
-        FROM station AS S
-        LEFT JOIN {schema}.{table} AS D ON (S.id=D.id)
-        LEFT JOIN {schema}.{station} AS Y ON S.id=Y.id
-        WHERE D.date >= %(start)s AND D.date <= %(stop)s
-        ORDER BY S.rank,D.date;""".format(schema=city,
-                                          table='daily_transaction',
-                                          station='station',
-                                          order_by=order_by,
-                                          limit=limit)
+    return {"data": rset.dicts()}
 
 
 def daily_transaction(city, station_ids, day, window=0, backward=True):
@@ -288,15 +274,14 @@ def daily_transaction(city, station_ids, day, window=0, backward=True):
     Return a list of dicts
     """
     window = time_window(day, window, backward)
-    query = daily_query(city)
-    eng = db()
-    rset = eng.execute(query,
-                       id_list=tuple(str(x) for x in station_ids),
-                       start=window.start, stop=window.stop).fetchall()
+    rset = queries.execute('daily', city, ids=[str(x) for x in station_ids],
+                           start=window.start, stop=window.stop)
     return processing_daily_data(rset, window)
 
 
-def daily_transaction_list(city, day, limit, order_by, window=0, backward=True):
+@coalesce
+def daily_transaction_list(city, day, limit, order_by, window=0, backward=True,
+                           cursor=None):
     """Retrieve the daily transaction for the Bordeaux stations
 
     city: str
@@ -308,41 +293,67 @@ def daily_transaction_list(city, day, limit, order_by, window=0, backward=True):
         Number of days to look around the specific date
     backward: bool (True by default)
         Get data before the date or not, according to the window number
+    cursor: str
+        Cursor of the page, given by the 'next' key of the previous page
 
     Return a list of dicts
     """
+    if order_by not in ('station', 'value'):
+        raise ValueError("Order by '{}' not supported.".format(order_by))
+    kind = 'daily_by_' + order_by
+    params = {'after_id': ''}
+    if order_by == 'value':
+        params['after_value'] = float('inf')
+    if cursor is not None:
+        key = decode_cursor(cursor, kind)
+        if order_by == 'value':
+            params['after_value'], params['after_id'] = key
+        else:
+            params['after_id'], = key
     window = time_window(day, window, backward)
-    query = daily_query_stations(city, limit, order_by)
-    eng = db()
-    rset = eng.execute(query, start=window.start, stop=window.stop,
-                       order_reference_date=window.order_reference_date).fetchall()
-    return processing_daily_data(rset, window)
+    rset = queries.execute('daily_stations_by_' + order_by, city, limit=limit,
+                           start=window.start, stop=window.stop,
+                           order_reference_date=window.order_reference_date,
+                           **params)
+    result = processing_daily_data(rset, window)
+    result["next"] = next_cursor(kind, result["data"], limit,
+                                 lambda x: _daily_key(x, order_by, window))
+    return result
+
+
+def _daily_key(station, order_by, window):
+    """Keyset of a station of the daily transactions list
+    """
+    if order_by == 'station':
+        return (station['id'],)
+    value = station['value'][station['date'].index(window.order_reference_date)]
+    return (value, station['id'])
 
 
 def timeseries(city, station_ids, start, stop):
     """Get timeseries data between two dates for a specific city and a list of station ids
     """
-    query = """SELECT T.*
-      ,S.name as name
-      ,S.nb_stations as nb_stands
-    FROM {schema}.{table} AS T
-    LEFT JOIN {schema}.{station} AS S using(id)
-    WHERE id IN %(id_list)s AND timestamp >= %(start)s AND timestamp < %(stop)s
-    ORDER BY id,timestamp
-    """.format(schema=city,
-               table='timeseries',
-               station='station')
-    eng = db()
-    rset = eng.execute(query, id_list=tuple(x for x in station_ids),
-                       start=start, stop=stop)
+    rset = queries.execute('timeseries', city, ids=[str(x) for x in station_ids],
+                           start=start, stop=stop)
     return processing_timeseries(rset)
 
 
+def _fetch_dicts(name, city, **params):
+    """Execute a registered query and return the rows as a list of dicts
+    """
+    return queries.execute(name, city, **params).dicts()
+
+
+@coalesce
 def prediction_timeseries(city, station_ids, start, stop,
                           values_num, with_current_values, freq='1H'):
     """Get bike availability predictions between `start` and `stop` dates for
     `city` at stations `station_ids`
 
+    The `values_num` latest predictions of each station and its current value
+    (the latest availability of the window) are selected by the database, with
+    two queries run concurrently.
+
     Parameters
     ----------
     city : str
@@ -354,56 +365,35 @@ def prediction_timeseries(city, station_ids, start, stop,
     stop : datetime
         End of prediction period
     values_num : int
-        Number of predict values
+        Number of predict values for each station
     with_current_values : bool
         Include the current values?
     Returns
     -------
     list of dict
     """
-    # get predicted data
-    query = """SELECT T.station_id AS id
-         , T.timestamp AS timestamp
-         , T.nb_bikes AS nb_bikes
-         , S.nb_stations as nb_stands
-         , S.name AS name
-         FROM {city}.prediction AS T
-         LEFT JOIN {city}.station AS S ON (T.station_id::varchar = S.id::varchar)
-         WHERE id IN %(id_list)s
-           AND timestamp >= %(start)s AND timestamp < %(stop)s
-           AND frequency = %(freq)s
-         ORDER BY id,timestamp;""".format(city=city)
-    eng = db()
-    rset_pred = eng.execute(query, id_list=tuple(x for x in station_ids),
-                            start=start, stop=stop, freq=freq)
-    # current values
-    rset_current = None
+    ids = [str(x) for x in station_ids]
+    future_pred = EXECUTOR.submit(metrics.propagate(_fetch_dicts), 'prediction', city,
+                                  ids=ids, start=start, stop=stop,
+                                  freq=freq, values_num=values_num)
+    future_current = None
     if with_current_values:
-        query = """select distinct id
-           , timestamp
-           , available_bikes as nb_bikes
-           , S.nb_stations as nb_stands
-           , S.name
-        from {city}.timeseries as T
-        left join {city}.station as S using(id)
-        where id in %(id_list)s
-           AND timestamp >= %(start)s and timestamp < %(stop)s
-        """.format(city=city)
-        rset_current = eng.execute(query, id_list=tuple(x for x in station_ids),
-                                   start=start, stop=stop)
-    pred = [dict(zip(x.keys(), x)) for x in rset_pred]
-    # truncate the nth latest values and add the prediction time
-    for data in pred[-values_num:]:
+        future_current = EXECUTOR.submit(metrics.propagate(_fetch_dicts),
+                                         'current_values', city,
+                                         ids=ids, start=start, stop=stop)
+    pred = future_pred.result()
+    for data in pred:
         data['at'] = freq
     current = []
-    if rset_current:
-        current = [dict(zip(x.keys(), x)) for x in rset_current]
+    if future_current is not None:
+        current = future_current.result()
         for data in current:
             data['at'] = '0'
-    return current + pred[-values_num:]
+    return current + pred
 
 
-def latest_availability(city, limit, geojson):
+@coalesce
+def latest_availability(city, limit, geojson, cursor=None):
     """Get bike the latest bikes availability for a specific city.
 
     Parameters
@@ -414,46 +404,32 @@ def latest_availability(city, limit, geojson):
         Max number of stations
     geosjon : bool
         Data in geojson?
-    freq : str
-        Time horizon
+    cursor : str
+        Cursor of the page, given by the 'next' key of the previous page
 
     Returns
     -------
     dict
     """
-    query = """with latest as (
-      select id
-        ,timestamp
-        ,available_bikes as nb_bikes
-        ,rank() over (partition by id order by timestamp desc) as rank
-      from {city}.timeseries
-      where timestamp >= %(min_date)s
-    )
-    select P.id
-      ,P.timestamp
-      ,P.nb_bikes
-      ,S.name
-      ,S.nb_stations as nb_stands
-      ,st_x(S.geom) as x
-      ,st_y(S.geom) as y
-    from latest as P
-    join {city}.station as S using(id)
-    where P.rank=1
-    order by id
-    limit %(limit)s
-    """.format(city=city)
-    eng = db()
     # avoid getting the full history
     min_date = datetime.now() - timedelta(days=2)
-    rset = eng.execute(query, min_date=min_date, limit=limit)
-    keys = rset.keys()
-    result = [dict(zip(keys, row)) for row in rset]
-    latest_date = max(x['timestamp'] for x in result)
+    after = _after_id('availability', cursor)
+    if geojson and postgis_geojson():
+        return _postgis_geojson('latest_availability', city, 'availability', limit,
+                                min_date=min_date, after=after)
+    result = queries.execute('latest_availability', city, min_date=min_date, limit=limit,
+                             after=after).dicts()
+    latest_date = max((x['timestamp'] for x in result), default=None)
+    cursor = next_cursor('availability', result, limit, lambda x: (x['id'],))
     if geojson:
-        return station_geojson(result, feature_list=['id', 'name', 'timestamp', 'nb_bikes', 'nb_stands'])
-    return {"data": result, "date": latest_date}
+        with metrics.timed('compute'):
+            geodata = station_geojson(result, feature_list=['id', 'name', 'timestamp', 'nb_bikes', 'nb_stands'])
+        geodata["next"] = cursor
+        return geodata
+    return {"data": result, "date": latest_date, "next": cursor}
 
 
+@coalesce
 def latest_predictions(city, limit, geojson, freq='1H'):
     """Get bike availability predictions for a specific city.
 
@@ -472,58 +448,346 @@ def latest_predictions(city, limit, geojson, freq='1H'):
     -------
     dict
     """
-    query = """with latest as (
-      select station_id as id
-        ,timestamp
-        ,nb_bikes
-        ,rank() over (partition by station_id order by timestamp desc) as rank
-      from {city}.prediction
-      where frequency=%(freq)s
-         and timestamp >= %(min_date)s
-    )
-    select P.id
-      ,P.timestamp
-      ,P.nb_bikes
-      ,S.name
-      ,S.nb_stations as nb_stands
-      ,st_x(S.geom) as x
-      ,st_y(S.geom) as y
-    from latest as P
-    join {city}.station as S using(id)
-    where P.rank=1
-    order by id
-    limit %(limit)s
-    """.format(city=city)
-    eng = db()
     # avoid getting the full history
     min_date = datetime.now() - timedelta(days=2)
-    rset = eng.execute(query, freq=freq, min_date=min_date, limit=limit)
-    keys = rset.keys()
-    result = [dict(zip(keys, row)) for row in rset]
+    result = queries.execute('latest_predictions', city, freq=freq,
+                             min_date=min_date, limit=limit).dicts()
     predict_date = max(x['timestamp'] for x in result)
     if geojson:
-        return station_geojson(result, feature_list=['id', 'name', 'timestamp', 'nb_bikes', 'nb_stands'])
+        with metrics.timed('compute'):
+            return station_geojson(result, feature_list=['id', 'name', 'timestamp', 'nb_bikes', 'nb_stands'])
     return {"data": result, "date": predict_date}
 
 
+def _spatial_stations(city):
+    """Stations coordinates used to build the spatial index
+    """
+    return queries.execute('stations', city, limit=None, after='').dicts()
+
+
+def _spatial_availability(city):
+    """Latest availability of all the stations joined to the spatial index
+    """
+    latest = latest_availability(city, None, False)
+    return latest['data'], latest['date']
+
+
+def _availability_ttl():
+    if config is None or not config.has_section('spatial'):
+        return 60
+    return config['spatial'].getint('availability_ttl', fallback=60)
+
+
+SPATIAL_INDEXES = IndexCache(_spatial_stations, _spatial_availability,
+                             availability_ttl=_availability_ttl())
+
+
+def _tile_cache_size():
+    if config is None or not config.has_section('tiles'):
+        return 1024
+    return config['tiles'].getint('cache_size', fallback=1024)
+
+
+TILES = TileCache(_tile_cache_size())
+
+
+def station_tile(city, z, x, y):
+    """Vector tile (MVT) of the stations, with their latest availability and
+    cluster label
+
+    The tile is cached until the next ingestion tick, i.e. a newer latest
+    availability in the spatial index of the city. Only the computation of a
+    missing tile is coalesced, see `render_tile`.
+
+    Parameters
+    ----------
+    city : str
+    z, x, y : int
+        Tile coordinates (XYZ scheme)
+
+    Returns
+    -------
+    bytes
+    """
+    check_tile(z, x, y)
+    index = SPATIAL_INDEXES.get(city)
+    tick = index.date if index is not None else None
+    if tick is not None:
+        tile = TILES.get(city, z, x, y, tick)
+        if tile is not None:
+            return tile
+    return render_tile(city, z, x, y, tick)
+
+
+@coalesce
+def render_tile(city, z, x, y, tick):
+    """Compute the tile `z`, `x`, `y` with `ST_AsMVT` and cache it for the
+    ingestion tick `tick` (if not None), see `station_tile`
+
+    Returns
+    -------
+    bytes
+    """
+    xmin, ymin, xmax, ymax = tile_envelope(z, x, y)
+    lon_min, lat_min, lon_max, lat_max = tile_lonlat_bounds(z, x, y)
+    rset = queries.execute('station_tile', city, xmin=xmin, ymin=ymin, xmax=xmax,
+                           ymax=ymax, extent=EXTENT, buffer=BUFFER,
+                           min_date=datetime.now() - timedelta(days=2),
+                           lon_min=lon_min, lat_min=lat_min, lon_max=lon_max,
+                           lat_max=lat_max)
+    tile = bytes(rset[0][0] or b'')
+    if tick is not None:
+        TILES.put(city, z, x, y, tick, tile)
+    return tile
+
+
+def _stream_snapshot(city):
+    """Latest availability of the stations sent by the live stream
+    """
+    min_date = datetime.now() - timedelta(days=2)
+    rows = queries.execute('availability_snapshot', city, min_date=min_date).dicts()
+    availability = {x['id']: (x['nb_bikes'], x['nb_stands']) for x in rows}
+    return max((x['timestamp'] for x in rows), default=None), availability
+
+
+def _stream_connect(city):
+    # the notifications are sent on the primary database; the listening
+    # connection lives as long as the stream, out of the pool
+    conn = db('write', city).raw_connection()
+    conn.detach()
+    return conn.connection
+
+
+def _stream_settings():
+    if config is None or not config.has_section('stream'):
+        return {'interval': 60, 'queue_size': 16, 'listen': None}
+    section = config['stream']
+    return {'interval': section.getint('interval', fallback=60),
+            'queue_size': section.getint('queue_size', fallback=16),
+            'listen': (stream.listen(_stream_connect)
+                       if section.getboolean('listen', fallback=False) else None)}
+
+
+STREAMS = stream.Hub(_stream_snapshot, **_stream_settings())
+
+
+def availability_stream(city):
+    """Subscribe to the live availability of `city`
+
+    Returns
+    -------
+    tuple
+        (broadcaster, subscription), see `jitenshea.stream`
+    """
+    broadcaster = STREAMS[city]
+    return broadcaster, broadcaster.subscribe()
+
+
+# latest availability of the forecasts, when the live stream does not run:
+# city -> (loading time, date, availability)
+_FORECAST_SNAPSHOTS = {}
+
+
+def forecast_snapshot(city):
+    """Latest availability of the stations used by the forecasts: the one in
+    memory of the live stream when it runs, else the latest state loaded at
+    most every `availability_ttl` seconds
+
+    Returns
+    -------
+    tuple
+        (date, dict station id -> (nb_bikes, nb_stands))
+    """
+    current = STREAMS[city].current()
+    if current is not None:
+        return current
+    now = time.monotonic()
+    cached = _FORECAST_SNAPSHOTS.get(city)
+    if cached is None or now - cached[0] > _availability_ttl():
+        cached = _FORECAST_SNAPSHOTS[city] = (now,) + _stream_snapshot(city)
+    return cached[1:]
+
+
+@coalesce
+def forecast(city, station_ids=None, horizons=None):
+    """Bike availability forecasts of the latest snapshot, computed on demand
+    by the active models of the registry (see `jitenshea.registry`)
+
+    The features are built as by the prediction task, then each model scores
+    all the stations at once.
+
+    Parameters
+    ----------
+    city : str
+    station_ids : list
+        All the stations of the snapshot if None
+    horizons : list
+        Prediction frequencies, e.g. '30T', all the ones with an active model
+    by default
+
+    Returns
+    -------
+    dict
+        The date of the snapshot, the forecasts of each station and horizon
+    ('at') and the model of each horizon; None without any active model
+    """
+    if horizons is None:
+        horizons = sorted(MODELS.registry(city).read()['active'])
+    models = {}
+    for horizon in horizons:
+        path, booster = MODELS.active(city, horizon)
+        if booster is not None:
+            models[horizon] = (os.path.basename(path), booster)
+    if not models:
+        return None
+    date, availability = forecast_snapshot(city)
+    if station_ids is None:
+        ids = list(availability)
+    else:
+        ids = [x for x in (str(y) for y in station_ids) if x in availability]
+    data = []
+    with metrics.timed('compute'):
+        bikes = np.array([availability[x][0] for x in ids], dtype=np.float64)
+        stands = np.array([availability[x][1] for x in ids], dtype=np.float64)
+        # the stations without any bike nor stand are not in the training data
+        keep = bikes + stands > 0
+        if date is not None and keep.any():
+            df = pd.DataFrame({'station_id': np.array(ids)[keep].astype(int),
+                               'ts': pd.Timestamp(date),
+                               'nb_bikes': bikes[keep],
+                               'nb_stands': stands[keep],
+                               'probability': bikes[keep] / (bikes + stands)[keep]})
+            features = build_features(df)
+            for horizon, (_, booster) in models.items():
+                predicted = score_features(features, booster, horizon)
+                data.extend({'id': str(station), 'timestamp': ts.to_pydatetime(),
+                             'nb_bikes': int(nb_bikes), 'nb_stands': int(nb_stands),
+                             'probability': float(probability), 'at': horizon}
+                            for ts, station, probability, nb_bikes, nb_stands
+                            in zip(predicted.index, predicted['station_id'],
+                                   predicted['pred_probability'],
+                                   predicted['pred_nb_bikes'],
+                                   predicted['pred_nb_stands']))
+    return {"date": date, "data": data,
+            "models": {k: name for k, (name, _) in models.items()}}
+
+
+def nearest_stations(city, lon, lat, n=5, min_bikes=0):
+    """Nearest stations with at least `min_bikes` available bikes
+
+    Parameters
+    ----------
+    city : str
+    lon : float
+    lat : float
+    n : int
+        Number of stations
+    min_bikes : int
+
+    Returns
+    -------
+    dict
+        Stations sorted by distance (in meters)
+    """
+    index = SPATIAL_INDEXES.get(city)
+    if index is not None:
+        return {"data": index.nearest(lon, lat, n, min_bikes),
+                "date": index.date}
+    logger.info("spatial index of '%s' not ready: KNN query with PostGIS", city)
+    min_date = datetime.now() - timedelta(days=2)
+    result = queries.execute('nearest_stations', city, lon=lon, lat=lat, n=n,
+                             min_bikes=min_bikes, min_date=min_date).dicts()
+    latest_date = max((x['timestamp'] for x in result), default=None)
+    return {"data": result, "date": latest_date}
+
+
+def stations_within(city, xmin, ymin, xmax, ymax, min_bikes=0):
+    """Stations within a bounding box, e.g. a map viewport
+
+    Parameters
+    ----------
+    city : str
+    xmin, ymin, xmax, ymax : float
+        Longitude and latitude bounds
+    min_bikes : int
+
+    Returns
+    -------
+    dict
+        Stations sorted by id
+    """
+    index = SPATIAL_INDEXES.get(city)
+    if index is not None:
+        return {"data": index.within(xmin, ymin, xmax, ymax, min_bikes),
+                "date": index.date}
+    logger.info("spatial index of '%s' not ready: bbox query with PostGIS", city)
+    min_date = datetime.now() - timedelta(days=2)
+    result = queries.execute('stations_within', city, xmin=xmin, ymin=ymin,
+                             xmax=xmax, ymax=ymax, min_bikes=min_bikes,
+                             min_date=min_date).dicts()
+    latest_date = max((x['timestamp'] for x in result), default=None)
+    return {"data": result, "date": latest_date}
+
+
+@coalesce
+def heatmap(city, resolution, start=None, stop=None):
+    """Availability by hexagonal cell, for the latest time bucket or for each
+    time bucket between `start` and `stop` (an animation)
+
+    Parameters
+    ----------
+    city : str
+    resolution : int
+        See `hexgrid.RESOLUTIONS`
+    start, stop : datetime
+        Range of the buckets, the latest bucket if `start` is None
+
+    Returns
+    -------
+    dict
+        The cells as a GeoJSON FeatureCollection, sent once, and the frames:
+    one by bucket, with the rows [cell index, bikes, stands, transactions]
+    """
+    if start is None:
+        start = stop = queries.execute('hex_rollup_latest', city,
+                                       resolution=resolution)[0][0]
+    elif stop is None:
+        stop = start
+    rset = [] if start is None else queries.execute(
+        'hex_rollup', city, resolution=resolution, start=start, stop=stop)
+    cells = {}
+    frames = []
+    for bucket, rows in groupby(rset, lambda row: row[0]):
+        frames.append({"bucket": bucket,
+                       "cells": [[cells.setdefault((q, r), len(cells)),
+                                  bikes, stands, transactions]
+                                 for _, q, r, bikes, stands, transactions in rows]})
+    q, r = zip(*cells) if cells else ((), ())
+    return {"resolution": resolution,
+            "cells": hex_geojson(q, r, resolution),
+            "frames": frames}
+
+
 def hourly_process(df):
     """DataFrame with timeseries into a hourly transaction profile
 
     df: DataFrame
-        timeseries bike data for one specific station
+        timeseries bike data of one or several stations ('id' column), sorted
+        by date
 
-    Return a DataFrame with the transactions sum & mean for each hour
+    Return a DataFrame indexed by station id and hour with the transactions
+    sum & mean for each hour
     """
-    df = df.copy().set_index('ts')
-    transaction = (df['available_bikes']
-                   .diff()
-                   .abs()
-                   .dropna()
-                   .resample('H')
-                   .sum()
-                   .reset_index())
-    transaction['hour'] = transaction['ts'].apply(lambda x: x.hour)
-    return transaction.groupby('hour')['available_bikes'].agg(['sum', 'mean'])
+    transactions = df.groupby('id')['available_bikes'].diff().abs()
+    observed = transactions.notnull().values
+    cube = StationCube.from_arrays(df['id'].values[observed], df['ts'].values[observed],
+                                   {'transactions': transactions.values[observed]},
+                                   '1H', agg='sum', dtype=np.float64)
+    hours, sums, means, counts = cube.profile('transactions', 'hour')
+    station, hour = np.nonzero(counts)
+    return pd.DataFrame({'sum': sums[station, hour], 'mean': means[station, hour]},
+                        index=pd.MultiIndex.from_arrays([cube.stations[station], hours[hour]],
+                                                        names=['id', 'hour']))
 
 
 def hourly_profile(city, station_ids, day, window):
@@ -542,13 +806,22 @@ def hourly_profile(city, station_ids, day, window):
     Return a list of dicts
     """
     start = day - timedelta(window)
+    data = timeseries(city, station_ids, start, day)["data"]
+    with metrics.timed('compute'):
+        # the profiles of all the stations in one cube
+        df = pd.DataFrame({'id': np.repeat([x['id'] for x in data], [len(x['ts']) for x in data]),
+                           'ts': [ts for x in data for ts in x['ts']],
+                           'available_bikes': [v for x in data for v in x['available_bikes']]},
+                          columns=['id', 'ts', 'available_bikes'])
+        profiles = hourly_process(df.astype({'available_bikes': float}))
+    by_station = {k: x.droplevel('id') for k, x in profiles.groupby(level='id')}
+    empty = profiles.droplevel('id').iloc[:0]
     result = []
-    for data in timeseries(city, station_ids, start, day)["data"]:
-        df = pd.DataFrame(data)
-        profile = hourly_process(df)
+    for station in data:
+        profile = by_station.get(station['id'], empty)
         result.append({
-            'id': data['id'],
-            'name': data['name'],
+            'id': station['id'],
+            'name': station['name'],
             'hour': profile.index.values.tolist(),
             'sum': profile['sum'].values.tolist(),
             'mean': profile['mean'].values.tolist()})
@@ -585,8 +858,9 @@ def daily_profile(city, station_ids, day, window):
     """
     result = []
     for data in daily_transaction(city, station_ids, day, window)["data"]:
-        df = pd.DataFrame(data)
-        profile = daily_profile_process(df)
+        with metrics.timed('compute'):
+            df = pd.DataFrame(data)
+            profile = daily_profile_process(df)
         result.append({
             'id': data['id'],
             'name': data['name'],
@@ -609,53 +883,11 @@ def get_station_ids(city):
     list of integers
         IDs of the shared-bike stations in the `city`
     """
-    query = ("SELECT id FROM {schema}.{table}"
-             ";").format(schema=city,
-                         table='station')
-    eng = db()
-    rset = eng.execute(query).fetchall()
-    if not rset:
-        return []
+    rset = queries.execute('station_ids', city)
     return [row[0] for row in rset]
 
 
-def station_cluster_query(city):
-    """SQL query to get cluster IDs for some shared_bike stations within `city`
-
-    Parameters
-    ----------
-    city : str
-        City of interest, either ̀bordeaux` or `lyon`
-
-    Returns
-    -------
-    str
-        SQL query that gives the cluster ID for shared-bike stations in `city`
-    """
-    if city not in ('bordeaux', 'lyon'):
-        raise ValueError("City '{}' not supported.".format(city))
-    return ("WITH ranked_clusters AS ("
-            "SELECT cs.station_id AS id, "
-            "cs.cluster_id, "
-            "cs.start AS start, "
-            "cs.stop AS stop, "
-            "citystation.name AS name, "
-            "citystation.geom AS geom, "
-            "rank() OVER (ORDER BY stop DESC) AS rank "
-            "FROM {schema}.{cluster} AS cs "
-            "JOIN {schema}.{station} AS citystation "
-            "ON citystation.id = cs.station_id "
-            "WHERE cs.station_id IN %(id_list)s) "
-            "SELECT id, cluster_id, start, stop, name, "
-            "st_x(geom) as x, "
-            "st_y(geom) as y "
-            "FROM ranked_clusters "
-            "WHERE rank=1"
-            ";").format(schema=city,
-                        cluster='clustering',
-                        station='station')
-
-
+@coalesce
 def station_clusters(city, station_ids=None, geojson=False):
     """Return the cluster IDs of shared-bike stations in `city`, when running a
     K-means algorithm between `day` and `day+window`
@@ -677,48 +909,21 @@ def station_clusters(city, station_ids=None, geojson=False):
     """
     if station_ids is None:
         station_ids = get_station_ids(city)
-    query = station_cluster_query(city)
-    eng = db()
-    rset = eng.execute(query,
-                       id_list=tuple(str(x) for x in station_ids))
+    ids = [str(x) for x in station_ids]
+    if geojson and postgis_geojson():
+        return _postgis_geojson('station_clusters', city, ids=ids)
+    rset = queries.execute('station_clusters', city, ids=ids)
     if not rset:
         logger.warning("rset is empty")
         return {"data": []}
-    data = {"data": [dict(zip(rset.keys(), row)) for row in rset]}
+    data = {"data": rset.dicts()}
     if geojson:
-        return clustered_station_geojson(data["data"])
+        with metrics.timed('compute'):
+            return clustered_station_geojson(data["data"])
     return data
 
 
-def cluster_profile_query(city):
-    """SQL query to get cluster descriptions as 24-houred timeseries within `city`
-
-    Parameters
-    ----------
-    city : str
-        City of interest, either ̀bordeaux` or `lyon`
-
-    Returns
-    -------
-    str
-        SQL query that gives the timeseries cluster profile in `city`
-
-    """
-    if city not in ('bordeaux', 'lyon'):
-        raise ValueError("City '{}' not supported.".format(city))
-    return ("WITH ranked_centroids AS ("
-            "SELECT *, rank() OVER (ORDER BY stop DESC) AS rank "
-            "FROM {schema}.{centroid}) "
-            "SELECT cluster_id, "
-            "h00, h01, h02, h03, h04, h05, h06, h07, h08, h09, h10, h11, "
-            "h12, h13, h14, h15, h16, h17, h18, h19, h20, h21, h22, h23, "
-            "start, stop "
-            "FROM ranked_centroids "
-            "WHERE rank=1"
-            ";").format(schema=city,
-                        centroid='centroid')
-
-
+@coalesce
 def cluster_profiles(city):
     """Return the cluster profiles in `city`, when running a K-means algorithm
     between `day` and `day+window`
@@ -733,20 +938,20 @@ def cluster_profiles(city):
     dict
         Cluster profiles for each cluster, at each hour of the day
     """
-    query = cluster_profile_query(city)
-    eng = db()
-    df = pd.io.sql.read_sql_query(query, eng)
+    rset = queries.execute('cluster_profiles', city)
+    df = pd.DataFrame(rset, columns=rset.keys())
     if df.empty:
         logger.warning("df is empty")
         return {"data": []}
-    df = df.set_index('cluster_id')
-    labels = find_cluster(df)
-    result = []
-    for cluster_id, cluster in df.iterrows():
-        result.append({"cluster_id": cluster_id,
-                       'label': labels[cluster_id],
-                       "start": cluster['start'],
-                       'stop': cluster['stop'],
-                       'hour': list(range(24)),
-                       'values': [cluster[h] for h in ["h{:02d}".format(i) for i in range(24)]]})
+    with metrics.timed('compute'):
+        df = df.set_index('cluster_id')
+        labels = find_cluster(df)
+        result = []
+        for cluster_id, cluster in df.iterrows():
+            result.append({"cluster_id": cluster_id,
+                           'label': labels[cluster_id],
+                           "start": cluster['start'],
+                           'stop': cluster['stop'],
+                           'hour': list(range(24)),
+                           'values': [cluster[h] for h in ["h{:02d}".format(i) for i in range(24)]]})
     return {"data": result}
@@ -0,0 +1,421 @@
+# coding: utf-8
+
+"""Dense station x time x variable cube of the bike availability
+
+The statistics (clustering, features of the prediction model, profiles) work
+on a regular time grid. A `StationCube` is this grid: a NumPy array of shape
+(stations, time buckets, variables) with the index of the stations and of the
+time buckets. It is built in one vectorized pass from the rows of a query,
+instead of a resampling by station, and it may be backed by a memory-mapped
+file. A `CubeAccumulator` builds it chunk by chunk, e.g. from a server-side
+cursor, without keeping the rows.
+
+The time range of a station is the range of its observations: the cells out
+of this range are NaN, like after the resampling of each station.
+"""
+
+import re
+import json
+
+import numpy as np
+import pandas as pd
+
+
+AGGREGATIONS = ('mean', 'sum', 'last')
+
+_UNITS = {'T': 'min', 'H': 'h', 'S': 's', 'L': 'ms'}
+
+
+def bucket_size(freq):
+    """Duration of the time buckets of `freq`, e.g. '10T', '10min' or '1H'
+
+    Returns
+    -------
+    pandas.Timedelta
+    """
+    if isinstance(freq, pd.Timedelta):
+        return freq
+    match = re.fullmatch(r"\s*(\d*)\s*([A-Za-z]+)\s*", freq)
+    if match is None:
+        raise ValueError("Invalid frequency '{}'".format(freq))
+    number, unit = match.groups()
+    return pd.Timedelta(int(number or 1), unit=_UNITS.get(unit, unit))
+
+
+def _fill(values, backward):
+    """Fill the NaN of each row of the 2D `values` with the next (previous)
+    valid value, in place
+    """
+    n = values.shape[1]
+    valid = ~np.isnan(values)
+    if backward:
+        index = np.where(valid, np.arange(n), n - 1)
+        index = np.minimum.accumulate(index[:, ::-1], axis=1)[:, ::-1]
+    else:
+        index = np.where(valid, np.arange(n), 0)
+        index = np.maximum.accumulate(index, axis=1)
+    values[:] = np.take_along_axis(values, index, axis=1)
+
+
+class StationCube:
+    """Bike availability on a regular time grid, by station
+
+    Parameters
+    ----------
+    data : numpy.ndarray
+        Shape (stations, time buckets, variables), NaN for a missing value
+    stations : array-like
+        Station ids, sorted
+    origin : pandas.Timestamp
+        Start of the first time bucket
+    freq : str or pandas.Timedelta
+        Duration of a time bucket
+    variables : list
+        Names of the variables
+    first, last : numpy.ndarray
+        Index of the first and of the last observed bucket of each station
+    """
+    def __init__(self, data, stations, origin, freq, variables, first=None, last=None):
+        self.data = data
+        self.stations = np.asarray(stations)
+        self.origin = pd.Timestamp(origin)
+        self.freq = bucket_size(freq)
+        self.variables = list(variables)
+        n_stations, n_times, _ = data.shape
+        self.first = np.zeros(n_stations, dtype=np.int64) if first is None else np.asarray(first)
+        self.last = (np.full(n_stations, n_times - 1, dtype=np.int64)
+                     if last is None else np.asarray(last))
+        self.station_index = {x: i for i, x in enumerate(self.stations.tolist())}
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def times(self):
+        """Start of each time bucket
+        """
+        return pd.date_range(self.origin, periods=self.data.shape[1], freq=self.freq)
+
+    @classmethod
+    def from_arrays(cls, stations, timestamps, values, freq, agg='mean', start=None,
+                    stop=None, dtype=np.float32, path=None):
+        """Cube of the observations (station, timestamp, values)
+
+        Parameters
+        ----------
+        stations : array-like
+            Station of each observation
+        timestamps : array-like
+            Date of each observation
+        values : dict
+            Variable name -> array of the values of each observation
+        freq : str
+            Duration of a time bucket
+        agg : str
+            Aggregation of the values of a bucket, 'mean', 'sum' (0 for a
+        bucket without observation) or 'last'
+        start, stop : datetime
+            Time range of the grid, the range of the observations by default
+        dtype : numpy.dtype
+        path : str
+            Build a memory-mapped cube in this .npy file, see `save`
+
+        Returns
+        -------
+        StationCube
+        """
+        if agg not in AGGREGATIONS:
+            raise ValueError("Unknown aggregation '{}'".format(agg))
+        step = bucket_size(freq).value
+        codes, ids = pd.factorize(np.asarray(stations), sort=True)
+        ns = pd.DatetimeIndex(timestamps).values.astype('datetime64[ns]').astype(np.int64)
+        if start is not None:
+            origin = pd.Timestamp(start).value // step * step
+        else:
+            origin = ns.min() // step * step if len(ns) else 0
+        if stop is not None:
+            n_times = -(-(pd.Timestamp(stop).value - origin) // step)
+        else:
+            n_times = int((ns.max() - origin) // step + 1) if len(ns) else 0
+        buckets = (ns - origin) // step
+        keep = (buckets >= 0) & (buckets < n_times)
+        codes, buckets = codes[keep], buckets[keep]
+        n_stations = len(ids)
+        flat = codes * n_times + buckets
+        shape = (n_stations, n_times, len(values))
+        if path is not None:
+            data = np.lib.format.open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+        else:
+            data = np.empty(shape, dtype=dtype)
+
+        size = n_stations * n_times
+        observed = np.bincount(flat, minlength=size).reshape(n_stations, n_times) > 0
+        has_data = observed.any(axis=1)
+        first = np.zeros(n_stations, dtype=np.int64)
+        last = np.full(n_stations, -1, dtype=np.int64)
+        if n_times:
+            first[has_data] = observed.argmax(axis=1)[has_data]
+            last[has_data] = n_times - 1 - observed[:, ::-1].argmax(axis=1)[has_data]
+        in_range = (np.arange(n_times) >= first[:, np.newaxis]) \
+            & (np.arange(n_times) <= last[:, np.newaxis])
+        if agg == 'last':
+            # index of the last observation of each bucket
+            order = np.argsort(ns[keep], kind='stable')[::-1]
+            cells, position = np.unique(flat[order], return_index=True)
+            last_rows = order[position]
+        for k, name in enumerate(values):
+            value = np.asarray(values[name], dtype=np.float64)[keep]
+            if agg == 'last':
+                grid = np.full(size, np.nan)
+                grid[cells] = value[last_rows]
+            else:
+                valid = ~np.isnan(value)
+                sums = np.bincount(flat[valid], weights=value[valid], minlength=size)
+                if agg == 'sum':
+                    grid = sums
+                else:
+                    counts = np.bincount(flat[valid], minlength=size)
+                    with np.errstate(invalid='ignore', divide='ignore'):
+                        grid = np.where(counts > 0, sums / counts, np.nan)
+            grid = grid.reshape(n_stations, n_times)
+            grid[~in_range] = np.nan
+            data[:, :, k] = grid
+        cube = cls(data, ids, pd.Timestamp(origin), freq, list(values), first, last)
+        if path is not None:
+            data.flush()
+            cube._save_index(path)
+        return cube
+
+    @classmethod
+    def from_frame(cls, df, freq, variables=None, station='station_id', ts='ts', **kwargs):
+        """Cube of the rows of a DataFrame, e.g. the result of a query
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+        freq : str
+        variables : list
+            Columns of the variables, all the columns but `station` and `ts`
+        by default
+        station, ts : str
+            Columns of the station ids and of the dates
+        kwargs : dict
+            See `from_arrays`
+        """
+        if variables is None:
+            variables = [x for x in df.columns if x not in (station, ts)]
+        return cls.from_arrays(df[station].values, df[ts].values,
+                               {x: df[x].values for x in variables}, freq, **kwargs)
+
+    def _save_index(self, path):
+        index = {'stations': self.stations.tolist(),
+                 'origin': self.origin.isoformat(),
+                 'freq': self.freq.value,
+                 'variables': self.variables,
+                 'first': self.first.tolist(),
+                 'last': self.last.tolist()}
+        with open(path + '.json', 'w') as fobj:
+            json.dump(index, fobj)
+
+    def save(self, path):
+        """Save the cube into the .npy file `path`, and its index into
+        `path`.json
+        """
+        np.save(path, self.data)
+        self._save_index(path)
+
+    @classmethod
+    def load(cls, path, mmap_mode='r'):
+        """Cube saved by `save`, memory-mapped by default
+        """
+        with open(path + '.json') as fobj:
+            index = json.load(fobj)
+        data = np.load(path, mmap_mode=mmap_mode)
+        return cls(data, index['stations'], index['origin'], pd.Timedelta(index['freq']),
+                   index['variables'], index['first'], index['last'])
+
+    def var(self, name):
+        """View (stations, time buckets) of the variable `name`
+        """
+        return self.data[:, :, self.variables.index(name)]
+
+    def in_range(self):
+        """Mask (stations, time buckets) of the range of each station
+        """
+        times = np.arange(self.data.shape[1])
+        return (times >= self.first[:, np.newaxis]) & (times <= self.last[:, np.newaxis])
+
+    def fill(self, method='bfill'):
+        """Fill the missing values within the range of each station with the
+        next ('bfill') or previous ('ffill') value, in place
+
+        Returns
+        -------
+        StationCube
+        """
+        if method not in ('bfill', 'ffill'):
+            raise ValueError("Unknown fill method '{}'".format(method))
+        out_of_range = ~self.in_range()
+        for k in range(len(self.variables)):
+            values = np.array(self.data[:, :, k])
+            _fill(values, backward=method == 'bfill')
+            values[out_of_range] = np.nan
+            self.data[:, :, k] = values
+        return self
+
+    def select(self, stations=None, times=None):
+        """Sub-cube of the stations mask and of the time buckets mask
+        """
+        data, ids, first, last = self.data, self.stations, self.first, self.last
+        origin = self.origin
+        if stations is not None:
+            data, ids = data[stations], ids[stations]
+            first, last = first[stations], last[stations]
+        if times is not None:
+            # a slice keeps the grid regular
+            index = np.flatnonzero(times)
+            start, stop = (index[0], index[-1] + 1) if len(index) else (0, 0)
+            data = data[:, start:stop]
+            origin = origin + start * self.freq
+            first = np.maximum(first - start, 0)
+            last = np.minimum(last - start, stop - start - 1)
+        return StationCube(data, ids, origin, self.freq, self.variables, first, last)
+
+    def to_frame(self, station='station_id', ts='ts', dropna=True):
+        """Long DataFrame (station, ts, variables...) of the cube, sorted by
+        station and date, without the buckets out of the range of the stations
+        if `dropna`
+        """
+        n_stations, n_times, _ = self.data.shape
+        mask = self.in_range().ravel() if dropna else slice(None)
+        times = self.times.values
+        frame = {station: np.repeat(self.stations, n_times)[mask],
+                 ts: np.tile(times, n_stations)[mask]}
+        for k, name in enumerate(self.variables):
+            frame[name] = self.data[:, :, k].ravel()[mask]
+        return pd.DataFrame(frame)
+
+    def profile(self, name, by='hour', mask=None):
+        """Sum, mean and count of the variable `name` by hour of the day or day
+        of the week, for each station
+
+        Parameters
+        ----------
+        name : str
+        by : str
+            'hour' or 'weekday'
+        mask : numpy.ndarray
+            Boolean mask of the time buckets to consider, e.g. the weekdays
+
+        Returns
+        -------
+        tuple
+            (keys, sum, mean, count), arrays of shape (number of keys,) and
+        (stations, number of keys); the mean is NaN without any value
+        """
+        keys = np.arange(24) if by == 'hour' else np.arange(7)
+        groups = getattr(self.times, by).values
+        onehot = (groups[:, np.newaxis] == keys).astype(np.float64)
+        if mask is not None:
+            onehot[~np.asarray(mask)] = 0.
+        values = np.asarray(self.var(name), dtype=np.float64)
+        valid = ~np.isnan(values)
+        sums = np.where(valid, values, 0.) @ onehot
+        counts = valid.astype(np.float64) @ onehot
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = sums / counts
+        return keys, sums, means, counts
+
+
+class CubeAccumulator:
+    """Mean of the observations on a fixed time grid, added by chunks
+
+    The sums and the counts by cell are kept, not the observations: the
+    memory does not depend on the number of rows. The stations are added as
+    they come.
+
+    Parameters
+    ----------
+    start, stop : datetime
+        Time range of the grid
+    freq : str
+        Duration of a time bucket
+    variables : list
+        Names of the variables
+    """
+    def __init__(self, start, stop, freq, variables):
+        self.freq = bucket_size(freq)
+        self.step = self.freq.value
+        self.origin = pd.Timestamp(start).value // self.step * self.step
+        self.n_times = int(-(-(pd.Timestamp(stop).value - self.origin) // self.step))
+        self.variables = list(variables)
+        self.station_index = {}
+        self.sums = np.zeros((0, self.n_times, len(self.variables)))
+        self.counts = np.zeros((0, self.n_times, len(self.variables)), dtype=np.int32)
+
+    def _codes(self, stations):
+        ids, inverse = np.unique(stations, return_inverse=True)
+        new = [x for x in ids.tolist() if x not in self.station_index]
+        if new:
+            for x in new:
+                self.station_index[x] = len(self.station_index)
+            shape = (len(new),) + self.sums.shape[1:]
+            self.sums = np.concatenate([self.sums, np.zeros(shape)])
+            self.counts = np.concatenate([self.counts, np.zeros(shape, dtype=np.int32)])
+        rows = np.array([self.station_index[x] for x in ids.tolist()], dtype=np.int64)
+        return rows[inverse.ravel()]
+
+    def add(self, stations, timestamps, values):
+        """Add a chunk of observations
+
+        Parameters
+        ----------
+        stations : numpy.ndarray
+            Integer code of the station of each observation
+        timestamps : numpy.ndarray
+            Date of each observation, as datetime64 or as int64 nanoseconds
+        since the epoch
+        values : dict
+            Variable name -> array of the values of each observation
+        """
+        if not len(stations):
+            return
+        ns = np.asarray(timestamps)
+        if ns.dtype.kind == 'M':
+            ns = ns.astype('datetime64[ns]').astype(np.int64)
+        buckets = (ns - self.origin) // self.step
+        keep = (buckets >= 0) & (buckets < self.n_times)
+        codes = self._codes(np.asarray(stations))[keep]
+        flat = codes * self.n_times + buckets[keep]
+        size = self.sums.shape[0] * self.n_times
+        for k, name in enumerate(self.variables):
+            value = np.asarray(values[name])[keep].astype(np.float64)
+            valid = ~np.isnan(value)
+            self.sums[:, :, k] += np.bincount(flat[valid], weights=value[valid],
+                                              minlength=size).reshape(-1, self.n_times)
+            self.counts[:, :, k] += np.bincount(flat[valid], minlength=size) \
+                .reshape(-1, self.n_times).astype(np.int32)
+
+    def cube(self, dtype=np.float32):
+        """StationCube of the means, sorted by station, see
+        `StationCube.from_arrays`
+        """
+        stations = np.array(list(self.station_index), dtype=np.int64)
+        order = np.argsort(stations, kind='stable')
+        stations, sums, counts = stations[order], self.sums[order], self.counts[order]
+        observed = (counts > 0).any(axis=2)
+        has_data = observed.any(axis=1)
+        n_stations = len(stations)
+        first = np.zeros(n_stations, dtype=np.int64)
+        last = np.full(n_stations, -1, dtype=np.int64)
+        if self.n_times:
+            first[has_data] = observed.argmax(axis=1)[has_data]
+            last[has_data] = self.n_times - 1 - observed[:, ::-1].argmax(axis=1)[has_data]
+        times = np.arange(self.n_times)
+        in_range = (times >= first[:, np.newaxis]) & (times <= last[:, np.newaxis])
+        with np.errstate(invalid='ignore', divide='ignore'):
+            data = np.where(counts > 0, sums / counts, np.nan).astype(dtype)
+        data[~in_range] = np.nan
+        return StationCube(data, stations, pd.Timestamp(self.origin), self.freq,
+                           self.variables, first, last)
@@ -0,0 +1,110 @@
+# coding: utf-8
+
+"""Bulk export of the bike availability in Parquet or gzip CSV
+
+The rows are streamed from a server-side cursor and written by chunks of a
+fixed number of rows, i.e. one Parquet row group by chunk: the memory used by
+an export does not depend on its date range.
+
+An export is either a luigi task (`tasks.city.ExportTimeseries`) or an
+asynchronous job of the Web API (`/api/<city>/export`).
+"""
+
+import gzip
+
+import daiquiri
+
+import pandas as pd
+
+from jitenshea import queries
+from jitenshea.iodb import db
+
+
+logger = daiquiri.getLogger(__name__)
+
+FORMATS = {'parquet': ('parquet', 'application/vnd.apache.parquet'),
+           'csv': ('csv.gz', 'application/gzip')}
+CHUNK_SIZE = 100000
+
+COLUMNS = ['id', 'timestamp', 'available_bikes', 'available_stands', 'status']
+DTYPES = {'available_bikes': 'Int16', 'available_stands': 'Int16'}
+
+
+def chunks(city, start, stop, ids=None, chunk_size=CHUNK_SIZE):
+    """Availability of `city` between `start` and `stop`, by chunks
+
+    Parameters
+    ----------
+    city : str
+    start, stop : datetime
+    ids : list
+        Station ids, all the stations if None
+    chunk_size : int
+        Number of rows of a chunk
+
+    Yields
+    ------
+    pandas.DataFrame
+    """
+    name, params = 'export_timeseries', {'start': start, 'stop': stop}
+    if ids is not None:
+        name, params['ids'] = 'export_station_timeseries', [str(x) for x in ids]
+    with db('analytics', city).connect() as conn:
+        rset = (conn.execution_options(stream_results=True, max_row_buffer=chunk_size)
+                .execute(queries.statement(name, city), **params))
+        for rows in rset.partitions(chunk_size):
+            yield pd.DataFrame.from_records(rows, columns=COLUMNS).astype(DTYPES)
+
+
+def write_csv(chunks, path):
+    """Write the chunks into a gzip CSV file, return the number of rows
+    """
+    count = 0
+    with gzip.open(path, 'wt', newline='') as fobj:
+        fobj.write(','.join(COLUMNS) + '\n')
+        for df in chunks:
+            df.to_csv(fobj, header=False, index=False)
+            count += len(df)
+    return count
+
+
+def write_parquet(chunks, path):
+    """Write the chunks into a Parquet file, one row group by chunk, return the
+    number of rows
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([('id', pa.string()),
+                        ('timestamp', pa.timestamp('us')),
+                        ('available_bikes', pa.int16()),
+                        ('available_stands', pa.int16()),
+                        ('status', pa.string())])
+    count = 0
+    with pq.ParquetWriter(path, schema, compression='snappy') as writer:
+        for df in chunks:
+            writer.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False))
+            count += len(df)
+    return count
+
+
+def export(city, start, stop, path, fmt='parquet', ids=None, chunk_size=CHUNK_SIZE):
+    """Export the availability of `city` between `start` and `stop` into
+    `path`
+
+    Parameters
+    ----------
+    fmt : str
+        'parquet' or 'csv' (gzip)
+
+    Returns
+    -------
+    int
+        Number of exported rows
+    """
+    if fmt not in FORMATS:
+        raise ValueError("Unknown export format '{}'".format(fmt))
+    write = write_parquet if fmt == 'parquet' else write_csv
+    count = write(chunks(city, start, stop, ids, chunk_size), path)
+    logger.info("export %s rows of '%s' between %s and %s", count, city, start, stop)
+    return count
@@ -0,0 +1,138 @@
+# coding: utf-8
+
+"""Feature store of the bike availability prediction model
+
+The features of a city (see `stats.build_features`) are stored by day, one
+Parquet partition by day and resampling frequency:
+
+    <datadir>/<city>/features/<freq>/<YYYY-MM-DD>.parquet
+
+A partition is built once, when its day is over (`tasks.city.BuildFeatures`).
+Its rows are streamed from a server-side cursor with compact types (int32
+station codes, int16 counts, int64 epoch timestamps) and accumulated into a
+`StationCube`, see `extract`.
+A training reads the partitions of its window instead of extracting and
+resampling the whole window again. The label (the future availability) is
+added when reading, since it crosses the boundaries of the days.
+"""
+
+import os
+import sys
+import resource
+
+import daiquiri
+
+import numpy as np
+import pandas as pd
+
+from jitenshea import queries
+from jitenshea.cube import CubeAccumulator
+from jitenshea.iodb import db
+
+
+logger = daiquiri.getLogger(__name__)
+
+DTYPES = {'station_id': 'int32',
+          'nb_bikes': 'float32',
+          'nb_stands': 'float32',
+          'probability': 'float32',
+          'day': 'int8',
+          'hour': 'int8',
+          'minute': 'int8'}
+CHUNK_SIZE = 100000
+VARIABLES = ['nb_bikes', 'nb_stands', 'probability']
+
+
+def peak_rss():
+    """Peak resident set size of the process, in bytes
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def chunks(city, start, stop, chunk_size=CHUNK_SIZE):
+    """Availability of `city` between `start` and `stop`, by chunks of
+    compact arrays
+
+    Yields
+    ------
+    dict
+        Arrays `station_id` (int32), `ts` (int64, nanoseconds since the
+    epoch), `nb_bikes` and `nb_stands` (int16)
+    """
+    params = {'start': start, 'stop': stop}
+    with db('analytics', city).connect() as conn:
+        rset = (conn.execution_options(stream_results=True, max_row_buffer=chunk_size)
+                .execute(queries.statement('training_availability', city), **params))
+        for rows in rset.partitions(chunk_size):
+            station_id, ts, bikes, stands = zip(*rows)
+            yield {'station_id': np.array(station_id, dtype=np.int32),
+                   'ts': np.array(ts, dtype=np.int64) * 1000,
+                   'nb_bikes': np.array(bikes, dtype=np.int16),
+                   'nb_stands': np.array(stands, dtype=np.int16)}
+
+
+def accumulate(chunks, start, stop, freq):
+    """Mean availability by station and time bucket of the `chunks`, see
+    `chunks`
+
+    Returns
+    -------
+    jitenshea.cube.StationCube
+        Variables `nb_bikes`, `nb_stands` and `probability`
+    """
+    acc = CubeAccumulator(start, stop, freq, VARIABLES)
+    count = 0
+    for chunk in chunks:
+        bikes, stands = chunk['nb_bikes'], chunk['nb_stands']
+        total = bikes.astype(np.float32) + stands
+        values = {'nb_bikes': bikes, 'nb_stands': stands, 'probability': bikes / total}
+        acc.add(chunk['station_id'], chunk['ts'], values)
+        count += len(bikes)
+    logger.info("accumulate %d rows into a cube of %d stations", count,
+                len(acc.station_index))
+    return acc.cube()
+
+
+def extract(city, start, stop, freq, chunk_size=CHUNK_SIZE):
+    """Availability of `city` between `start` and `stop` on the time grid of
+    `freq`, see `accumulate`
+    """
+    return accumulate(chunks(city, start, stop, chunk_size), start, stop, freq)
+
+
+def partition_path(datadir, city, freq, day):
+    """Path of the features of `city` for the day `day`
+    """
+    return os.path.join(datadir, city, 'features', freq, '{}.parquet'.format(day))
+
+
+def write_partition(df, path):
+    """Write the features of a day, with compact dtypes
+    """
+    if not df.empty:
+        df = df.astype({k: v for k, v in DTYPES.items() if k in df.columns})
+    df.to_parquet(path, index=False)
+
+
+def read_partitions(paths, columns=None):
+    """Features of the partitions `paths`, sorted by station and date
+
+    Parameters
+    ----------
+    paths : list
+    columns : list
+        Columns to read, all of them by default
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    frames = [pd.read_parquet(path, columns=columns) for path in paths]
+    frames = [x for x in frames if not x.empty]
+    if not frames:
+        return pd.DataFrame(columns=columns or ['station_id', 'ts'] + list(DTYPES)[1:])
+    logger.info("read %d feature partitions", len(frames))
+    df = pd.concat(frames, ignore_index=True)
+    return df.sort_values(['station_id', 'ts'], kind='stable', ignore_index=True)
@@ -0,0 +1,16 @@
+# coding: utf-8
+
+"""Stable keys of the cached results, e.g. the Web API jobs, the training
+matrices or the exported files
+"""
+
+import json
+import hashlib
+
+
+def key_hash(*key):
+    """SHA-1 hex digest of `key`, JSON-serializable values; the other values
+    are hashed through their string
+    """
+    data = json.dumps(key, sort_keys=True, default=str).encode('utf-8')
+    return hashlib.sha1(data).hexdigest()
@@ -0,0 +1,162 @@
+# coding: utf-8
+
+"""Hexagonal grid for the spatial aggregation of the stations
+
+The grid is made of pointy-top hexagons in the Web Mercator plane
+(EPSG:3857), identified by their axial coordinates (q, r). A cell only depends
+on its resolution, so the grid is the same for every city and every day.
+
+The rollups aggregate the station availability by cell and time bucket, see
+`hex_rollup`. They feed the city heatmaps.
+"""
+
+import math
+
+import numpy as np
+import pandas as pd
+
+
+# edge length of the hexagons (Web Mercator meters, about 0.7 times less on the
+# ground at the latitude of Lyon and Bordeaux) by resolution
+RESOLUTIONS = {7: 1600., 8: 600., 9: 230.}
+
+ORIGIN_SHIFT = 20037508.342789244
+SQRT3 = math.sqrt(3.)
+
+
+def _mercator(lon, lat):
+    x = np.radians(lon) * ORIGIN_SHIFT / math.pi
+    y = np.log(np.tan(np.pi / 4. + np.radians(lat) / 2.)) * ORIGIN_SHIFT / math.pi
+    return x, y
+
+
+def _lonlat(x, y):
+    lon = np.degrees(x * math.pi / ORIGIN_SHIFT)
+    lat = np.degrees(2. * np.arctan(np.exp(y * math.pi / ORIGIN_SHIFT)) - math.pi / 2.)
+    return lon, lat
+
+
+def hex_cells(lon, lat, resolution):
+    """Cells of the points (`lon`, `lat`)
+
+    Parameters
+    ----------
+    lon, lat : array-like
+    resolution : int
+        See RESOLUTIONS
+
+    Returns
+    -------
+    tuple of arrays
+        (q, r) axial coordinates of the cells
+    """
+    size = RESOLUTIONS[resolution]
+    x, y = _mercator(np.asarray(lon, dtype=np.float64), np.asarray(lat, dtype=np.float64))
+    # fractional axial coordinates then rounding in cube coordinates
+    q = (SQRT3 / 3. * x - y / 3.) / size
+    r = (2. / 3. * y) / size
+    s = -q - r
+    rq, rr, rs = np.round(q), np.round(r), np.round(s)
+    dq, dr, ds = np.abs(rq - q), np.abs(rr - r), np.abs(rs - s)
+    fix_q = (dq > dr) & (dq > ds)
+    fix_r = ~fix_q & (dr > ds)
+    rq = np.where(fix_q, -rr - rs, rq)
+    rr = np.where(fix_r, -rq - rs, rr)
+    return rq.astype(np.int64), rr.astype(np.int64)
+
+
+def hex_centers(q, r, resolution):
+    """Longitude and latitude of the centers of the cells (q, r)
+    """
+    size = RESOLUTIONS[resolution]
+    q = np.asarray(q, dtype=np.float64)
+    r = np.asarray(r, dtype=np.float64)
+    x = size * SQRT3 * (q + r / 2.)
+    y = size * 1.5 * r
+    return _lonlat(x, y)
+
+
+def hex_polygons(q, r, resolution):
+    """Vertices of the cells (q, r)
+
+    Returns
+    -------
+    numpy.array
+        Shape (number of cells, 7, 2): closed rings of (lon, lat)
+    """
+    size = RESOLUTIONS[resolution]
+    q = np.asarray(q, dtype=np.float64)
+    r = np.asarray(r, dtype=np.float64)
+    x = size * SQRT3 * (q + r / 2.)
+    y = size * 1.5 * r
+    angles = np.radians(30. + 60. * np.arange(7))
+    vx = x[:, np.newaxis] + size * np.cos(angles)
+    vy = y[:, np.newaxis] + size * np.sin(angles)
+    lon, lat = _lonlat(vx, vy)
+    return np.stack([lon, lat], axis=-1)
+
+
+def hex_geojson(q, r, resolution):
+    """GeoJSON FeatureCollection of the cells (q, r)
+    """
+    polygons = hex_polygons(q, r, resolution)
+    return {"type": "FeatureCollection",
+            "features": [{"type": "Feature",
+                          "geometry": {"type": "Polygon",
+                                       "coordinates": [ring.round(6).tolist()]},
+                          "properties": {"q": int(cq), "r": int(cr)}}
+                         for cq, cr, ring in zip(q, r, polygons)]}
+
+
+def hex_rollup(df, stations, freq='15min', resolutions=None):
+    """Availability aggregated by cell and time bucket
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Timeseries with the columns 'id', 'timestamp', 'available_bikes' and
+    'available_stands'
+    stations : pandas.DataFrame
+        Stations with the columns 'id', 'x' (longitude) and 'y' (latitude)
+    freq : str
+        Size of the time buckets
+    resolutions : list
+        Grid resolutions, all of them by default
+
+    Returns
+    -------
+    pandas.DataFrame
+        With the columns 'resolution', 'bucket', 'q', 'r', 'nb_bikes',
+    'nb_stands', 'transactions' and 'nb_stations'. The availability of a
+    station in a bucket is its last value; the transactions are the sum of the
+    absolute variations of its bikes.
+    """
+    columns = ['resolution', 'bucket', 'q', 'r', 'nb_bikes', 'nb_stands',
+               'transactions', 'nb_stations']
+    if df.empty:
+        return pd.DataFrame(columns=columns)
+    resolutions = sorted(RESOLUTIONS) if resolutions is None else resolutions
+    df = df.sort_values(['id', 'timestamp'])
+    df = df.assign(transactions=df.groupby('id')['available_bikes'].diff().abs().fillna(0),
+                   bucket=df['timestamp'].dt.floor(freq))
+    by_station = (df.groupby(['id', 'bucket'])
+                  .agg(nb_bikes=('available_bikes', 'last'),
+                       nb_stands=('available_stands', 'last'),
+                       transactions=('transactions', 'sum'))
+                  .reset_index())
+    stations = stations[['id', 'x', 'y']].drop_duplicates('id')
+    by_station = by_station.merge(stations, on='id', how='inner')
+    result = []
+    for resolution in resolutions:
+        q, r = hex_cells(by_station['x'].values, by_station['y'].values, resolution)
+        cells = (by_station.assign(q=q, r=r)
+                 .groupby(['bucket', 'q', 'r'])
+                 .agg(nb_bikes=('nb_bikes', 'sum'),
+                      nb_stands=('nb_stands', 'sum'),
+                      transactions=('transactions', 'sum'),
+                      nb_stations=('id', 'nunique'))
+                 .reset_index())
+        cells['transactions'] = cells['transactions'].astype(np.int64)
+        cells.insert(0, 'resolution', resolution)
+        result.append(cells)
+    return pd.concat(result, ignore_index=True)[columns]
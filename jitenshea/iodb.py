@@ -1,17 +1,46 @@
 # coding: utf-8
 
 """Some function to read and write with a PostgreSQL/PostGIS database
+
+The engines are returned by `db` according to the intent of the caller: the
+primary database for the writes, the read replicas for the Web API and for the
+analytics extractions, see the [database:<city>] and [replica:<name>] sections
+of the configuration file.
+
+The engines time every SQL statement. The statistics are
+aggregated by query fingerprint, i.e. the statement without its literal
+values, see `query_stats`. The statements slower than the 'slow_query_ms'
+threshold are logged with their parameters and their database, and kept in
+`slow_queries`; their plan can be captured on demand with `explain`, on the
+database where they ran. The execution of a prepared statement is recorded as
+the statement it prepared, see `PREPARED_STATEMENTS`.
 """
 
+import os
+import re
+import time
+import hashlib
+import itertools
+import threading
+from datetime import datetime
+from collections import deque
+
 import daiquiri
 
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 
 from jitenshea import config
 
 
 logger = daiquiri.getLogger(__name__)
 
+# number of durations kept by fingerprint to compute the percentiles
+DURATION_SAMPLES = 1000
+SLOW_QUERIES = 100
+# prepared statement name -> prepared statement, with pyformat parameters,
+# e.g. filled by `queries.prepare_statement`
+PREPARED_STATEMENTS = {}
+
 
 def psql_args():
     """Return the arguments for the command psql with some db parameters
@@ -46,18 +75,366 @@ def shp2pgsql_args(projection, filename, tablename, encoding=None):
     shp2pgsql.extend([filename, tablename])
     return shp2pgsql
 
-def db():
-    """Return a SQLAlchemy engine with Postgres connection parameters
+INTENTS = ('read', 'write', 'analytics')
+CONNECTION_KEYS = ('host', 'port', 'dbname', 'user', 'password')
+# number of seconds during which the measured lag of a replica is reused
+LAG_CHECK_INTERVAL = 5
+
+_ENGINES = {}
+_ENGINES_LOCK = threading.Lock()
+_LAGS = {}
+_ROUND_ROBIN = itertools.count()
+
+
+def database_settings(city=None):
+    """Connection parameters of the primary database of `city`
+
+    The [database:<city>] section overrides the parameters of the [database]
+    section for the schema of `city`.
+
+    Returns
+    -------
+    dict
+        host, port, dbname, user and password (None if not set)
     """
     database = config['database']
-    if database.get('password') is not None:
-        url = 'postgresql://{user}:{password}@{host}/{dbname}'
-        return create_engine(url.format(user=database['user'],
-                                        password=database['password'],
-                                        host=database['host'],
-                                        dbname=database['dbname']))
-    else:
-        url = 'postgresql://{user}@{host}/{dbname}'
-        return create_engine(url.format(user=database['user'],
-                                        host=database['host'],
-                                        dbname=database['dbname']))
+    settings = {key: database.get(key) for key in CONNECTION_KEYS}
+    section = 'database:{}'.format(city)
+    if city is not None and config.has_section(section):
+        settings.update((key, value) for key, value in config[section].items()
+                        if key in CONNECTION_KEYS)
+    return settings
+
+
+def replica_settings(intent, city=None):
+    """Connection parameters of the read replicas for `intent` and `city`
+
+    A replica is a [replica:<name>] section. Its connection parameters default
+    to the ones of the primary database of the city. The optional 'cities' and
+    'intents' options (comma-separated) restrict the use of the replica,
+    e.g. to dedicate a replica to the training extractions ('analytics').
+
+    Returns
+    -------
+    list of dicts
+    """
+    result = []
+    for section in config.sections():
+        if not section.startswith('replica:'):
+            continue
+        replica = config[section]
+        cities = _split(replica.get('cities'))
+        intents = _split(replica.get('intents')) or ['read', 'analytics']
+        if intent not in intents or (cities and city not in cities):
+            continue
+        settings = database_settings(city)
+        settings.update((key, value) for key, value in replica.items()
+                        if key in CONNECTION_KEYS)
+        result.append(settings)
+    return result
+
+
+def _split(value):
+    if not value:
+        return []
+    return [x.strip() for x in value.split(',') if x.strip()]
+
+
+def _url(settings):
+    credentials = settings['user']
+    if settings.get('password') is not None:
+        credentials += ':' + settings['password']
+    host = settings['host']
+    if settings.get('port'):
+        host += ':' + str(settings['port'])
+    return 'postgresql://{}@{}/{}'.format(credentials, host, settings['dbname'])
+
+
+def engine(settings):
+    """SQLAlchemy engine of the connection parameters `settings`
+
+    The engine, and thus its connection pool, is created once by process
+    (a forked process must not share the connections of its parent).
+    """
+    key = (os.getpid(), _url(settings))
+    with _ENGINES_LOCK:
+        eng = _ENGINES.get(key)
+        if eng is None:
+            eng = _ENGINES[key] = instrument(create_engine(key[1]))
+    return eng
+
+
+def _max_replica_lag():
+    if config is None or not config.has_section('database'):
+        return 30.
+    return config['database'].getfloat('max_replica_lag', fallback=30.)
+
+
+def replica_lag(eng):
+    """Replication lag of the replica `eng`, in seconds
+
+    The lag is zero when the replica has replayed all the WAL it received,
+    e.g. no write on the primary for a while. It is measured at most every
+    LAG_CHECK_INTERVAL seconds. An unreachable replica has an infinite lag.
+    """
+    now = time.monotonic()
+    measure = _LAGS.get(eng.url)
+    if measure is not None and now - measure[0] < LAG_CHECK_INTERVAL:
+        return measure[1]
+    try:
+        with eng.connect() as conn:
+            lag = conn.execute(
+                "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0 "
+                "ELSE extract(epoch FROM now() - pg_last_xact_replay_timestamp()) END"
+            ).scalar()
+        lag = float(lag or 0.)
+    except Exception:
+        logger.exception("cannot measure the lag of the replica '%s'", eng.url)
+        lag = float('inf')
+    _LAGS[eng.url] = (now, lag)
+    return lag
+
+
+def db(intent='write', city=None, fresh=False):
+    """Return a SQLAlchemy engine with Postgres connection parameters
+
+    Parameters
+    ----------
+    intent : str
+        'write' for the primary database, 'read' (Web API) or 'analytics'
+        (bulk extractions) for a read replica, if any is configured
+    city : str
+        Schema of the statements, which may live in its own database
+    fresh : bool
+        The statements need the latest data: a replica whose lag is greater
+        than the 'max_replica_lag' option is skipped for the primary
+
+    Returns
+    -------
+    sqlalchemy.engine.Engine
+    """
+    if intent not in INTENTS:
+        raise ValueError("Unknown database intent '{}'".format(intent))
+    if intent != 'write':
+        replicas = replica_settings(intent, city)
+        if replicas:
+            # round robin between the replicas
+            first = next(_ROUND_ROBIN)
+            for i in range(len(replicas)):
+                eng = engine(replicas[(first + i) % len(replicas)])
+                if not fresh or replica_lag(eng) <= _max_replica_lag():
+                    return eng
+            logger.warning("replicas of '%s' are lagging, use the primary database", city)
+    return engine(database_settings(city))
+
+def _slow_query_threshold():
+    """Threshold in seconds above which a statement is logged as slow
+    """
+    if config is None or not config.has_section('database'):
+        return 0.5
+    return config['database'].getfloat('slow_query_ms', fallback=500.) / 1000.
+
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAM = re.compile(r"%\(\w+\)s|%s|(?<!:):(?!:)\w+")
+_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_COMMENT = re.compile(r"--[^\n]*")
+_SPACES = re.compile(r"\s+")
+
+
+_EXECUTE = re.compile(r"\s*EXECUTE\s+(\w+)", re.IGNORECASE)
+
+
+def prepared_source(statement):
+    """Statement prepared by the `EXECUTE name(...)` statement `statement`, with
+    the same parameters; `statement` itself if it is not the execution of a
+    known prepared statement
+    """
+    match = _EXECUTE.match(statement)
+    if match is None:
+        return statement
+    return PREPARED_STATEMENTS.get(match.group(1), statement)
+
+
+def fingerprint(statement):
+    """Normalize a SQL statement: literals, parameters and lists of values are
+    replaced by '?', the case and the spaces are normalized
+
+    Parameters
+    ----------
+    statement : str
+
+    Returns
+    -------
+    str
+    """
+    query = _COMMENT.sub(' ', statement)
+    query = _STRING.sub('?', query)
+    query = _PARAM.sub('?', query)
+    query = _NUMBER.sub('?', query)
+    query = _LIST.sub('(?)', query)
+    query = _SPACES.sub(' ', query).strip().rstrip(';').strip()
+    return query.lower()
+
+
+class QueryStats:
+    """Statistics of the SQL statements aggregated by fingerprint
+    """
+    def __init__(self, slow_threshold=0.5):
+        self.slow_threshold = slow_threshold
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._slow = deque(maxlen=SLOW_QUERIES)
+        self._slow_id = 0
+
+    def record(self, statement, parameters, duration, rows, database=None):
+        """Record the execution of `statement`
+
+        `database` is the URL of the engine, without its password, see
+        `database_url`. The execution of a prepared statement is recorded as
+        its source statement, see `prepared_source`.
+        """
+        statement = prepared_source(statement)
+        query = fingerprint(statement)
+        key = hashlib.md5(query.encode('utf-8')).hexdigest()[:12]
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = {'fingerprint': query,
+                                            'calls': 0, 'total': 0., 'max': 0.,
+                                            'rows': 0,
+                                            'durations': deque(maxlen=DURATION_SAMPLES)}
+            stats['calls'] += 1
+            stats['total'] += duration
+            stats['max'] = max(stats['max'], duration)
+            stats['rows'] += max(rows, 0)
+            stats['durations'].append(duration)
+            if duration < self.slow_threshold:
+                return
+            self._slow_id += 1
+            self._slow.append({'id': self._slow_id, 'query_id': key,
+                               'statement': statement, 'parameters': parameters,
+                               'duration': duration, 'rows': rows,
+                               'database': database, 'at': datetime.now()})
+        logger.warning("slow query (%.3fs, %d rows) %s -- parameters: %s",
+                       duration, rows, _SPACES.sub(' ', statement).strip(),
+                       _short(parameters))
+
+    def summary(self, sort_by='total'):
+        """Statistics by fingerprint: calls, total, mean, p95, max (seconds)
+        and rows
+
+        Returns
+        -------
+        list of dicts
+            Sorted by decreasing `sort_by`
+        """
+        with self._lock:
+            items = [(key, dict(stats, durations=sorted(stats['durations'])))
+                     for key, stats in self._stats.items()]
+        result = []
+        for key, stats in items:
+            durations = stats.pop('durations')
+            stats['id'] = key
+            stats['mean'] = stats['total'] / stats['calls']
+            stats['p95'] = durations[int(round(0.95 * (len(durations) - 1)))]
+            result.append(stats)
+        return sorted(result, key=lambda x: x[sort_by], reverse=True)
+
+    def slow(self):
+        """Latest slow statements, the most recent first
+        """
+        with self._lock:
+            return list(reversed(self._slow))
+
+    def get_slow(self, slow_id):
+        with self._lock:
+            for query in self._slow:
+                if query['id'] == slow_id:
+                    return query
+        return None
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+            self._slow.clear()
+
+
+def _short(parameters, size=200):
+    text = repr(parameters)
+    return text if len(text) <= size else text[:size] + '...'
+
+
+query_stats = QueryStats(_slow_query_threshold())
+
+
+def database_url(eng):
+    """URL of the engine `eng`, without its password
+    """
+    return eng.url.render_as_string(hide_password=True)
+
+
+def slow_query_engine(query):
+    """Engine of the database where the slow statement `query` ran, see
+    `QueryStats.slow`
+    """
+    with _ENGINES_LOCK:
+        engines = [eng for (pid, _), eng in _ENGINES.items() if pid == os.getpid()]
+    for eng in engines:
+        if database_url(eng) == query.get('database'):
+            return eng
+    raise ValueError("Unknown database of the slow query: {}".format(query.get('database')))
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_stats_tic', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    tics = conn.info.get('query_stats_tic')
+    if not tics:
+        return
+    duration = time.perf_counter() - tics.pop()
+    query_stats.record(statement, parameters, duration, cursor.rowcount,
+                       database_url(conn.engine))
+
+
+def instrument(engine):
+    """Time the SQL statements executed by `engine`
+    """
+    event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+    return engine
+
+
+def explain(slow_id):
+    """Plan of a recorded slow statement, with EXPLAIN (ANALYZE, BUFFERS), on
+    the database where it ran
+
+    Only read statements are explained since ANALYZE executes the statement.
+
+    Parameters
+    ----------
+    slow_id : int
+        Id of the slow statement, see `QueryStats.slow`
+
+    Returns
+    -------
+    list of str
+        Lines of the plan, None if the statement is unknown
+    """
+    query = query_stats.get_slow(slow_id)
+    if query is None:
+        return None
+    statement = query['statement'].strip()
+    if not re.match(r"(select|with)\b", statement, re.IGNORECASE):
+        raise ValueError("Only SELECT statements can be explained")
+    if re.search(r"\b(insert|update|delete|truncate|drop|alter|create)\b",
+                 _STRING.sub('', statement), re.IGNORECASE):
+        raise ValueError("Only read statements can be explained")
+    eng = slow_query_engine(query)
+    with eng.connect() as conn:
+        cursor = conn.connection.cursor()
+        cursor.execute("EXPLAIN (ANALYZE, BUFFERS) " + statement, query['parameters'])
+        return [row[0] for row in cursor.fetchall()]
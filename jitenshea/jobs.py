@@ -0,0 +1,295 @@
+# coding: utf-8
+
+"""Asynchronous jobs of the Web API
+
+A job computes a long result, e.g. a daily profile over a year, in a local
+pool of threads and writes it to a file of the jobs directory. The client
+gets the job id at once, then polls the status of the job and downloads its
+result.
+
+The id of a job is the hash of its request: identical requests share the same
+job, pending or done, until its result is older than the TTL. The status of a
+job is a JSON file next to its result, so that each worker process of the Web
+API sees the jobs of the other ones.
+
+A job is claimed under a lock of the jobs directory: when several worker
+processes get the same request, only one of them computes it. The status of
+a job records its owner, the only process which updates it.
+
+The process of a pending or running job refreshes its heartbeat. A job whose
+heartbeat is older than the 'stale' delay died with its process: it is marked
+as failed, and computed again by the next identical request.
+"""
+
+import os
+import json
+import time
+import uuid
+import fcntl
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import daiquiri
+
+from jitenshea import config
+from jitenshea.hashing import key_hash
+
+
+logger = daiquiri.getLogger(__name__)
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+STATUS_SUFFIX = '.status.json'
+LOCK_FILE = '.lock'
+
+
+class JobError(Exception):
+    """Expected failure of a job, with the HTTP status of its error
+    """
+    def __init__(self, message, code=500):
+        super().__init__(message)
+        self.message = message
+        self.code = code
+
+
+def settings():
+    """Read the [jobs] options from the configuration file
+
+    Returns
+    -------
+    dict
+        directory, ttl (seconds), workers and stale (seconds without heartbeat
+    of a pending or running job)
+    """
+    section = config['jobs'] if config is not None and config.has_section('jobs') else {}
+    datadir = config['main']['datadir'] if config is not None else 'datarepo'
+    return {'directory': section.get('directory') or os.path.join(datadir, 'jobs'),
+            'ttl': int(section.get('ttl') or 86400),
+            'workers': int(section.get('workers') or 2),
+            'stale': int(section.get('stale') or 60)}
+
+
+def job_id(*key):
+    """Id of the job of the request `key`, JSON-serializable values
+    """
+    return key_hash(*key)
+
+
+class JobStore:
+    """Jobs computed by a local pool of threads, with their result files
+
+    Parameters
+    ----------
+    directory : str
+    ttl : int
+        Number of seconds during which a result is kept and shared
+    workers : int
+        Number of jobs computed at the same time by this process
+    stale : float
+        Number of seconds without heartbeat after which a pending or running
+        job is considered dead
+    """
+    def __init__(self, directory, ttl=86400, workers=2, stale=60):
+        self.directory = directory
+        self.ttl = ttl
+        self.stale = stale
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='job')
+        self._lock = threading.Lock()
+        # pending and running jobs of this process, by id
+        self._active = {}
+        self._heartbeat = None
+        self.owner = uuid.uuid4().hex
+
+    def _path(self, filename):
+        return os.path.join(self.directory, filename)
+
+    def _status_path(self, jid):
+        return self._path(jid + STATUS_SUFFIX)
+
+    def _write_status(self, status):
+        path = self._status_path(status['id'])
+        tmp = '{}.{}-{}'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp, 'w') as fobj:
+            json.dump(status, fobj)
+        os.replace(tmp, path)
+
+    @contextmanager
+    def _claim(self):
+        """Lock of the jobs directory, shared by the worker processes, held
+        to submit a job or to update the status of a job
+        """
+        with self._lock:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self._path(LOCK_FILE), 'a') as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                yield
+
+    def _read_status(self, jid):
+        try:
+            with open(self._status_path(jid)) as fobj:
+                return json.load(fobj)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _update_status(self, status):
+        """Write the status of a job of this process, unless another process
+        claimed the job since, e.g. after a missed heartbeat; within `_claim`
+
+        Returns
+        -------
+        bool
+            The status was written
+        """
+        current = self._read_status(status['id'])
+        if current is not None and current.get('owner') != self.owner:
+            logger.warning("job '%s' was claimed by another process", status['id'])
+            return False
+        self._write_status(status)
+        return True
+
+    def _expired(self, status, now):
+        return now - status.get('finished', status['submitted']) > self.ttl
+
+    def _stalled(self, status, now):
+        return (status['status'] in (PENDING, RUNNING)
+                and now - status.get('heartbeat', status['submitted']) > self.stale)
+
+    def _beat(self):
+        """Refresh the heartbeat of the pending and running jobs of this
+        process, until there is not any
+        """
+        while True:
+            time.sleep(self.stale / 4)
+            with self._claim():
+                if not self._active:
+                    self._heartbeat = None
+                    return
+                now = time.time()
+                for jid, status in list(self._active.items()):
+                    status['heartbeat'] = now
+                    if not self._update_status(status):
+                        del self._active[jid]
+
+    def _remove(self, status):
+        for path in (self._status_path(status['id']), self.result_path(status)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def status(self, jid):
+        """Status of the job `jid`, None if it is unknown or expired
+
+        Returns
+        -------
+        dict
+            With the keys 'id', 'status', 'submitted' (timestamp), 'filename'
+        and 'mimetype', then 'finished' and 'size' or 'error' and 'code'
+        """
+        if not all(c in '0123456789abcdef' for c in jid):
+            return None
+        status = self._read_status(jid)
+        if status is None:
+            return None
+        now = time.time()
+        if self._expired(status, now):
+            self._remove(status)
+            return None
+        if self._stalled(status, now):
+            logger.warning("job '%s' has not any heartbeat since %.0fs", jid,
+                           now - status.get('heartbeat', status['submitted']))
+            status = dict(status, status=FAILED, finished=now,
+                          error="The job was interrupted", code=500)
+            self._write_status(status)
+        return status
+
+    def result_path(self, status):
+        """Path of the result file of a done job
+        """
+        return self._path(status['filename'])
+
+    def submit(self, key, func, extension='json', mimetype='application/json', **info):
+        """Job of the request `key`, submitted unless an identical job is
+        pending or done
+
+        Parameters
+        ----------
+        key : tuple
+            JSON-serializable values which identify the request
+        func : callable
+            path -> None, writes the result of the job into `path`
+        extension, mimetype : str
+            Of the result file
+        info : dict
+            Added to the status of the job
+
+        Returns
+        -------
+        dict
+            Status of the job
+        """
+        jid = job_id(*key)
+        with self._claim():
+            status = self.status(jid)
+            if status is not None and status['status'] != FAILED:
+                return status
+            self.cleanup()
+            now = time.time()
+            status = dict(info, id=jid, status=PENDING, submitted=now, heartbeat=now,
+                          owner=self.owner, filename='{}.{}'.format(jid, extension),
+                          mimetype=mimetype)
+            self._write_status(status)
+            self._active[jid] = dict(status)
+            if self._heartbeat is None:
+                self._heartbeat = threading.Thread(target=self._beat, daemon=True,
+                                                   name='job-heartbeat')
+                self._heartbeat.start()
+            self._executor.submit(self._run, status, func)
+        logger.info("submit the job '%s'", jid)
+        return status
+
+    def _run(self, status, func):
+        with self._claim():
+            status = dict(status, status=RUNNING, heartbeat=time.time())
+            if not self._update_status(status):
+                self._active.pop(status['id'], None)
+                return
+            self._active[status['id']] = dict(status)
+        path = self.result_path(status)
+        tmp = '{}.{}-{}'.format(path, os.getpid(), threading.get_ident())
+        try:
+            func(tmp)
+            os.replace(tmp, path)
+        except Exception as e:
+            if not isinstance(e, JobError):
+                logger.exception("job '%s' failed", status['id'])
+                e = JobError("Internal error")
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            status = dict(status, status=FAILED, finished=time.time(),
+                          error=e.message, code=e.code)
+        else:
+            status = dict(status, status=DONE, finished=time.time(),
+                          size=os.path.getsize(path))
+        with self._claim():
+            self._active.pop(status['id'], None)
+            self._update_status(status)
+
+    def cleanup(self):
+        """Remove the expired jobs and their results
+        """
+        now = time.time()
+        for filename in os.listdir(self.directory):
+            if not filename.endswith(STATUS_SUFFIX):
+                continue
+            try:
+                with open(self._path(filename)) as fobj:
+                    status = json.load(fobj)
+            except (OSError, ValueError):
+                continue
+            if self._expired(status, now):
+                self._remove(status)
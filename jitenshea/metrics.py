@@ -0,0 +1,265 @@
+# coding: utf-8
+
+"""Per-request performance metrics of the Web application
+
+Each request records a timing breakdown:
+
+- db: time spent in the SQL statements (SQLAlchemy cursor events)
+- compute: post-processing in Python/pandas, see `timed`
+- serialize: JSON encoding
+- bytes out: size of the response body
+
+The latency histograms by route and city are exposed with the Prometheus text
+format on `/metrics`. The breakdown can also be sent with a `Server-Timing`
+response header.
+"""
+
+import time
+import threading
+from bisect import bisect_left
+from functools import wraps
+from contextlib import contextmanager
+
+import daiquiri
+
+from flask import request, Response
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from jitenshea import coalesce
+
+
+logger = daiquiri.getLogger(__name__)
+
+PHASES = ('db', 'compute', 'serialize')
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10.)
+SIZE_BUCKETS = (1e3, 1e4, 1e5, 1e6, 1e7)
+
+_local = threading.local()
+
+
+class Histogram:
+    """Cumulative histogram with fixed buckets, as Prometheus does
+    """
+    def __init__(self, buckets):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """List of (upper bound, cumulative count)
+        """
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Registry:
+    """Histograms by metric name and labels
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._help = {}
+
+    def observe(self, name, labels, value, buckets=LATENCY_BUCKETS):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._metrics.get(key)
+            if histogram is None:
+                histogram = self._metrics[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def describe(self, name, text):
+        self._help[name] = text
+
+    def exposition(self):
+        """Prometheus text format of all the histograms
+        """
+        with self._lock:
+            items = sorted(self._metrics.items())
+            lines = []
+            current = None
+            for (name, labels), histogram in items:
+                if name != current:
+                    current = name
+                    if name in self._help:
+                        lines.append("# HELP {} {}".format(name, self._help[name]))
+                    lines.append("# TYPE {} histogram".format(name))
+                for bound, count in histogram.cumulative():
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append("{}_bucket{} {}".format(
+                        name, _labels(labels + (('le', le),)), count))
+                lines.append("{}_sum{} {}".format(name, _labels(labels), histogram.sum))
+                lines.append("{}_count{} {}".format(name, _labels(labels), histogram.count))
+        return "\n".join(lines) + "\n"
+
+
+def _labels(labels):
+    if not labels:
+        return ''
+    escape = lambda x: str(x).replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+    return '{' + ','.join('{}="{}"'.format(k, escape(v)) for k, v in labels) + '}'
+
+
+REGISTRY = Registry()
+REGISTRY.describe('jitenshea_request_duration_seconds', "Duration of the requests")
+REGISTRY.describe('jitenshea_request_phase_seconds',
+                  "Time spent by the requests in the db, compute and serialize phases")
+REGISTRY.describe('jitenshea_response_size_bytes', "Size of the response bodies")
+
+
+def start():
+    """Start the timing breakdown of the current request
+    """
+    _local.timings = dict.fromkeys(PHASES, 0.)
+    _local.start = time.perf_counter()
+
+
+def stop():
+    """Stop the timing breakdown of the current request
+
+    Returns
+    -------
+    tuple
+        (total duration, dict phase -> duration) or None if not started
+    """
+    timings = getattr(_local, 'timings', None)
+    if timings is None:
+        return None
+    total = time.perf_counter() - _local.start
+    _local.timings = None
+    return total, timings
+
+
+def add(phase, duration):
+    """Add `duration` seconds to the `phase` of the current request, if any
+    """
+    timings = getattr(_local, 'timings', None)
+    if timings is not None:
+        timings[phase] += duration
+
+
+@contextmanager
+def timed(phase):
+    """Context manager to time a phase of the current request
+
+    >>> with timed('compute'):
+    ...     profile = hourly_process(df)
+    """
+    if getattr(_local, 'timings', None) is None:
+        yield
+        return
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        add(phase, time.perf_counter() - tic)
+
+
+def propagate(func):
+    """Wrap `func` to record its timings in the current request when it is
+    run by another thread, e.g. a thread pool
+    """
+    timings = getattr(_local, 'timings', None)
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'timings', None)
+        _local.timings = timings
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.timings = previous
+    return wrapper
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_tic', []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    tics = conn.info.get('metrics_tic')
+    if tics:
+        add('db', time.perf_counter() - tics.pop())
+
+
+def server_timing(total, timings):
+    """Value of the Server-Timing header
+    """
+    parts = ["{};dur={:.2f}".format(phase, 1000 * timings[phase]) for phase in PHASES]
+    parts.append("total;dur={:.2f}".format(1000 * total))
+    return ", ".join(parts)
+
+
+def install(app, with_server_timing=False):
+    """Record the metrics of each request of the Flask `app` and add the
+    `/metrics` route
+
+    Parameters
+    ----------
+    app : flask.Flask
+    with_server_timing : bool
+        Add the Server-Timing header to the responses
+    """
+    event.listen(Engine, 'before_cursor_execute', _before_cursor_execute)
+    event.listen(Engine, 'after_cursor_execute', _after_cursor_execute)
+
+    @app.before_request
+    def _start_timing():
+        start()
+
+    @app.after_request
+    def _record_timing(response):
+        measure = stop()
+        if measure is None or request.url_rule is None:
+            return response
+        total, timings = measure
+        route = request.url_rule.rule
+        city = (request.view_args or {}).get('city', '')
+        if response.status_code == 404:
+            # avoid one series by unknown city
+            city = ''
+        labels = {'route': route, 'city': city, 'method': request.method,
+                  'status': str(response.status_code)}
+        REGISTRY.observe('jitenshea_request_duration_seconds', labels, total)
+        for phase in PHASES:
+            REGISTRY.observe('jitenshea_request_phase_seconds',
+                             {'route': route, 'city': city, 'phase': phase},
+                             timings[phase])
+        if not response.is_streamed:
+            REGISTRY.observe('jitenshea_response_size_bytes',
+                             {'route': route, 'city': city},
+                             response.calculate_content_length() or 0,
+                             buckets=SIZE_BUCKETS)
+        if with_server_timing:
+            response.headers['Server-Timing'] = server_timing(total, timings)
+        return response
+
+    @app.route('/metrics')
+    def prometheus_metrics():
+        return Response(exposition(), mimetype='text/plain; version=0.0.4')
+
+
+def exposition():
+    """Prometheus text format of the request metrics and of the coalescing
+    counters
+    """
+    lines = [REGISTRY.exposition()]
+    lines.append("# HELP jitenshea_coalescing_total Coalesced calls of the controller functions")
+    lines.append("# TYPE jitenshea_coalescing_total counter")
+    for function, counters in sorted(coalesce.stats().items()):
+        for kind, value in sorted(counters.items()):
+            lines.append("jitenshea_coalescing_total{}".format(
+                _labels((('function', function), ('kind', kind)))) + " {}".format(value))
+    return "\n".join(lines) + "\n"
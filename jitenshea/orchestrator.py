@@ -0,0 +1,303 @@
+# coding: utf-8
+
+"""Parallel training of the prediction models of several cities, horizons and
+time windows
+
+A nightly retraining trains a model by city, prediction frequency and rolling
+window. Instead of independent tasks which read the same features again and
+compete for the cores, the orchestrator:
+
+- reads the features of the widest window of each city once, from the
+  feature store, and labels them for all the horizons at once (see
+  `stats.add_futures`);
+- writes them as one .npy file by column (`SharedWindow`), which the worker
+  processes memory-map read-only: the pages are shared through the page cache
+  and not copied into each worker;
+- runs the training jobs in a pool of processes with an explicit core budget,
+  each job training with `nthread` threads (see `core_budget`), the longest
+  windows first;
+- collects the models into the registry of each city: all of them are
+  registered, and the one with the lowest validation error of each city and
+  frequency is activated.
+
+The number of processes and of threads by job come from the [training]
+section of the configuration file, see `training.settings`.
+"""
+
+import os
+import json
+import shutil
+import tempfile
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import daiquiri
+
+import numpy as np
+import pandas as pd
+
+import xgboost as xgb
+
+from jitenshea import features, registry, training
+from jitenshea.stats import (add_futures, available_cores, fit_matrices,
+                             future_column)
+
+
+logger = daiquiri.getLogger(__name__)
+
+WINDOW_INDEX = 'window.json'
+
+# training of a model of `city` on the features between `start` and `stop`,
+# with the validation cutoff `validation`, saved in `path`
+Job = namedtuple('Job', ['city', 'start', 'stop', 'validation', 'frequency', 'path'])
+
+
+def cutoff(stop, frequency):
+    """Validation cutoff of a window ending at `stop`: the last one whose
+    validation set is labelled within the window
+    """
+    return pd.Timestamp(stop) - (training.VALIDATION_PERIODS + 1) * training.period(frequency)
+
+
+def core_budget(n_jobs, cores=None, threads=None):
+    """Number of processes and of threads by job to run `n_jobs` training jobs
+    on `cores` cores
+
+    Parameters
+    ----------
+    n_jobs : int
+    cores : int
+        Core budget, all the available cores by default
+    threads : int
+        Threads of each job; by default, the cores are shared between the jobs
+    which run at the same time
+
+    Returns
+    -------
+    tuple
+        (processes, threads by job)
+    """
+    cores = cores or available_cores()
+    if threads:
+        threads = min(threads, cores)
+        processes = cores // threads
+    else:
+        processes = min(n_jobs, cores)
+        threads = cores // max(processes, 1)
+    return max(min(processes, n_jobs), 1), max(threads, 1)
+
+
+class SharedWindow:
+    """Labelled features of a city, one .npy file by column, memory-mapped
+    read-only by the training jobs
+
+    Parameters
+    ----------
+    directory : str
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, WINDOW_INDEX)) as fobj:
+            index = json.load(fobj)
+        self.features = index['features']
+        self.frequencies = index['frequencies']
+        self.columns = {name: np.load(self._path(name), mmap_mode='r')
+                        for name in ['ts'] + self.features + index['labels']}
+
+    def _path(self, name):
+        return os.path.join(self.directory, name + '.npy')
+
+    @classmethod
+    def create(cls, directory, df, frequencies):
+        """Label the features `df` for the horizons `frequencies`, then write
+        them into `directory`
+
+        Parameters
+        ----------
+        directory : str
+        df : pandas.DataFrame
+            Features of the window, see `features.read_partitions`
+        frequencies : list
+
+        Returns
+        -------
+        SharedWindow
+        """
+        os.makedirs(directory, exist_ok=True)
+        df = add_futures(df, frequencies)
+        labels = [future_column(x) for x in frequencies]
+        columns = [x for x in df.columns if x != "probability" and x not in labels]
+        np.save(os.path.join(directory, 'ts.npy'),
+                df.index.values.astype('datetime64[ns]').astype(np.int64))
+        for name in columns + labels:
+            np.save(os.path.join(directory, name + '.npy'), df[name].values)
+        with open(os.path.join(directory, WINDOW_INDEX), 'w') as fobj:
+            json.dump({'features': columns, 'labels': labels,
+                       'frequencies': list(frequencies), 'rows': len(df)}, fobj)
+        return cls(directory)
+
+    def matrices(self, start, stop, validation, frequency):
+        """Training and validation DMatrix of the window between `start` and
+        `stop`, split like `training.split`
+
+        Returns
+        -------
+        tuple
+            (training DMatrix, validation DMatrix)
+        """
+        ts = self.columns['ts']
+        label = self.columns[future_column(frequency)]
+        validation = pd.Timestamp(validation)
+        period = training.period(frequency)
+        window = ((ts >= pd.Timestamp(start).value) & (ts < pd.Timestamp(stop).value)
+                  & ~np.isnan(label))
+        stop_validation = validation + training.VALIDATION_PERIODS * period
+        sets = []
+        for mask in (window & (ts <= (validation - period).value),
+                     window & (ts >= validation.value) & (ts <= stop_validation.value)):
+            rows = np.flatnonzero(mask)
+            X = pd.DataFrame({name: self.columns[name][rows] for name in self.features})
+            sets.append(xgb.DMatrix(X, label=label[rows]))
+        return tuple(sets)
+
+
+def train_job(directory, job, params, num_round):
+    """Train and save the model of `job` on the shared window of `directory`;
+    run in a worker process
+
+    Returns
+    -------
+    tuple
+        (metrics on the validation set, number of boosting rounds)
+    """
+    window = SharedWindow(directory)
+    xg_train, xg_test = window.matrices(job.start, job.stop, job.validation, job.frequency)
+    if not xg_train.num_row():
+        raise Exception("There is not any training data for {}.".format(job))
+    logger.info("train %s on %d rows with %d threads", os.path.basename(job.path),
+                xg_train.num_row(), params['nthread'])
+    booster = fit_matrices(xg_train, xg_test, params, num_round)[0]
+    os.makedirs(os.path.dirname(job.path), exist_ok=True)
+    booster.save_model(job.path)
+    return training.evaluate(booster, xg_test), booster.num_boosted_rounds()
+
+
+def share_window(city, paths, frequencies, directory):
+    """Read the feature partitions `paths` of `city` once and write them as a
+    `SharedWindow` in `directory`
+    """
+    df = features.read_partitions(paths)
+    if df.empty:
+        raise Exception("There is not any feature of '{}' to process. "
+                        "Please check the dates.".format(city))
+    window = SharedWindow.create(os.path.join(directory, city), df, frequencies)
+    logger.info("share %d rows of '%s', peak RSS %.1f MiB", len(df), city,
+                features.peak_rss() / 2**20)
+    return window
+
+
+def collect(results):
+    """Write the metadata of the trained models and register them; the model
+    with the lowest validation error of each city and frequency is activated
+
+    Parameters
+    ----------
+    results : list
+        (Job, metrics, rounds)
+
+    Returns
+    -------
+    list
+        Metadata of the models, with their path
+    """
+    best = {}
+    for job, metrics, _ in results:
+        key = (job.city, job.frequency)
+        rmse = np.inf if metrics['rmse'] is None else metrics['rmse']
+        if key not in best or rmse < best[key][0]:
+            best[key] = (rmse, job.path)
+    models = []
+    for job, metrics, rounds in results:
+        promoted = best[(job.city, job.frequency)][1] == job.path
+        info = dict(city=job.city, start=job.start, stop=job.stop,
+                    validation=pd.Timestamp(job.validation).isoformat(),
+                    frequency=job.frequency, metrics=metrics, rounds=rounds,
+                    parent=None, promoted=promoted)
+        training.write_metadata(job.path, **info)
+        registry.ModelRegistry(os.path.dirname(job.path)).register(
+            job.path, info, activate=promoted)
+        models.append(dict(info, path=job.path))
+    return models
+
+
+def run(jobs, windows, cores=None, threads=None, params=None, num_round=None,
+        workdir=None):
+    """Train the models of `jobs` in parallel and register them
+
+    Parameters
+    ----------
+    jobs : list
+        Training jobs, see `Job`
+    windows : dict
+        City -> feature partitions of its widest window, sorted by day
+    cores : int
+        Core budget, the 'nthread' training option by default (0 for all the
+    available cores)
+    threads : int
+        Threads by job, the 'job_threads' training option by default (0 to
+    share the cores between the jobs)
+    params : dict
+        XGBoost parameters, see `training.default_params`
+    num_round : int
+    workdir : str
+        Parent directory of the shared windows, the 'cache_dir' training
+    option by default; they are written into a temporary directory of it,
+    removed at the end
+
+    Returns
+    -------
+    list
+        Metadata of the trained models, see `collect`
+    """
+    options = training.settings()
+    processes, nthread = core_budget(len(jobs), cores or options['nthread'] or None,
+                                     threads or options['job_threads'] or None)
+    params = dict(params or training.default_params(options), nthread=nthread)
+    num_round = num_round or options['num_round']
+    logger.info("train %d models in %d processes of %d threads", len(jobs), processes,
+                nthread)
+    workdir = workdir or options['cache_dir']
+    os.makedirs(workdir, exist_ok=True)
+    # only this directory is removed, not the other content of `workdir`
+    workdir = tempfile.mkdtemp(prefix='windows-', dir=workdir)
+    context = multiprocessing.get_context('spawn')
+    results, failures = [], []
+    try:
+        with ProcessPoolExecutor(processes, mp_context=context) as pool:
+            futures = {}
+            for city, paths in windows.items():
+                city_jobs = [x for x in jobs if x.city == city]
+                if not city_jobs:
+                    continue
+                frequencies = sorted({x.frequency for x in city_jobs})
+                # the next city is read while the jobs of this one are trained
+                window = share_window(city, paths, frequencies, workdir)
+                city_jobs.sort(key=lambda x: pd.Timestamp(x.stop) - pd.Timestamp(x.start),
+                               reverse=True)
+                for job in city_jobs:
+                    future = pool.submit(train_job, window.directory, job, params, num_round)
+                    futures[future] = job
+            for future in as_completed(futures):
+                job = futures[future]
+                try:
+                    results.append((job,) + future.result())
+                except Exception as exc:
+                    logger.error("training of %s failed: %s", job, exc)
+                    failures.append(job)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    models = collect(results)
+    if failures:
+        raise Exception("{} training jobs failed: {}".format(len(failures), failures))
+    return models
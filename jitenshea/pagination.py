@@ -0,0 +1,65 @@
+# coding: utf-8
+
+"""Opaque cursors of the paginated listings
+
+A cursor holds the key of the last row of a page, e.g. the station id or the
+(value, id) pair for a listing ordered by value. The next page starts right
+after this key (keyset pagination): its cost is an index range scan whatever
+the page number, and the page boundaries do not move when rows are added
+before the cursor.
+"""
+
+import json
+import base64
+import binascii
+
+
+class InvalidCursor(ValueError):
+    """The cursor was not issued by this listing
+    """
+
+
+def encode_cursor(kind, *key):
+    """Opaque cursor of the listing `kind` after the row `key`
+
+    >>> encode_cursor('station', '1024')
+    'WyJzdGF0aW9uIiwgWyIxMDI0Il1d'
+    """
+    data = json.dumps([kind, key]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor, kind):
+    """Key of the row encoded by `cursor`
+
+    Raises
+    ------
+    InvalidCursor
+        The cursor cannot be decoded or belongs to another listing
+    """
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        cursor_kind, key = json.loads(base64.urlsafe_b64decode(cursor + padding).decode('utf-8'))
+    except (binascii.Error, UnicodeDecodeError, TypeError, ValueError):
+        raise InvalidCursor("Invalid cursor '{}'".format(cursor))
+    if cursor_kind != kind:
+        raise InvalidCursor("Cursor of '{}' instead of '{}'".format(cursor_kind, kind))
+    return tuple(key)
+
+
+def next_cursor(kind, rows, limit, key):
+    """Cursor of the page after `rows`, None on the last page
+
+    Parameters
+    ----------
+    kind : str
+    rows : list
+        Rows of the current page
+    limit : int
+        Size of the page, None for no limit
+    key : callable
+        row -> key tuple
+    """
+    if not rows or limit is None or len(rows) < limit:
+        return None
+    return encode_cursor(kind, *key(rows[-1]))
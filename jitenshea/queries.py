@@ -0,0 +1,527 @@
+# coding: utf-8
+
+"""Registry of the SQL queries of the Web API controller
+
+Each query is written once with bound parameters (`:name`), including the
+limits and the lists of ids (`= ANY(:ids)`). The SQLAlchemy `text()`
+construct is built once by city since the city is the schema name.
+
+With the 'prepared_statements' option of the [database] section, the queries
+are executed as server-side prepared statements: each pooled connection
+prepares a query the first time it executes it, and the following
+executions skip the parsing and the planning of the statement.
+"""
+
+import re
+from functools import lru_cache
+from collections import namedtuple
+
+import daiquiri
+
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+from jitenshea import config, iodb
+from jitenshea.iodb import db
+
+
+logger = daiquiri.getLogger(__name__)
+
+CITIES = ('bordeaux', 'lyon')
+
+# sql: statement with a {city} schema and :name bound parameters
+# params: list of (name, PostgreSQL type), used to prepare the statement
+# fresh: the query needs the latest data, see `iodb.db`
+Query = namedtuple('Query', ['name', 'sql', 'params', 'fresh'])
+
+QUERIES = {}
+
+_BIND = re.compile(r"(?<![:\w]):(\w+)")
+
+
+def register(name, sql, params, fresh=False):
+    """Register a query
+
+    Parameters
+    ----------
+    name : str
+    sql : str
+        Statement with a '{city}' schema and ':name' bound parameters
+    params : list of tuples
+        (name, PostgreSQL type) of each bound parameter
+    fresh : bool
+        The query reads the latest data: it is not sent to a lagging replica
+    """
+    names = set(_BIND.findall(sql))
+    declared = set(x for x, _ in params)
+    if names != declared:
+        raise ValueError("Query '{}': parameters {} are declared but {} are used"
+                         .format(name, sorted(declared), sorted(names)))
+    QUERIES[name] = Query(name, sql, params, fresh)
+
+
+# FeatureCollection of the rows of a query, as a JSON text, with the number of
+# rows and the last id (for the page cursors)
+_GEOJSON = """SELECT json_build_object(
+        'type', 'FeatureCollection',
+        'features', coalesce(json_agg(json_build_object(
+          'type', 'Feature',
+          'geometry', st_asgeojson(st_setsrid(st_makepoint(F.x, F.y), 4326))::json,
+          'properties', json_build_object({properties})) ORDER BY F.id), '[]'))::text AS geojson
+      ,count(*) AS count
+      ,max(F.id) AS last_id
+    FROM (
+    {sql}) AS F"""
+
+
+def register_geojson(name, source, properties):
+    """Register the GeoJSON variant of the query `source`, built by PostGIS,
+    with the same parameters
+
+    Parameters
+    ----------
+    name : str
+    source : str
+        Name of a registered query with the columns 'id', 'x' and 'y'
+    properties : list
+        Columns of `source` which are the properties of the features; a
+        timestamp column is formatted as by the Web API
+    """
+    query = QUERIES[source]
+    properties = ', '.join(
+        "'{0}', to_char(F.{0}, 'YYYY-MM-DD\"T\"HH24:MI:SS')".format(x)
+        if x == 'timestamp' else "'{0}', F.{0}".format(x)
+        for x in properties)
+    register(name, _GEOJSON.format(properties=properties, sql=query.sql),
+             query.params, query.fresh)
+
+
+def _check_city(city):
+    if city not in CITIES:
+        raise ValueError("City '{}' not supported.".format(city))
+
+
+@lru_cache(maxsize=None)
+def statement(name, city):
+    """SQLAlchemy text construct of the query `name` for `city`
+    """
+    _check_city(city)
+    return text(QUERIES[name].sql.format(city=city))
+
+
+@lru_cache(maxsize=None)
+def prepare_statement(name, city):
+    """PREPARE statement of the query `name` for `city`
+
+    Returns
+    -------
+    tuple
+        (prepared statement name, PREPARE statement, EXECUTE statement)
+    """
+    _check_city(city)
+    query = QUERIES[name]
+    position = {param: i for i, (param, _) in enumerate(query.params, start=1)}
+    sql = _BIND.sub(lambda m: '${}'.format(position[m.group(1)]),
+                    query.sql.format(city=city))
+    prepared_name = 'jitenshea_{}_{}'.format(name, city)
+    prepare = 'PREPARE {} AS {}'.format(prepared_name, sql)
+    execute = 'EXECUTE {}'.format(prepared_name)
+    if query.params:
+        # PostgreSQL does not accept empty parentheses
+        types = ', '.join(pgtype for _, pgtype in query.params)
+        prepare = 'PREPARE {} ({}) AS {}'.format(prepared_name, types, sql)
+        args = ', '.join('%({})s'.format(param) for param, _ in query.params)
+        execute = 'EXECUTE {}({})'.format(prepared_name, args)
+    # the statistics and the plans of the slow statements use the source query
+    iodb.PREPARED_STATEMENTS[prepared_name] = _BIND.sub(
+        lambda m: '%({})s'.format(m.group(1)), query.sql.format(city=city).replace('%', '%%'))
+    return prepared_name, prepare, execute
+
+
+def use_prepared_statements():
+    if config is None or not config.has_section('database'):
+        return False
+    return config['database'].getboolean('prepared_statements', fallback=False)
+
+
+class Rows(list):
+    """Fetched rows with the `keys` of the result set
+    """
+    def __init__(self, keys, rows):
+        super().__init__(rows)
+        self._keys = list(keys)
+
+    def keys(self):
+        return self._keys
+
+    def dicts(self):
+        """List of dicts, one by row
+        """
+        return [dict(zip(self._keys, row)) for row in self]
+
+
+def execute(name, city, eng=None, **params):
+    """Execute the query `name` for `city` with its bound parameters
+
+    Parameters
+    ----------
+    name : str
+        Name of a registered query
+    city : str
+    eng : sqlalchemy Engine or Connection
+        A read replica of the city by default, see `iodb.db`
+    params : dict
+        Bound parameters, e.g. `ids` as a list
+
+    Returns
+    -------
+    Rows
+    """
+    if eng is None:
+        eng = db('read', city, fresh=QUERIES[name].fresh)
+    if use_prepared_statements():
+        return _execute_prepared(eng, name, city, params)
+    rset = eng.execute(statement(name, city), **params)
+    return Rows(rset.keys(), rset.fetchall())
+
+
+def _execute_prepared(eng, name, city, params):
+    prepared_name, prepare, execute_sql = prepare_statement(name, city)
+    if isinstance(eng, Engine):
+        with eng.connect() as conn:
+            return _execute_prepared(conn, name, city, params)
+    # the prepared statements live as long as the (pooled) DBAPI connection
+    prepared = eng.connection.info.setdefault('prepared_statements', set())
+    if prepared_name not in prepared:
+        logger.debug("prepare the statement '%s'", prepared_name)
+        eng.exec_driver_sql(prepare)
+        prepared.add(prepared_name)
+    rset = eng.exec_driver_sql(execute_sql, params)
+    return Rows(rset.keys(), rset.fetchall())
+
+
+register('stations', """SELECT id
+      ,name
+      ,address
+      ,city
+      ,nb_stations as nb_stands
+      ,st_x(geom) as x
+      ,st_y(geom) as y
+    FROM {city}.station
+    WHERE id > :after
+    ORDER BY id
+    LIMIT :limit""", [('after', 'varchar'), ('limit', 'bigint')])
+register_geojson('stations_geojson', 'stations',
+                 ['id', 'name', 'address', 'city', 'nb_stands'])
+
+register('specific_stations', """SELECT id
+      ,name
+      ,address
+      ,city
+      ,nb_stations as nb_stands
+      ,st_x(geom) as x
+      ,st_y(geom) as y
+    FROM {city}.station
+    WHERE id = ANY(:ids)""", [('ids', 'varchar[]')])
+
+register('station_ids', """SELECT id FROM {city}.station""", [])
+
+register('daily', """SELECT id
+       ,number AS value
+       ,date
+       ,name
+    FROM {city}.daily_transaction AS X
+    LEFT JOIN {city}.station AS Y using(id)
+    WHERE id = ANY(:ids) AND date >= :start AND date <= :stop
+    ORDER BY id,date""", [('ids', 'varchar[]'), ('start', 'date'), ('stop', 'date')])
+
+# keyset pagination: a page starts after the key (id or (value, id)) of the
+# last station of the previous page, with the index on
+# daily_transaction(date, number DESC, id)
+_DAILY_STATIONS = """WITH station AS (
+        SELECT id
+          ,number
+        FROM {{city}}.daily_transaction
+        WHERE date = :order_reference_date AND {keyset}
+        ORDER BY {order_by}
+        LIMIT :limit
+        )
+    SELECT S.id
+      ,D.number AS value
+      ,D.date
+      ,Y.name
+    FROM station AS S
+    LEFT JOIN {{city}}.daily_transaction AS D ON (S.id=D.id)
+    LEFT JOIN {{city}}.station AS Y ON S.id=Y.id
+    WHERE D.date >= :start AND D.date <= :stop
+    ORDER BY {outer_order_by},D.date"""
+register('daily_stations_by_station', _DAILY_STATIONS.format(
+    keyset='id > :after_id', order_by='id', outer_order_by='S.id'),
+         [('order_reference_date', 'date'), ('after_id', 'varchar'),
+          ('limit', 'bigint'), ('start', 'date'), ('stop', 'date')])
+register('daily_stations_by_value', _DAILY_STATIONS.format(
+    keyset='number <= :after_value AND (number < :after_value OR id > :after_id)',
+    order_by='number DESC, id', outer_order_by='S.number DESC, S.id'),
+         [('order_reference_date', 'date'), ('after_value', 'float8'),
+          ('after_id', 'varchar'), ('limit', 'bigint'), ('start', 'date'),
+          ('stop', 'date')])
+
+register('timeseries', """SELECT T.id
+      ,T.timestamp
+      ,T.available_stands
+      ,T.available_bikes
+      ,S.name as name
+      ,S.nb_stations as nb_stands
+    FROM {city}.timeseries AS T
+    LEFT JOIN {city}.station AS S using(id)
+    WHERE T.id = ANY(:ids) AND T.timestamp >= :start AND T.timestamp < :stop
+    ORDER BY T.id,T.timestamp""",
+         [('ids', 'varchar[]'), ('start', 'timestamp'), ('stop', 'timestamp')])
+
+# bulk exports, streamed with a server-side cursor (see `jitenshea.export`) in
+# the order of the index on timeseries(timestamp)
+_EXPORT = """SELECT id
+      ,timestamp
+      ,available_bikes
+      ,available_stands
+      ,status
+    FROM {{city}}.timeseries
+    WHERE timestamp >= :start AND timestamp < :stop{where}
+    ORDER BY timestamp, id"""
+register('export_timeseries', _EXPORT.format(where=''),
+         [('start', 'timestamp'), ('stop', 'timestamp')])
+register('export_station_timeseries', _EXPORT.format(where=' AND id = ANY(:ids)'),
+         [('start', 'timestamp'), ('stop', 'timestamp'), ('ids', 'varchar[]')])
+
+# availability of the prediction model, streamed by chunks into a cube (see
+# `jitenshea.features.extract`): compact types, neither DISTINCT nor ORDER BY
+register('training_availability', """SELECT id::int AS station_id
+      ,(extract(epoch FROM timestamp) * 1000000)::bigint AS ts
+      ,available_bikes::smallint AS nb_bikes
+      ,available_stands::smallint AS nb_stands
+    FROM {city}.timeseries
+    WHERE timestamp >= :start AND timestamp < :stop
+      AND (available_bikes > 0 OR available_stands > 0)
+      AND status = 'open'""",
+         [('start', 'timestamp'), ('stop', 'timestamp')])
+
+# the latest predictions are looked up station by station, with the index on
+# prediction(station_id, frequency, timestamp)
+register('prediction', """SELECT P.station_id AS id
+     , P.timestamp AS timestamp
+     , P.nb_bikes AS nb_bikes
+     , S.nb_stations as nb_stands
+     , S.name AS name
+     FROM {city}.station AS S
+     CROSS JOIN LATERAL (
+       SELECT station_id, timestamp, nb_bikes
+       FROM {city}.prediction AS T
+       WHERE T.station_id = S.id
+         AND T.frequency = :freq
+         AND T.timestamp >= :start AND T.timestamp < :stop
+       ORDER BY T.timestamp DESC
+       LIMIT :values_num
+     ) AS P
+     WHERE S.id = ANY(:ids)
+     ORDER BY id,timestamp""",
+         [('ids', 'varchar[]'), ('freq', 'varchar'), ('start', 'timestamp'),
+          ('stop', 'timestamp'), ('values_num', 'bigint')])
+
+# the current value of each station is its latest availability of the window,
+# looked up with the index on timeseries(id, timestamp)
+register('current_values', """SELECT S.id
+     , C.timestamp
+     , C.nb_bikes
+     , S.nb_stations as nb_stands
+     , S.name
+     FROM {city}.station AS S
+     CROSS JOIN LATERAL (
+       SELECT T.timestamp
+         , T.available_bikes as nb_bikes
+       FROM {city}.timeseries AS T
+       WHERE T.id = S.id
+         AND T.timestamp >= :start AND T.timestamp < :stop
+       ORDER BY T.timestamp DESC
+       LIMIT 1
+     ) AS C
+     WHERE S.id = ANY(:ids)
+     ORDER BY S.id""",
+         [('ids', 'varchar[]'), ('start', 'timestamp'), ('stop', 'timestamp')])
+
+# the stations are paged by id and their latest availability is looked up one
+# by one, with the index on timeseries(id, timestamp)
+register('latest_availability', """SELECT S.id
+      ,A.timestamp
+      ,A.nb_bikes
+      ,S.name
+      ,S.nb_stations as nb_stands
+      ,st_x(S.geom) as x
+      ,st_y(S.geom) as y
+    FROM {city}.station AS S
+    CROSS JOIN LATERAL (
+      SELECT timestamp
+        ,available_bikes as nb_bikes
+      FROM {city}.timeseries AS T
+      WHERE T.id = S.id AND T.timestamp >= :min_date
+      ORDER BY T.timestamp DESC
+      LIMIT 1
+    ) AS A
+    WHERE S.id > :after
+    ORDER BY S.id
+    LIMIT :limit""", [('min_date', 'timestamp'), ('after', 'varchar'), ('limit', 'bigint')],
+         fresh=True)
+register_geojson('latest_availability_geojson', 'latest_availability',
+                 ['id', 'name', 'timestamp', 'nb_bikes', 'nb_stands'])
+
+# compact snapshot of the availability sent by the live stream
+register('availability_snapshot', """SELECT DISTINCT ON (id) id
+      ,timestamp
+      ,available_bikes AS nb_bikes
+      ,available_stands AS nb_stands
+    FROM {city}.timeseries
+    WHERE timestamp >= :min_date
+    ORDER BY id, timestamp DESC""", [('min_date', 'timestamp')], fresh=True)
+
+register('latest_predictions', """with latest as (
+      select station_id as id
+        ,timestamp
+        ,nb_bikes
+        ,rank() over (partition by station_id order by timestamp desc) as rank
+      from {city}.prediction
+      where frequency=:freq
+         and timestamp >= :min_date
+    )
+    select P.id
+      ,P.timestamp
+      ,P.nb_bikes
+      ,S.name
+      ,S.nb_stations as nb_stands
+      ,st_x(S.geom) as x
+      ,st_y(S.geom) as y
+    from latest as P
+    join {city}.station as S using(id)
+    where P.rank=1
+    order by id
+    limit :limit""", [('freq', 'varchar'), ('min_date', 'timestamp'), ('limit', 'bigint')],
+         fresh=True)
+
+# used when the in-memory spatial index is not built yet: the latest
+# availability is looked up station by station, with the index on
+# timeseries(id, timestamp)
+_SPATIAL = """SELECT S.id
+      ,S.name
+      ,A.nb_bikes
+      ,S.nb_stations as nb_stands
+      ,A.timestamp
+      ,st_x(S.geom) as x
+      ,st_y(S.geom) as y{distance}
+    FROM {{city}}.station AS S
+    CROSS JOIN LATERAL (
+      SELECT timestamp
+        ,available_bikes as nb_bikes
+      FROM {{city}}.timeseries AS T
+      WHERE T.id = S.id AND T.timestamp >= :min_date
+      ORDER BY T.timestamp DESC
+      LIMIT 1
+    ) AS A
+    WHERE A.nb_bikes >= :min_bikes{where}
+    ORDER BY {order_by}"""
+register('nearest_stations', _SPATIAL.format(
+    distance="""
+      ,st_distance(S.geom::geography,
+                   st_setsrid(st_makepoint(:lon, :lat), 4326)::geography) as distance""",
+    where='',
+    order_by='S.geom <-> st_setsrid(st_makepoint(:lon, :lat), 4326)\n    LIMIT :n'),
+         [('lon', 'float8'), ('lat', 'float8'), ('min_date', 'timestamp'),
+          ('min_bikes', 'int'), ('n', 'bigint')], fresh=True)
+register('stations_within', _SPATIAL.format(
+    distance='',
+    where='\n      AND S.geom && st_makeenvelope(:xmin, :ymin, :xmax, :ymax, 4326)',
+    order_by='S.id'),
+         [('min_date', 'timestamp'), ('min_bikes', 'int'), ('xmin', 'float8'),
+          ('ymin', 'float8'), ('xmax', 'float8'), ('ymax', 'float8')], fresh=True)
+
+# vector tile of the stations: the stations are selected in the lon/lat bounds
+# of the tile with the index on station(geom), then clipped and encoded
+# relative to the Web Mercator envelope of the tile
+register('station_tile', """WITH tile AS (
+      SELECT S.id
+        ,S.name
+        ,S.nb_stations AS nb_stands
+        ,A.nb_bikes
+        ,to_char(A.timestamp, 'YYYY-MM-DD"T"HH24:MI:SS') AS timestamp
+        ,C.cluster_id
+        ,st_asmvtgeom(st_transform(S.geom, 3857),
+                      st_makeenvelope(:xmin, :ymin, :xmax, :ymax, 3857)::box2d,
+                      :extent, :buffer, true) AS geom
+      FROM {city}.station AS S
+      LEFT JOIN LATERAL (
+        SELECT timestamp
+          ,available_bikes AS nb_bikes
+        FROM {city}.timeseries AS T
+        WHERE T.id = S.id AND T.timestamp >= :min_date
+        ORDER BY T.timestamp DESC
+        LIMIT 1
+      ) AS A ON true
+      LEFT JOIN LATERAL (
+        SELECT cluster_id
+        FROM {city}.clustering AS K
+        WHERE K.station_id = S.id
+        ORDER BY K.stop DESC
+        LIMIT 1
+      ) AS C ON true
+      WHERE S.geom && st_makeenvelope(:lon_min, :lat_min, :lon_max, :lat_max, 4326)
+    )
+    SELECT st_asmvt(tile, 'stations', :extent, 'geom')
+    FROM tile
+    WHERE geom IS NOT NULL""",
+         [('xmin', 'float8'), ('ymin', 'float8'), ('xmax', 'float8'), ('ymax', 'float8'),
+          ('extent', 'int'), ('buffer', 'int'), ('min_date', 'timestamp'),
+          ('lon_min', 'float8'), ('lat_min', 'float8'), ('lon_max', 'float8'),
+          ('lat_max', 'float8')])
+
+# heatmap frames: range scans of the primary key (resolution, bucket, q, r) of
+# the rollup table, see `tasks.city.HexRollupToDB`
+register('hex_rollup', """SELECT bucket
+      ,q
+      ,r
+      ,nb_bikes
+      ,nb_stands
+      ,transactions
+    FROM {city}.hex_rollup
+    WHERE resolution = :resolution AND bucket >= :start AND bucket <= :stop
+    ORDER BY bucket, q, r""",
+         [('resolution', 'smallint'), ('start', 'timestamp'), ('stop', 'timestamp')])
+register('hex_rollup_latest', """SELECT max(bucket) AS bucket
+    FROM {city}.hex_rollup
+    WHERE resolution = :resolution""", [('resolution', 'smallint')])
+
+register('station_clusters', """WITH ranked_clusters AS (
+      SELECT cs.station_id AS id
+        ,cs.cluster_id
+        ,cs.start AS start
+        ,cs.stop AS stop
+        ,citystation.name AS name
+        ,citystation.geom AS geom
+        ,rank() OVER (ORDER BY stop DESC) AS rank
+      FROM {city}.clustering AS cs
+      JOIN {city}.station AS citystation
+      ON citystation.id = cs.station_id
+      WHERE cs.station_id = ANY(:ids))
+    SELECT id, cluster_id, start, stop, name
+      ,st_x(geom) as x
+      ,st_y(geom) as y
+    FROM ranked_clusters
+    WHERE rank=1""", [('ids', 'varchar[]')])
+register_geojson('station_clusters_geojson', 'station_clusters',
+                 ['id', 'cluster_id', 'name', 'start', 'stop'])
+
+register('cluster_profiles', """WITH ranked_centroids AS (
+      SELECT *, rank() OVER (ORDER BY stop DESC) AS rank
+      FROM {city}.centroid)
+    SELECT cluster_id
+      ,h00, h01, h02, h03, h04, h05, h06, h07, h08, h09, h10, h11
+      ,h12, h13, h14, h15, h16, h17, h18, h19, h20, h21, h22, h23
+      ,start, stop
+    FROM ranked_centroids
+    WHERE rank=1""", [])
@@ -0,0 +1,192 @@
+# coding: utf-8
+
+"""Registry of the prediction models and in-memory cache of their boosters
+
+The models of a city are files of `<datadir>/<city>/xgboost-model/`. The
+registry of a city is the JSON file `registry.json` of this directory: the
+versions of the models (training window, cutoff, frequency, metrics, parent,
+promotion) and the active model of each prediction frequency. It is written
+by the training tasks, under a file lock, and replaced atomically.
+
+A `ModelCache` keeps the boosters loaded in the process. The active booster of
+a city and frequency is swapped when the registry changes, e.g. when a
+retraining is promoted by another process, so the predictions do not load and
+deserialize the model again.
+"""
+
+import os
+import json
+import fcntl
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+import daiquiri
+
+from jitenshea import config
+from jitenshea.stats import load_model
+
+
+logger = daiquiri.getLogger(__name__)
+
+REGISTRY_FILE = 'registry.json'
+
+
+def model_dir(city, datadir=None):
+    """Directory of the models of `city`
+    """
+    if datadir is None:
+        datadir = config['main']['datadir'] if config is not None else 'datarepo'
+    return os.path.join(datadir, city, 'xgboost-model')
+
+
+class ModelRegistry:
+    """Versions and active models of a city
+
+    Parameters
+    ----------
+    directory : str
+        Directory of the model files, see `model_dir`
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = os.path.join(directory, REGISTRY_FILE)
+
+    def read(self):
+        """Content of the registry: {'versions': {name: info}, 'active':
+        {frequency: name}}
+        """
+        try:
+            with open(self.path) as fobj:
+                return json.load(fobj)
+        except FileNotFoundError:
+            return {'versions': {}, 'active': {}}
+
+    def mtime(self):
+        """Modification time of the registry file, None if there is not any
+        """
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    @contextmanager
+    def _update(self):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            registry = self.read()
+            yield registry
+            tmp = '{}.{}'.format(self.path, os.getpid())
+            with open(tmp, 'w') as fobj:
+                json.dump(registry, fobj, indent=2, sort_keys=True, default=str)
+            os.replace(tmp, self.path)
+
+    def register(self, model_path, info, activate=False):
+        """Record the model file `model_path`, the active one of its frequency
+        if `activate` and if its cutoff is not older than the one of the active
+        model, e.g. not for a backfill
+
+        Parameters
+        ----------
+        model_path : str
+        info : dict
+            Metadata of the model, with at least a 'frequency' and a
+        'validation' cutoff (ISO format)
+        activate : bool
+        """
+        name = os.path.basename(model_path)
+        with self._update() as registry:
+            registry['versions'][name] = dict(info, registered=datetime.now().isoformat())
+            current = registry['versions'].get(registry['active'].get(info['frequency']))
+            if activate and (current is None or current['validation'] <= info['validation']):
+                registry['active'][info['frequency']] = name
+            activate = registry['active'].get(info['frequency']) == name
+        logger.info("register the model '%s' (active: %s)", name, activate)
+
+    def activate(self, name, frequency):
+        """Make the registered model `name` the active one of `frequency`
+        """
+        with self._update() as registry:
+            if name not in registry['versions']:
+                raise KeyError("Unknown model '{}'".format(name))
+            registry['active'][frequency] = name
+
+    def versions(self, frequency=None):
+        """Registered models, of `frequency` if not None, by name
+        """
+        versions = self.read()['versions']
+        return {k: v for k, v in versions.items()
+                if frequency is None or v.get('frequency') == frequency}
+
+    def active(self, frequency):
+        """Path of the active model of `frequency`, None if there is not any
+        """
+        name = self.read()['active'].get(frequency)
+        return None if name is None else os.path.join(self.directory, name)
+
+
+class ModelCache:
+    """Boosters loaded in the process, by model file
+
+    The active booster of a city and frequency is looked up in its registry;
+    it is loaded at the first call, then swapped when the registry changes.
+    """
+    def __init__(self, datadir=None):
+        self.datadir = datadir
+        self._lock = threading.Lock()
+        self._boosters = {}
+        # (city, frequency) -> (registry mtime, model path, booster)
+        self._active = {}
+
+    def registry(self, city):
+        return ModelRegistry(model_dir(city, self.datadir))
+
+    def load(self, path):
+        """Booster of the model file `path`, loaded once
+        """
+        booster = self._boosters.get(path)
+        if booster is None:
+            booster = load_model(path)
+            with self._lock:
+                booster = self._boosters.setdefault(path, booster)
+        return booster
+
+    def active(self, city, frequency):
+        """Path and booster of the active model of `city` and `frequency`
+
+        Returns
+        -------
+        tuple
+            (path, xgboost.Booster), (None, None) without any active model
+        """
+        registry = self.registry(city)
+        mtime = registry.mtime()
+        key = (city, frequency)
+        cached = self._active.get(key)
+        if cached is not None and cached[0] == mtime:
+            return cached[1:]
+        path = registry.active(frequency)
+        booster = None if path is None else self.load(path)
+        self.swap(city, frequency, path, booster, mtime)
+        return path, booster
+
+    def swap(self, city, frequency, path, booster, mtime=None):
+        """Replace the active booster of `city` and `frequency`
+        """
+        with self._lock:
+            previous = self._active.get((city, frequency))
+            self._active[(city, frequency)] = (mtime, path, booster)
+            if previous is not None and previous[1] not in (None, path):
+                # the replaced booster is freed once its readers are done
+                self._boosters.pop(previous[1], None)
+        if previous is None or previous[1] != path:
+            logger.info("active model of '%s' (%s): %s", city, frequency, path)
+
+    def clear(self):
+        with self._lock:
+            self._boosters.clear()
+            self._active.clear()
+
+
+MODELS = ModelCache()
@@ -0,0 +1,210 @@
+# coding: utf-8
+
+"""In-memory spatial index of the bicycle stations
+
+The station coordinates of a city are loaded once into a ball tree (haversine
+metric) joined with the latest bike availability. Nearest-station and
+bounding-box queries are then answered without any database round trip.
+"""
+
+import time
+import threading
+
+import daiquiri
+
+import numpy as np
+
+from sklearn.neighbors import BallTree
+
+
+logger = daiquiri.getLogger(__name__)
+
+EARTH_RADIUS = 6371008.8  # meters
+
+
+class StationIndex:
+    """Spatial index over the stations of a city
+
+    Parameters
+    ----------
+    stations : list of dicts
+        Stations with the keys 'id', 'name', 'nb_stands', 'x' (longitude) and
+    'y' (latitude)
+    """
+    def __init__(self, stations):
+        self.ids = np.array([str(x['id']) for x in stations], dtype=object)
+        self.names = np.array([x['name'] for x in stations], dtype=object)
+        self.nb_stands = np.array([x['nb_stands'] for x in stations])
+        self.lon = np.array([x['x'] for x in stations], dtype=np.float64)
+        self.lat = np.array([x['y'] for x in stations], dtype=np.float64)
+        self.position = {station_id: i for i, station_id in enumerate(self.ids)}
+        self.tree = BallTree(np.radians(np.c_[self.lat, self.lon]),
+                             metric='haversine')
+        # stations sorted by longitude for the bounding box queries
+        self._lon_order = np.argsort(self.lon, kind='stable')
+        self._sorted_lon = self.lon[self._lon_order]
+        # -1 means no recent availability
+        self.nb_bikes = np.full(len(self.ids), -1, dtype=np.int32)
+        self.timestamps = np.full(len(self.ids), None, dtype=object)
+        self.date = None
+
+    def __len__(self):
+        return len(self.ids)
+
+    def set_availability(self, availability, date=None):
+        """Join the latest availability
+
+        Parameters
+        ----------
+        availability : list of dicts
+            Latest availability with the keys 'id', 'nb_bikes' and 'timestamp'
+        date : datetime
+            Date of the latest availability
+        """
+        nb_bikes = np.full(len(self.ids), -1, dtype=np.int32)
+        timestamps = np.full(len(self.ids), None, dtype=object)
+        for row in availability:
+            i = self.position.get(str(row['id']))
+            if i is None:
+                continue
+            nb_bikes[i] = row['nb_bikes']
+            timestamps[i] = row['timestamp']
+        # swap the arrays at once for the concurrent readers
+        self.nb_bikes, self.timestamps, self.date = nb_bikes, timestamps, date
+
+    def _records(self, positions, distances=None):
+        nb_bikes, timestamps = self.nb_bikes, self.timestamps
+        result = []
+        for k, i in enumerate(positions):
+            record = {'id': self.ids[i],
+                      'name': self.names[i],
+                      'nb_bikes': int(nb_bikes[i]),
+                      'nb_stands': int(self.nb_stands[i]),
+                      'timestamp': timestamps[i],
+                      'x': float(self.lon[i]),
+                      'y': float(self.lat[i])}
+            if distances is not None:
+                record['distance'] = float(distances[k])
+            result.append(record)
+        return result
+
+    def nearest(self, lon, lat, n=5, min_bikes=0):
+        """Nearest stations with at least `min_bikes` available bikes
+
+        Parameters
+        ----------
+        lon : float
+        lat : float
+        n : int
+            Number of stations
+        min_bikes : int
+
+        Returns
+        -------
+        list of dicts
+            Stations sorted by distance (in meters)
+        """
+        size = len(self.ids)
+        if size == 0 or n <= 0:
+            return []
+        nb_bikes = self.nb_bikes
+        point = np.radians([[lat, lon]])
+        k = min(n, size)
+        # widen the search until enough stations have the required bikes
+        while True:
+            distances, positions = self.tree.query(point, k=k)
+            distances, positions = distances[0], positions[0]
+            mask = nb_bikes[positions] >= min_bikes
+            if mask.sum() >= n or k == size:
+                break
+            k = min(2 * k, size)
+        positions = positions[mask][:n]
+        distances = distances[mask][:n] * EARTH_RADIUS
+        return self._records(positions, distances)
+
+    def within(self, xmin, ymin, xmax, ymax, min_bikes=0):
+        """Stations within a bounding box
+
+        Parameters
+        ----------
+        xmin, ymin, xmax, ymax : float
+            Longitude and latitude bounds
+        min_bikes : int
+
+        Returns
+        -------
+        list of dicts
+            Stations sorted by id
+        """
+        start = np.searchsorted(self._sorted_lon, xmin, side='left')
+        stop = np.searchsorted(self._sorted_lon, xmax, side='right')
+        positions = self._lon_order[start:stop]
+        lat = self.lat[positions]
+        mask = (lat >= ymin) & (lat <= ymax) & (self.nb_bikes[positions] >= min_bikes)
+        positions = np.sort(positions[mask])
+        return self._records(positions)
+
+
+class IndexCache:
+    """Station indexes by city, built and refreshed in background threads
+
+    Parameters
+    ----------
+    load_stations : callable
+        city -> list of stations
+    load_availability : callable
+        city -> (latest availability, date)
+    availability_ttl : int
+        Number of seconds after which the availability is refreshed
+    """
+    def __init__(self, load_stations, load_availability, availability_ttl=60):
+        self.load_stations = load_stations
+        self.load_availability = load_availability
+        self.availability_ttl = availability_ttl
+        self._lock = threading.Lock()
+        self._indexes = {}
+        self._refreshed_at = {}
+        self._pending = set()
+
+    def get(self, city):
+        """Station index of `city`, or None if it is not built yet (cold start)
+
+        The build, or the refresh of a stale availability, is triggered in the
+        background.
+        """
+        index = self._indexes.get(city)
+        stale = time.monotonic() - self._refreshed_at.get(city, 0) > self.availability_ttl
+        if index is None or stale:
+            self._schedule(city, build=index is None)
+        return index
+
+    def _schedule(self, city, build):
+        with self._lock:
+            if city in self._pending:
+                return
+            self._pending.add(city)
+        thread = threading.Thread(target=self._update, args=(city, build),
+                                  name='spatial-index-{}'.format(city), daemon=True)
+        thread.start()
+
+    def _update(self, city, build):
+        try:
+            index = self._indexes.get(city)
+            if build or index is None:
+                logger.info("build the spatial index of the '%s' stations", city)
+                index = StationIndex(self.load_stations(city))
+            availability, date = self.load_availability(city)
+            index.set_availability(availability, date)
+            self._indexes[city] = index
+            self._refreshed_at[city] = time.monotonic()
+        except Exception:
+            logger.exception("cannot update the spatial index of '%s'", city)
+        finally:
+            with self._lock:
+                self._pending.discard(city)
+
+    def invalidate(self, city):
+        """Rebuild the index of `city` on the next call, e.g. new stations
+        """
+        self._indexes.pop(city, None)
+        self._refreshed_at.pop(city, None)
@@ -0,0 +1,81 @@
+# coding: utf-8
+
+"""Command line to display the SQL statements statistics of a running Web
+application
+
+    > python -m jitenshea.sqlstats --url http://localhost:7987 --sort p95
+    > python -m jitenshea.sqlstats --slow
+    > python -m jitenshea.sqlstats --explain 12
+
+The admin endpoints must be enabled in the configuration file. The token of
+the [admin] section is read from the JITENSHEA_ADMIN_TOKEN environment
+variable, or given with --token; without any token, the application only
+answers to the loopback interface.
+
+The statistics are kept in memory by each process of the Web application: with
+several workers (e.g. gunicorn), each request reads the statistics of the
+worker which answers it, and a slow statement can only be explained by the
+worker which recorded it.
+"""
+
+import os
+import argparse
+
+import requests
+
+
+def fetch(url, path, token=None, **params):
+    headers = {'Authorization': 'Bearer ' + token} if token else {}
+    resp = requests.get(url.rstrip('/') + '/api/admin/' + path, params=params,
+                        headers=headers)
+    resp.raise_for_status()
+    return resp.json()
+
+
+def print_stats(stats):
+    header = "{:<12} {:>8} {:>10} {:>9} {:>9} {:>9} {:>10}  {}"
+    print(header.format('id', 'calls', 'total(s)', 'mean(ms)', 'p95(ms)',
+                        'max(ms)', 'rows', 'query'))
+    for row in stats:
+        print(header.format(row['id'], row['calls'],
+                            '{:.3f}'.format(row['total']),
+                            '{:.1f}'.format(1000 * row['mean']),
+                            '{:.1f}'.format(1000 * row['p95']),
+                            '{:.1f}'.format(1000 * row['max']),
+                            row['rows'], row['fingerprint'][:80]))
+
+
+def print_slow(slow):
+    for row in slow:
+        print("#{id} at {at} ({duration:.3f}s, {rows} rows) query {query_id}".format(**row))
+        print("  " + " ".join(row['statement'].split()))
+        print("  parameters: {}".format(row['parameters']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--url', default='http://localhost:7987',
+                        help="URL of the Web application")
+    parser.add_argument('--token', default=os.environ.get('JITENSHEA_ADMIN_TOKEN'),
+                        help="admin token, JITENSHEA_ADMIN_TOKEN by default")
+    parser.add_argument('--sort', default='total',
+                        choices=('total', 'calls', 'mean', 'p95', 'max', 'rows'))
+    parser.add_argument('--limit', type=int, default=20)
+    parser.add_argument('--slow', action='store_true',
+                        help="display the latest slow statements")
+    parser.add_argument('--explain', type=int, metavar='ID',
+                        help="plan of a slow statement, with EXPLAIN (ANALYZE, BUFFERS)")
+    args = parser.parse_args(argv)
+    if args.explain is not None:
+        path = 'queries/slow/{}/explain'.format(args.explain)
+        print("\n".join(fetch(args.url, path, args.token)['plan']))
+        return
+    content = fetch(args.url, 'queries', args.token, sort=args.sort, limit=args.limit)
+    if args.slow:
+        print_slow(content['slow'])
+    else:
+        print_stats(content['data'])
+
+
+if __name__ == '__main__':
+    main()
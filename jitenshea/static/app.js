@@ -17,6 +17,20 @@ function getYesterday() {
   return yesterday.toISOString().substring(0, 10);
 };
 
+// Live availability of the stations of a city, pushed by the server (SSE).
+// 'callback' is called with the list of [id, nb_bikes, nb_stands] of the
+// changed stations (all the stations for a 'snapshot' event) and the date.
+function availabilityStream(city, callback) {
+  var source = new EventSource(API_URL + "/" + city + "/stream");
+  var handler = function(event) {
+    var content = JSON.parse(event.data);
+    callback(content.stations, content.date);
+  };
+  source.addEventListener("snapshot", handler);
+  source.addEventListener("delta", handler);
+  return source;
+};
+
 // feather icons https://github.com/feathericons/feather
 $(document).ready(function() {
   feather.replace();
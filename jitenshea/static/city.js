@@ -35,17 +35,25 @@ $(document).ready(function() {
 } );
 
 
+function markerColor(properties) {
+  return d3.interpolateRdYlGn(properties.nb_bikes / properties.nb_stands);
+};
+
+function markerPopup(properties) {
+  return "<ul><li><b>ID</b>: " + properties.id
+    + "</li><li><b>Name</b>: " + properties.name
+    + "</li><li><b>Stands</b>: " + properties.nb_stands
+    + "</li><li><b>Bikes</b>: " + properties.nb_bikes
+    + "</li><li><b>At</b> " + properties.timestamp + "</li></ul>";
+};
+
 function pointToLayer(data, coords) {
   return L.circleMarker(coords, {
     radius: 5,
     stroke: true,
-    color: d3.interpolateRdYlGn(data.properties.nb_bikes / data.properties.nb_stands)
+    color: markerColor(data.properties)
   })
-    .bindPopup("<ul><li><b>ID</b>: " + data.properties.id
-               + "</li><li><b>Name</b>: " + data.properties.name
-               + "</li><li><b>Stands</b>: " + data.properties.nb_stands
-               + "</li><li><b>Bikes</b>: " + data.properties.nb_bikes
-               + "</li><li><b>At</b> " + data.properties.timestamp + "</li></ul>")
+    .bindPopup(markerPopup(data.properties))
     .on('mouseover', function(e) {
       this.openPopup();
     })
@@ -75,9 +83,31 @@ $(document).ready(function() {
     }
   }).addTo(map);
 
-  var currentLayer = L.geoJSON(null, {
-    pointToLayer: pointToLayer
-  }).addTo(map);
+  // vector tiles: the map only downloads the stations of its viewport
+  var tileURL = API_URL + "/" + city + "/tiles/{z}/{x}/{y}.mvt";
+  var tileOptions = function(style) {
+    return {
+      rendererFactory: L.canvas.tile,
+      interactive: true,
+      getFeatureId: function(feature) { return feature.properties.id; },
+      vectorTileLayerStyles: {stations: style}
+    };
+  };
+  // capacity of the stations seen in the tiles, for the live updates
+  var nb_stands = {};
+  var currentLayer = L.vectorGrid.protobuf(tileURL, tileOptions(function(properties) {
+    nb_stands[properties.id] = properties.nb_stands;
+    return {radius: 5, stroke: true, color: markerColor(properties)};
+  }))
+    .on('click', function(e) {
+      L.popup().setLatLng(e.latlng).setContent(markerPopup(e.layer.properties)).openOn(map);
+    })
+    .addTo(map);
+
+  var clusterLayer = L.vectorGrid.protobuf(tileURL, tileOptions(function(properties) {
+    var color = properties.cluster_id === undefined ? "#999999" : d3.schemeSet1[properties.cluster_id % 9];
+    return {radius: 5, stroke: true, color: color};
+  }));
 
   var predictionLayer = L.geoJSON(null, {
     pointToLayer: pointToLayer
@@ -86,17 +116,13 @@ $(document).ready(function() {
   var baseMaps = {
     "info": infoLayer,
     "current": currentLayer,
-    "prediction": predictionLayer
+    "prediction": predictionLayer,
+    "clusters": clusterLayer
   };
 
   tile.addTo(map);
   L.control.layers(baseMaps).addTo(map);
 
-  $.getJSON(API_URL + "/" + city + "/station?geojson=true", function(data) {
-    currentLayer.addData(data);
-    // map.fitBounds(currentLayer.getBounds())
-  });
-
   $.getJSON(API_URL + "/" + city + "/predict/station?geojson=true", function(data) {
     predictionLayer.addData(data);
   });
@@ -105,6 +131,17 @@ $(document).ready(function() {
     infoLayer.addData(data);
     map.fitBounds(infoLayer.getBounds())
   });
+
+  // restyle the tile features with the live availability
+  availabilityStream(city, function(stations, date) {
+    stations.filter(function(station) {
+      return station[0] in nb_stands;
+    }).forEach(function(station) {
+      var properties = {nb_bikes: station[1], nb_stands: nb_stands[station[0]]};
+      currentLayer.setFeatureStyle(station[0], {radius: 5, stroke: true,
+                                                color: markerColor(properties)});
+    });
+  });
 });
 
 
@@ -1,12 +1,20 @@
 // Jitenshea functions for the 'station' page
 
+// The data of the page is fetched with a single batch request: each panel
+// registers its sub-request and the callback which draws it.
+var stationRequests = [];
+
+function stationRequest(request, callback) {
+  stationRequests.push({request: request, callback: callback});
+};
+
 
 // Station summary
 // TODO: handle the case when the ID does not exist with an error func callback
 // in the GET jQuery
 $(document).ready(function() {
   var station_id = document.getElementById("stationSummary").dataset.stationId;
-  $.get(cityurl("stationSummary") + "/station/" + station_id, function (content) {
+  stationRequest({resource: "station", ids: [station_id]}, function (content) {
     var station = content.data[0];
     $("#titlePanel").append("#" + station.id + " " + station.name + " in " + station.city);
     $("#id").append(station.id);
@@ -92,10 +100,9 @@ $(document).ready(function() {
   start = start.toISOString().substring(0, 10);
   stop = stop.toISOString().substring(0, 10);
 
-  var url = cityurl("stationTimeseries")
-      + "/timeseries/station/" + station_id
-      + "?start=" + start + "&stop=" + stop;
-  $.get(url, function(content) {
+  var request = {resource: "timeseries", ids: [station_id],
+                 args: {start: start, stop: stop}};
+  stationRequest(request, function(content) {
     // just a single station
     var data = content.data[0];
     var station_name = data.name;
@@ -178,10 +185,9 @@ $(document).ready(function() {
   console.log(start);
   console.log(stop);
 
-  var url = cityurl("stationPredictions")
-      + "/predict/station/" + station_id
-      + "?start=" + start + "&stop=" + stop + "&current=true";
-  $.get(url, function(data) {
+  var request = {resource: "prediction", ids: [station_id],
+                 args: {start: start, stop: stop, current: true}};
+  stationRequest(request, function(data) {
     var station_name = data[0].name;
     var nb_stands = data[0].nb_stands;
     var prediction = data.filter(function(x) {
@@ -194,7 +200,7 @@ $(document).ready(function() {
     }).map(function(x) {
         return [Date.parse(x.timestamp), x.nb_bikes];
     });
-    Highcharts.stockChart('stationPredictions', {
+    var chart = Highcharts.stockChart('stationPredictions', {
       // use to select the time window
       rangeSelector: {
         buttons: [{
@@ -245,6 +251,19 @@ $(document).ready(function() {
           valueDecimals: 1
         }}]
     } );
+    // add the live availability of the station to the 'current' series
+    var city = document.getElementById("stationPredictions").dataset.city;
+    availabilityStream(city, function(stations, date) {
+      stations.filter(function(x) {
+        return x[0] == station_id;
+      }).forEach(function(x) {
+        var timestamp = Date.parse(date);
+        var xdata = chart.series[0].xData;
+        if (xdata.length === 0 || xdata[xdata.length - 1] < timestamp) {
+          chart.series[0].addPoint([timestamp, x[1]]);
+        }
+      });
+    });
   } );
 } );
 
@@ -256,9 +275,9 @@ $(document).ready(function() {
   var window = 7;
   // day before today
   var day = getYesterday();
-  var url = cityurl("stationDailyTransactions") + "/daily/station/" + station_id
-      + "?date=" + day + "&window=" + window;
-  $.get(url, function(content) {
+  var request = {resource: "daily", ids: [station_id],
+                 args: {date: day, window: window}};
+  stationRequest(request, function(content) {
     var station_name = content.data[0].name;
     var nb_stands = content.data[0].nb_stands;
     var date = content.data[0].date;
@@ -297,9 +316,8 @@ $(document).ready(function() {
   var station_id = document.getElementById("stationProfileDay").dataset.stationId;
   // day before today
   var day = getYesterday();
-  var url = cityurl("stationProfileDay") + "/profile/hourly/station/" + station_id
-      + "?date=" + day;
-  $.get(url, function(content) {
+  var request = {resource: "hourly_profile", ids: [station_id], args: {date: day}};
+  stationRequest(request, function(content) {
     var station_name = content.data[0].name;
     var data = content.data[0].mean;
     Highcharts.chart('stationProfileDay', {
@@ -335,9 +353,8 @@ $(document).ready(function() {
   var station_id = document.getElementById("stationProfileWeek").dataset.stationId;
   // day before today
   var day = getYesterday();
-  var url = cityurl("stationProfileWeek") + "/profile/daily/station/" + station_id
-      + "?date=" + day;
-  $.get(url, function(content) {
+  var request = {resource: "daily_profile", ids: [station_id], args: {date: day}};
+  stationRequest(request, function(content) {
     var station_name = content.data[0].name;
     var data = content.data[0].mean;
     Highcharts.chart('stationProfileWeek', {
@@ -366,3 +383,27 @@ $(document).ready(function() {
     } );
   } );
 } );
+
+
+// One round trip for all the panels, after the registration of their
+// sub-requests
+$(document).ready(function() {
+  var requests = stationRequests.map(function(x, i) {
+    return Object.assign({id: i}, x.request);
+  });
+  $.ajax({
+    url: cityurl("stationSummary") + "/batch",
+    method: "POST",
+    contentType: "application/json",
+    data: JSON.stringify({requests: requests}),
+    success: function(content) {
+      content.responses.forEach(function(response) {
+        if (response.status !== 200) {
+          console.log("WARNING: " + requests[response.id].resource + ": " + response.message);
+          return;
+        }
+        stationRequests[response.id].callback(response.data);
+      });
+    }
+  });
+} );
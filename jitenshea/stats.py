@@ -2,6 +2,8 @@
 """Statistical methods used for analyzing the shared bike data
 """
 
+import os
+
 import daiquiri
 
 import numpy as np
@@ -11,21 +13,32 @@ from sklearn.cluster import KMeans
 
 import xgboost as xgb
 
+from jitenshea.cube import StationCube, bucket_size
+
 import seaborn as sns
 from matplotlib import pyplot as plt
 
 
 logger = daiquiri.getLogger("stats")
 
+# parameters of the prediction model; the histogram-based tree construction
+# is the one which supports the external memory, see `jitenshea.training`
+XGB_PARAMS = {'objective': 'reg:logistic',
+              'eta': 0.2,
+              'max_depth': 6,
+              'tree_method': 'hist',
+              'verbosity': 0}
+NUM_ROUND = 25
+
 
 def preprocess_data_for_clustering(df):
     """Prepare data in order to apply a clustering algorithm
 
     Parameters
     ----------
-    df : pandas.DataFrame
+    df : pandas.DataFrame or StationCube
         Input data, *i.e.* city-related timeseries, supposed to have
-    `station_id`, `ts` and `nb_bikes` columns
+    `station_id`, `ts` and `nb_bikes` columns, or their 5-minute cube
 
     Returns
     -------
@@ -33,23 +46,21 @@ def preprocess_data_for_clustering(df):
         Simpified version of `df`, ready to be used for clustering
 
     """
+    if isinstance(df, StationCube):
+        cube = df
+    else:
+        cube = StationCube.from_frame(df, "5T", ["nb_bikes"]).fill("bfill")
     # Filter unactive stations
-    max_bikes = df.groupby("station_id")["nb_bikes"].max()
-    unactive_stations = max_bikes[max_bikes==0].index.tolist()
-    active_station_mask = np.logical_not(df['station_id'].isin(unactive_stations))
-    df = df[active_station_mask]
-    # Set timestamps as the DataFrame index and resample it with 5-minute periods
-    df = (df.set_index("ts")
-          .groupby("station_id")["nb_bikes"]
-          .resample("5T")
-          .mean()
-          .bfill())
-    df = df.unstack(0)
-    # Drop week-end records
-    df = df[df.index.weekday < 5]
-    # Gather data regarding hour of the day
-    df['hour'] = df.index.hour
-    df = df.groupby("hour").mean()
+    nb_bikes = cube.var("nb_bikes")
+    max_bikes = np.where(np.isnan(nb_bikes), -np.inf, nb_bikes).max(axis=1)
+    cube = cube.select(stations=max_bikes != 0)
+    # Gather the week days data regarding hour of the day
+    weekdays = cube.times.weekday < 5
+    hours, _, means, _ = cube.profile("nb_bikes", "hour", mask=weekdays)
+    present = np.isin(hours, cube.times.hour[weekdays])
+    df = pd.DataFrame(means[:, present].T,
+                      index=pd.Index(hours[present], name="hour"),
+                      columns=pd.Index(cube.stations, name="station_id"))
     return df / df.max()
 
 
@@ -58,7 +69,7 @@ def compute_clusters(df):
 
     Parameters
     ----------
-    df : pandas.DataFrame
+    df : pandas.DataFrame or StationCube
         Input data, *i.e.* city-related timeseries, supposed to have
     `station_id`, `ts` and `nb_bikes` columns
 
@@ -177,11 +188,8 @@ def time_resampling(df, freq="10T"):
         Resampled data
     """
     logger.info("Time resampling for each station by '%s'", freq)
-    df = (df.groupby("station_id")
-          .resample(freq, on="ts")[["ts", "nb_bikes", "nb_stands", "probability"]]
-          .mean()
-          .bfill())
-    return df.reset_index()
+    cube = StationCube.from_frame(df, freq, ["nb_bikes", "nb_stands", "probability"])
+    return cube.fill("bfill").to_frame()
 
 
 def complete_data(df):
@@ -204,12 +212,75 @@ def complete_data(df):
     """
     logger.info("Complete some data")
     df = df.copy()
-    df['day'] = df['ts'].apply(lambda x: x.weekday())
-    df['hour'] = df['ts'].apply(lambda x: x.hour)
-    df['minute'] = df['ts'].apply(lambda x: x.minute)
+    if isinstance(df['ts'].dtype, pd.DatetimeTZDtype):
+        ts = df['ts'].dt
+        df['day'] = ts.weekday.astype(np.int64)
+        df['hour'] = ts.hour.astype(np.int64)
+        df['minute'] = ts.minute.astype(np.int64)
+        return df
+    # integer arithmetic on the minutes since the epoch, a Thursday
+    minutes = df['ts'].values.astype('datetime64[m]').astype(np.int64)
+    df['day'] = (minutes // 1440 + 3) % 7
+    df['hour'] = minutes // 60 % 24
+    df['minute'] = minutes % 60
     return df
 
 
+def _offset(frequency):
+    """pandas.Timedelta of a prediction frequency, e.g. '30T'
+    """
+    return bucket_size(frequency) if isinstance(frequency, str) else pd.Timedelta(frequency)
+
+
+def future_positions(ts, stations, offset):
+    """Row of the observation (ts + offset, station) of each observation, -1 if
+    there is not any
+
+    The dates are numbered on the grid of their greatest common step, so that
+    a (station, date) pair is one integer key: the shift of a date is an offset
+    of its key, looked up in the sorted keys.
+
+    Parameters
+    ----------
+    ts : array-like
+        Date of each observation
+    stations : array-like
+        Station of each observation
+    offset : pandas.Timedelta
+
+    Returns
+    -------
+    numpy.ndarray
+        Positions, or None if the (station, date) pairs are not unique
+    """
+    ns = np.asarray(ts, dtype='datetime64[ns]').astype(np.int64)
+    positions = np.full(len(ns), -1, dtype=np.int64)
+    if not len(ns):
+        return positions
+    codes = pd.factorize(np.asarray(stations))[0].astype(np.int64)
+    shift = pd.Timedelta(offset).value
+    origin = ns.min()
+    step = int(np.gcd.reduce(np.append(ns - origin, shift))) or 1
+    dates = (ns - origin) // step
+    size = int(dates.max()) + shift // step + 1
+    if size * (int(codes.max()) + 1) >= 2 ** 62:
+        # the keys would overflow: look the pairs up in a hash index
+        index = pd.MultiIndex.from_arrays([codes, dates])
+        if not index.is_unique:
+            return None
+        return index.get_indexer(pd.MultiIndex.from_arrays([codes, dates + shift // step]))
+    keys = codes * size + dates
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    if (np.diff(sorted_keys) == 0).any():
+        return None
+    targets = keys + shift // step
+    found = np.minimum(np.searchsorted(sorted_keys, targets), len(keys) - 1)
+    match = sorted_keys[found] == targets
+    positions[match] = order[found[match]]
+    return positions
+
+
 def add_future(df, frequency):
     """Add future bike availability to each observation by shifting input data
     accurate columns with respect to a given `frequency`
@@ -227,11 +298,27 @@ def add_future(df, frequency):
         Enriched data, with additional column "future"
     """
     logger.info("Compute the future bike availability (freq='%s')", frequency)
+    positions = future_positions(df["ts"].values, df["station_id"].values,
+                                 _offset(frequency))
+    if positions is None:
+        return _merge_future(df, frequency)
+    rows = np.flatnonzero(positions >= 0)
+    columns = ["station_id"] + [x for x in df.columns if x not in ("ts", "station_id")]
+    result = df[columns].iloc[rows]
+    result.index = pd.Index(df["ts"].values[rows], name="ts")
+    result.insert(len(columns), "future", df["probability"].values[positions[rows]])
+    return result
+
+
+def _merge_future(df, frequency):
+    """`add_future` of observations with duplicated (station, date) pairs:
+    each observation gets the label of each future observation
+    """
     df = df.set_index(["ts", "station_id"])
     label = df["probability"].copy()
     label.name = "future"
     label = (label.reset_index(level=1)
-             .shift(-1, freq=frequency)
+             .shift(-1, freq=_offset(frequency))
              .reset_index()
              .set_index(["ts", "station_id"]))
     logger.info("Merge future data with current observations")
@@ -240,6 +327,47 @@ def add_future(df, frequency):
     return df
 
 
+def future_column(frequency):
+    """Name of the label column of the horizon `frequency`, see `add_futures`
+    """
+    return "future_{}".format(frequency)
+
+
+def add_futures(df, frequencies):
+    """Add the future bike availability of several horizons to each
+    observation, the labels of a multi-horizon training
+
+    Unlike `add_future`, the observations are kept when a label is missing:
+    the label is NaN.
+
+    Parameters
+    ----------
+    df : pd.DataFrame
+        Input data, with `ts`, `station_id` and `probability` columns, one
+    observation by station and date
+    frequencies : list
+        Prediction frequencies, e.g. ['15T', '30T', '1H']
+
+    Returns
+    -------
+    pd.DataFrame
+        Indexed by `ts`, with an additional column by horizon, see
+    `future_column`
+    """
+    logger.info("Compute the future bike availability (freq=%s)", frequencies)
+    probability = df["probability"].values
+    ts, stations = df["ts"].values, df["station_id"].values
+    df = df.set_index("ts")
+    for frequency in frequencies:
+        positions = future_positions(ts, stations, _offset(frequency))
+        if positions is None:
+            raise ValueError("Several observations of a station at the same date")
+        label = np.full(len(df), np.nan, dtype=np.result_type(probability.dtype, np.float32))
+        label[positions >= 0] = probability[positions[positions >= 0]]
+        df[future_column(frequency)] = label
+    return df
+
+
 def prepare_data_for_training(df, date, frequency='1H', start=None, periods=1):
     """Prepare data for training
 
@@ -263,24 +391,45 @@ def prepare_data_for_training(df, date, frequency='1H', start=None, periods=1):
         two for training, two for testing (train_X, train_Y, test_X, test_Y)
     """
     logger.info("Split train and test according to a validation date")
-    cut = date - pd.Timedelta(frequency.replace('T', 'm'))
-    stop = date + periods * pd.Timedelta(frequency.replace('T', 'm'))
-    if start is not None:
-        df = df[df.index >= start]
-    logger.info("Data shape after start cut: %s", df.shape)
-    train = df[df.index <= cut].copy()
-    logger.info("Data shape after prediction date cut: %s", df.shape)
-    train_X = train.drop(["probability", "future"], axis=1)
-    train_Y = train['future'].copy()
+    cut = date - _offset(frequency)
+    stop = date + periods * _offset(frequency)
+    # one selection by set, without any intermediate copy of the frame; the
+    # labels of the other horizons are not features, see `add_futures`
+    features = [x for x in df.columns
+                if x != "probability" and not x.startswith("future")]
+    keep = np.ones(len(df), dtype=bool) if start is None else df.index >= start
+    train = keep & (df.index <= cut)
+    logger.info("Training set size after prediction date cut: %s", train.sum())
     # time window
-    mask = np.logical_and(df.index >= date, df.index <= stop)
-    test = df[mask].copy()
-    test_X = test.drop(["probability", "future"], axis=1)
-    test_Y = test['future'].copy()
-    return train_X, train_Y, test_X, test_Y
+    test = keep & (df.index >= date) & (df.index <= stop)
+    return (df.loc[train, features], df.loc[train, "future"],
+            df.loc[test, features], df.loc[test, "future"])
+
 
+def available_cores():
+    """Number of CPU cores available to the process
+    """
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
 
-def fit(train_X, train_Y, test_X, test_Y):
+
+def xgb_params(nthread=None, **kwargs):
+    """Parameters of the XGBoost training, see `XGB_PARAMS`
+
+    Parameters
+    ----------
+    nthread : int
+        Number of threads, all the available cores by default
+    kwargs : dict
+        Other parameters, overriding the default ones
+    """
+    param = dict(XGB_PARAMS, nthread=nthread or available_cores())
+    param.update(kwargs)
+    return param
+
+
+def fit(train_X, train_Y, test_X, test_Y, params=None, num_round=NUM_ROUND):
     """Train the xgboost model
 
     Parameters
@@ -289,24 +438,29 @@ def fit(train_X, train_Y, test_X, test_Y):
     test_X : pandas.DataFrame
     train_Y : pandas.DataFrame
     test_Y : pandas.DataFrame
+    params : dict
+        XGBoost parameters, see `xgb_params`
+    num_round : int
+        Number of boosting rounds
 
     Returns
     -------
     XGBoost.model
         Booster trained model
     """
-    logger.info("Fit training data with the model...")
-    # param = {'objective': 'reg:linear'}
-    param = {'objective': 'reg:logistic'}
-    param['eta'] = 0.2
-    param['max_depth'] = 6
-    param['silent'] = 1
-    param['nthread'] = 4
-    training_progress = dict()
     xg_train = xgb.DMatrix(train_X, label=train_Y)
     xg_test = xgb.DMatrix(test_X, label=test_Y)
+    return fit_matrices(xg_train, xg_test, params, num_round)
+
+
+def fit_matrices(xg_train, xg_test, params=None, num_round=NUM_ROUND):
+    """Train the xgboost model on the training and validation DMatrix, see
+    `fit`
+    """
+    logger.info("Fit training data with the model...")
+    param = params or xgb_params()
+    training_progress = dict()
     watchlist = [(xg_train, 'train'), (xg_test, 'test')]
-    num_round = 25
     bst = xgb.train(params=param,
                     dtrain=xg_train,
                     num_boost_round=num_round,
@@ -315,6 +469,44 @@ def fit(train_X, train_Y, test_X, test_Y):
     return bst, training_progress
 
 
+def build_features(df, freq="10T"):
+    """Features of the prediction model, without the label: the resampled
+    availability and its temporal columns
+
+    Parameters
+    ----------
+    df : pandas.DataFrame or jitenshea.cube.StationCube
+        Input data, contains columns `ts`, `nb_bikes`, `nb_stands`,
+    `station_id` and `probability`, or their cube on the grid of `freq`
+    freq : str
+        Time resampling frequency
+
+    Returns
+    -------
+    pandas.DataFrame
+        Columns `station_id`, `ts`, `nb_bikes`, `nb_stands`, `probability`,
+    `day`, `hour` and `minute`
+    """
+    if isinstance(df, StationCube):
+        return complete_data(df.fill("bfill").to_frame())
+    return complete_data(time_resampling(df, freq))
+
+
+def train_from_features(df, validation_date, frequency):
+    """Train a XGBoost model on features given by `build_features`, see
+    `train_prediction_model`
+    """
+    df = add_future(df, frequency)
+    train_test_split = prepare_data_for_training(df,
+                                                 validation_date,
+                                                 frequency=frequency,
+                                                 start=df.index.min(),
+                                                 periods=2)
+    train_X, train_Y, test_X, test_Y = train_test_split
+    trained_model = fit(train_X, train_Y, test_X, test_Y)
+    return trained_model[0]
+
+
 def train_prediction_model(df, validation_date, frequency):
     """Train a XGBoost model on `df` data with a train/validation split given
     by `predict_date` starting from temporal information (time of the day, day
@@ -337,17 +529,7 @@ def train_prediction_model(df, validation_date, frequency):
         Trained XGBoost model
 
     """
-    df = time_resampling(df)
-    df = complete_data(df)
-    df = add_future(df, frequency)
-    train_test_split = prepare_data_for_training(df,
-                                                 validation_date,
-                                                 frequency=frequency,
-                                                 start=df.index.min(),
-                                                 periods=2)
-    train_X, train_Y, test_X, test_Y = train_test_split
-    trained_model = fit(train_X, train_Y, test_X, test_Y)
-    return trained_model[0]
+    return train_from_features(build_features(df), validation_date, frequency)
 
 def load_model(filepath):
     """Load a XGBoost trained model stored in the indicated `filepath`
@@ -385,14 +567,44 @@ def predict_bike_availability(df_test, trained_model, frequency):
     pandas.dataframe
         Predicted bike availability levels
     """
-    df_test = time_resampling(df_test)
-    df_test = complete_data(df_test)
+    return score_features(build_features(df_test), trained_model, frequency)
+
+
+def predict_horizons(df_test, trained_models):
+    """Predict shared-bike availability at several horizons, with features
+    built once
+
+    Parameters
+    ----------
+    df_test : pandas.dataframe
+        Data on which predictions will be made
+    trained_models : dict
+        Prediction frequency, e.g. '30T' -> trained model
+
+    Returns
+    -------
+    pandas.dataframe
+        Predicted bike availability levels, with a `frequency` column
+    """
+    df_test = build_features(df_test)
+    frames = []
+    for frequency, trained_model in trained_models.items():
+        predicted_df = score_features(df_test, trained_model, frequency)
+        predicted_df.insert(0, "frequency", frequency)
+        frames.append(predicted_df)
+    return pd.concat(frames)
+
+
+def score_features(df_test, trained_model, frequency):
+    """Predict shared-bike availability from the features given by
+    `build_features`, see `predict_bike_availability`
+    """
     df_test = df_test.set_index(["ts"])
     predicted_df = df_test.drop(["probability"], axis=1).copy()
     xg_test = xgb.DMatrix(predicted_df)
     predictions = trained_model.predict(xg_test)
     predicted_df = predicted_df.drop(["day", "hour", "minute"], axis=1)
-    predicted_df.index = predicted_df.index + pd.Timedelta(frequency)
+    predicted_df.index = predicted_df.index + _offset(frequency)
     predicted_df["pred_probability"] = predictions
     total_stands = predicted_df["nb_bikes"] + predicted_df["nb_stands"]
     predicted_df["pred_nb_bikes"] = (total_stands
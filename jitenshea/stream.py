@@ -0,0 +1,290 @@
+# coding: utf-8
+
+"""Live stream of the bike availability, with server-sent events
+
+One broadcaster thread by city loads the latest availability once per
+ingestion tick and fans out the delta, i.e. the stations whose bikes or stands
+changed, to all the subscribers. The tick is either a PostgreSQL notification
+sent by the ingestion task (`LISTEN/NOTIFY`) or a polling interval.
+
+Each subscriber has a bounded queue: a slow client whose queue is full loses
+its pending deltas and receives the full snapshot instead (resync), so that it
+never blocks the fan-out.
+"""
+
+import json
+import queue
+import select
+import threading
+from datetime import datetime
+
+import daiquiri
+
+
+logger = daiquiri.getLogger(__name__)
+
+SNAPSHOT = 'snapshot'
+DELTA = 'delta'
+
+
+def channel(city):
+    """Name of the PostgreSQL notification channel of `city`
+    """
+    return 'jitenshea_availability_{}'.format(city)
+
+
+def notify(cursor, city, timestamp=None):
+    """Notify the listeners of the availability of `city` that new data is
+    available, e.g. after the ingestion of a batch
+
+    Parameters
+    ----------
+    cursor : psycopg2 cursor
+    city : str
+    timestamp : datetime
+        Date of the ingested data
+    """
+    payload = timestamp.isoformat() if timestamp is not None else ''
+    cursor.execute("SELECT pg_notify(%s, %s)", (channel(city), payload))
+
+
+def delta(previous, current):
+    """Stations of `current` whose availability differs from `previous`
+
+    Parameters
+    ----------
+    previous, current : dict
+        station id -> (nb_bikes, nb_stands)
+
+    Returns
+    -------
+    list
+        [id, nb_bikes, nb_stands] sorted by id
+    """
+    return [[station_id, bikes, stands]
+            for station_id, (bikes, stands) in sorted(current.items())
+            if previous.get(station_id) != (bikes, stands)]
+
+
+def format_event(event):
+    """Server-sent event text of `event`, a dict with the keys 'event', 'id'
+    and 'data'
+    """
+    data = json.dumps(event['data'], separators=(',', ':'), default=_default)
+    return "event: {}\nid: {}\ndata: {}\n\n".format(event['event'], event['id'], data)
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        return obj.isoformat()
+    raise TypeError("{} is not JSON serializable".format(type(obj)))
+
+
+class Subscription:
+    """Bounded queue of the events sent to one client
+    """
+    def __init__(self, size):
+        self.queue = queue.Queue(maxsize=size)
+        self.resyncs = 0
+
+    def put(self, event, snapshot):
+        """Put `event` into the queue, or replace the pending events by the
+        `snapshot` (a callable) if the queue is full
+        """
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.resyncs += 1
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            self.queue.put_nowait(snapshot())
+
+    def get(self, timeout):
+        """Next event, None if nothing happens within `timeout` seconds
+        """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+
+class Broadcaster:
+    """Fan-out of the availability deltas of a city
+
+    Parameters
+    ----------
+    city : str
+    load_snapshot : callable
+        city -> (date, dict station id -> (nb_bikes, nb_stands))
+    interval : int
+        Maximal number of seconds between two loads of the availability
+    queue_size : int
+        Number of pending events by subscriber
+    listen : callable
+        Optional (city, timeout) -> generator which yields once per
+        notification of `city`, or None after `timeout` seconds
+    """
+    def __init__(self, city, load_snapshot, interval=60, queue_size=16, listen=None):
+        self.city = city
+        self.load_snapshot = load_snapshot
+        self.interval = interval
+        self.queue_size = queue_size
+        self.listen = listen
+        self._lock = threading.Lock()
+        self._subscribers = set()
+        self._thread = None
+        self._tick = threading.Event()
+        self.sequence = 0
+        self.date = None
+        self.availability = {}
+        self.loads = 0
+
+    def subscribe(self):
+        """New subscription, the first event of which is the current snapshot
+        """
+        subscription = Subscription(self.queue_size)
+        with self._lock:
+            if self.date is not None:
+                subscription.put(self.snapshot(), self.snapshot)
+            self._subscribers.add(subscription)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='stream-{}'.format(self.city), daemon=True)
+                self._thread.start()
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscribers.discard(subscription)
+
+    def tick(self):
+        """Load the availability now, e.g. called by the ingestion path when
+        it runs in the same process
+        """
+        self._tick.set()
+
+    def current(self):
+        """(date, availability) loaded by the running stream, None if it does
+        not run, i.e. without any subscriber
+        """
+        with self._lock:
+            if self._thread is None or self.date is None:
+                return None
+            return self.date, self.availability
+
+    def snapshot(self):
+        """Event with the availability of all the stations
+        """
+        return {'event': SNAPSHOT,
+                'id': self.sequence,
+                'data': {'date': self.date,
+                         'stations': delta({}, self.availability)}}
+
+    def update(self):
+        """Load the availability and publish the delta to the subscribers
+
+        Returns
+        -------
+        int
+            Number of changed stations
+        """
+        date, availability = self.load_snapshot(self.city)
+        self.loads += 1
+        changes = delta(self.availability, availability)
+        first = self.date is None
+        with self._lock:
+            self.date, self.availability = date, availability
+            if not changes and not first:
+                return 0
+            self.sequence += 1
+            event = self.snapshot() if first else {
+                'event': DELTA,
+                'id': self.sequence,
+                'data': {'date': date, 'stations': changes}}
+            for subscription in self._subscribers:
+                subscription.put(event, self.snapshot)
+        return len(changes)
+
+    def _ticks(self):
+        """Yield at each ingestion tick or polling interval
+        """
+        if self.listen is not None:
+            try:
+                yield from self.listen(self.city, self.interval)
+                return
+            except Exception:
+                logger.exception("cannot listen the notifications of '%s', poll "
+                                 "every %s seconds", self.city, self.interval)
+        while True:
+            self._tick.wait(self.interval)
+            self._tick.clear()
+            yield
+
+    def _run(self):
+        logger.info("start the availability stream of '%s'", self.city)
+        ticks = self._ticks()
+        while True:
+            try:
+                self.update()
+            except Exception:
+                logger.exception("cannot load the availability of '%s'", self.city)
+            next(ticks)
+            with self._lock:
+                if not self._subscribers:
+                    # the next subscriber starts a new thread
+                    self._thread = None
+                    break
+        logger.info("stop the availability stream of '%s'", self.city)
+
+
+def listen(connect):
+    """Ticks from the PostgreSQL notifications sent by `notify`
+
+    Parameters
+    ----------
+    connect : callable
+        city -> psycopg2 connection to the primary database of the city
+
+    Returns
+    -------
+    callable
+        (city, timeout) -> generator, see `Broadcaster`
+    """
+    def ticks(city, timeout):
+        conn = connect(city)
+        try:
+            conn.autocommit = True
+            conn.cursor().execute("LISTEN {}".format(channel(city)))
+            while True:
+                if select.select([conn], [], [], timeout) != ([], [], []):
+                    conn.poll()
+                    # several notifications are one tick
+                    del conn.notifies[:]
+                yield
+        finally:
+            conn.close()
+    return ticks
+
+
+class Hub:
+    """Broadcasters by city, created on the first subscription
+    """
+    def __init__(self, load_snapshot, interval=60, queue_size=16, listen=None):
+        self.load_snapshot = load_snapshot
+        self.interval = interval
+        self.queue_size = queue_size
+        self.listen = listen
+        self._lock = threading.Lock()
+        self._broadcasters = {}
+
+    def __getitem__(self, city):
+        with self._lock:
+            broadcaster = self._broadcasters.get(city)
+            if broadcaster is None:
+                broadcaster = self._broadcasters[city] = Broadcaster(
+                    city, self.load_snapshot, self.interval, self.queue_size,
+                    self.listen)
+        return broadcaster
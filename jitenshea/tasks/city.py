@@ -19,6 +19,8 @@ from datetime import date, timedelta
 
 from lxml import etree
 
+import daiquiri
+
 import pandas as pd
 
 import sh
@@ -29,13 +31,18 @@ import luigi
 from luigi.contrib.postgres import CopyToTable, PostgresQuery
 from luigi.format import UTF8, MixedUnicodeBytes
 
-from jitenshea import config
-from jitenshea.iodb import db, psql_args, shp2pgsql_args
+from jitenshea import (config, export, features, orchestrator, registry, stream,
+                       training)
+from jitenshea.iodb import db, database_settings, psql_args, shp2pgsql_args
 from jitenshea.tasks.controller import latest_station_timewindow
-from jitenshea.stats import (compute_clusters, train_prediction_model,
-                             compute_geo_clusters,
-                             load_model, predict_bike_availability)
+from jitenshea.stats import (compute_clusters, build_features,
+                             compute_geo_clusters, predict_bike_availability,
+                             predict_horizons)
+from jitenshea.hexgrid import hex_rollup
+from jitenshea.hashing import key_hash
+
 
+logger = daiquiri.getLogger(__name__)
 
 _HERE = os.path.abspath(os.path.dirname(__file__))
 DATADIR = config["main"]["datadir"]
@@ -67,11 +74,37 @@ def extract_xml_feature(node, namespace='{http://data.bordeaux-metropole.fr/wfs}
             ("heure", pd.Timestamp(get("MDATE")))]
 
 
-class CreateSchema(PostgresQuery):
-    host = config['database']['host']
-    database = config['database']['dbname']
-    user = config['database']['user']
-    password = config['database'].get('password')
+class CityDatabase:
+    """Connection parameters of the primary database of the city schema, see
+    the [database:<city>] sections of the configuration file
+    """
+    @property
+    def _database(self):
+        city = getattr(self, 'city', None) or getattr(self, 'schema', None)
+        return database_settings(city)
+
+    @property
+    def host(self):
+        return self._database['host']
+
+    @property
+    def port(self):
+        return self._database['port']
+
+    @property
+    def database(self):
+        return self._database['dbname']
+
+    @property
+    def user(self):
+        return self._database['user']
+
+    @property
+    def password(self):
+        return self._database['password']
+
+
+class CreateSchema(CityDatabase, PostgresQuery):
     schema = luigi.Parameter()
     table = luigi.Parameter(default='create_schema')
     query = "CREATE SCHEMA IF NOT EXISTS {schema};"
@@ -187,17 +220,12 @@ class ShapefileIntoDB(luigi.Task):
                        .format(schema=self.city, table=self.table))
 
 
-class NormalizeStationTable(PostgresQuery):
+class NormalizeStationTable(CityDatabase, PostgresQuery):
     """
     """
     city = luigi.Parameter()
 
-    host = config['database']['host']
-    database = config['database']['dbname']
-    user = config['database']['user']
-    port = config['database']['port']
     table = 'station'
-    password = None
 
     query = ("DROP TABLE IF EXISTS {schema}.{tablename}; "
              "CREATE TABLE {schema}.{tablename} ("
@@ -340,17 +368,12 @@ class AvailabilityToCSV(luigi.Task):
             df.to_csv(fobj, index=False)
 
 
-class AvailabilityToDB(CopyToTable):
+class AvailabilityToDB(CityDatabase, CopyToTable):
     """Insert bike availability data into a PostgreSQL table
     """
     city = luigi.Parameter()
     timestamp = luigi.DateMinuteParameter(default=dt.now(), interval=5)
 
-    host = config['database']['host']
-    database = config['database']['dbname']
-    user = config['database']['user']
-    password = None
-
     columns = [('id', 'VARCHAR'),
                ('timestamp', 'TIMESTAMP'),
                ('available_stands', 'INT'),
@@ -384,6 +407,11 @@ class AvailabilityToDB(CopyToTable):
                     continue
                 yield row.values
 
+    def post_copy(self, connection):
+        """Notify the live streams of the Web API, sent on commit
+        """
+        stream.notify(connection.cursor(), self.city, self.timestamp)
+
 
 class AggregateTransaction(luigi.Task):
     """Aggregate shared-bike transactions data into a CSV file (one transaction
@@ -408,7 +436,7 @@ class AggregateTransaction(luigi.Task):
                  "ORDER BY timestamp, id"
                  ";").format(schema=self.city,
                              tablename='timeseries')
-        eng = db()
+        eng = db('analytics', self.city)
         query_params = {"start": self.date,
                         "stop": self.date + timedelta(1)}
         df = pd.io.sql.read_sql_query(query, eng, params=query_params)
@@ -423,17 +451,12 @@ class AggregateTransaction(luigi.Task):
             transactions.to_csv(fobj, index=False)
 
 
-class TransactionsIntoDB(CopyToTable):
+class TransactionsIntoDB(CityDatabase, CopyToTable):
     """Copy shared-bike transaction data into the database
     """
     city = luigi.Parameter()
     date = luigi.DateParameter(default=yesterday())
 
-    host = config['database']['host']
-    database = config['database']['dbname']
-    user = config['database']['user']
-    password = None
-
     columns = [('id', 'VARCHAR'),
                ('number', 'FLOAT'),
                ('date', 'DATE')]
@@ -456,6 +479,108 @@ class TransactionsIntoDB(CopyToTable):
         return AggregateTransaction(self.city, self.date)
 
 
+class HexRollup(luigi.Task):
+    """Aggregate the bike availability of a day by hexagonal cell and time
+    bucket into a CSV file, see `jitenshea.hexgrid`
+    """
+    city = luigi.Parameter()
+    date = luigi.DateParameter(default=yesterday())
+    freq = luigi.Parameter(default='15min')
+
+    @property
+    def path(self):
+        return os.path.join(DATADIR, self.city, '{year}',
+                            '{month:02d}', '{day:02d}', 'hex_rollup.csv')
+
+    def output(self):
+        return luigi.LocalTarget(self.path.format(year=self.date.year,
+                                                  month=self.date.month,
+                                                  day=self.date.day), format=UTF8)
+
+    def run(self):
+        query = ("SELECT DISTINCT id, timestamp, available_bikes, available_stands "
+                 "FROM {schema}.timeseries "
+                 "WHERE timestamp >= %(start)s AND timestamp < %(stop)s "
+                 "AND status = 'open'"
+                 ";").format(schema=self.city)
+        eng = db('analytics', self.city)
+        df = pd.io.sql.read_sql_query(query, eng,
+                                      params={"start": self.date,
+                                              "stop": self.date + timedelta(1)})
+        stations = pd.io.sql.read_sql_query(
+            "SELECT id, st_x(geom) AS x, st_y(geom) AS y FROM {schema}.station;"
+            "".format(schema=self.city), eng)
+        rollup = hex_rollup(df, stations, self.freq)
+        with self.output().open('w') as fobj:
+            rollup.to_csv(fobj, index=False)
+
+
+class HexRollupToDB(CityDatabase, CopyToTable):
+    """Copy the hexagonal rollup of a day into `hex_rollup`, read by the
+    heatmaps of the Web API
+    """
+    city = luigi.Parameter()
+    date = luigi.DateParameter(default=yesterday())
+
+    columns = [('resolution', 'SMALLINT'),
+               ('bucket', 'TIMESTAMP'),
+               ('q', 'INT'),
+               ('r', 'INT'),
+               ('nb_bikes', 'INT'),
+               ('nb_stands', 'INT'),
+               ('transactions', 'INT'),
+               ('nb_stations', 'INT')]
+
+    @property
+    def table(self):
+        return '{schema}.{tablename}'.format(
+            schema=self.city,
+            tablename='hex_rollup')
+
+    def rows(self):
+        with self.input().open('r') as fobj:
+            next(fobj)
+            for line in fobj:
+                yield line.strip('\n').split(',')
+
+    def requires(self):
+        return HexRollup(self.city, self.date)
+
+    def create_table(self, connection):
+        # the primary key is the index of the frame and range reads
+        coldefs = ','.join('{name} {type}'.format(name=name, type=type)
+                           for name, type in self.columns)
+        query = ("CREATE TABLE {table} ({coldefs}, "
+                 "PRIMARY KEY (resolution, bucket, q, r));"
+                 "").format(table=self.table, coldefs=coldefs)
+        connection.cursor().execute(query)
+
+
+class ExportTimeseries(luigi.Task):
+    """Export the bike availability between `start` and `stop` into a Parquet
+    or gzip CSV file, see `jitenshea.export`
+    """
+    city = luigi.Parameter()
+    start = luigi.DateParameter(default=yesterday())
+    stop = luigi.DateParameter(default=date.today())
+    fmt = luigi.ChoiceParameter(choices=sorted(export.FORMATS), default='parquet')
+    stations = luigi.ListParameter(default=[])
+
+    def output(self):
+        fname = "timeseries-{}-to-{}".format(self.start, self.stop)
+        if self.stations:
+            fname += "-" + key_hash(sorted(self.stations))[:10]
+        fname += "." + export.FORMATS[self.fmt][0]
+        return luigi.LocalTarget(os.path.join(DATADIR, self.city, 'export', fname),
+                                 format=MixedUnicodeBytes)
+
+    def run(self):
+        self.output().makedirs()
+        with self.output().temporary_path() as path:
+            export.export(self.city, self.start, self.stop, path, self.fmt,
+                          list(self.stations) or None)
+
+
 class ComputeClusters(luigi.Task):
     """Compute clusters corresponding to bike availability in `city` stations
     between a `start` and an `end` date
@@ -478,7 +603,7 @@ class ComputeClusters(luigi.Task):
                  "AND timestamp < %(stop)s;"
                  "").format(schema=self.city,
                             table='timeseries')
-        eng = db()
+        eng = db('analytics', self.city)
         df = pd.io.sql.read_sql_query(query, eng,
                                       params={"start": self.start,
                                               "stop": self.stop})
@@ -505,7 +630,7 @@ class ComputeClustersGeo(luigi.Task):
             FROM {schema}.{table};
             """.format(schema=self.city,
                        table='stations')
-        df = pd.io.sql.read_sql_query(query, db())
+        df = pd.io.sql.read_sql_query(query, db('analytics', self.city))
         clusters = compute_geo_clusters(df)
         self.output().makedirs()
         path = self.output().path
@@ -513,7 +638,7 @@ class ComputeClustersGeo(luigi.Task):
         clusters['centroids'].to_hdf(path, '/centroids')
 
 
-class StoreClustersToDatabase(CopyToTable):
+class StoreClustersToDatabase(CityDatabase, CopyToTable):
     """Read the cluster labels from `DATADIR/<city>/clustering.h5` file and store
     them into `clustered_stations`
 
@@ -522,11 +647,6 @@ class StoreClustersToDatabase(CopyToTable):
     start = luigi.DateParameter(default=yesterday())
     stop = luigi.DateParameter(default=date.today())
 
-    host = config['database']['host']
-    database = config['database']['dbname']
-    user = config['database']['user']
-    password = None
-
     columns = [('station_id', 'VARCHAR'),
                ('start', 'DATE'),
                ('stop', 'DATE'),
@@ -566,7 +686,7 @@ class StoreClustersToDatabase(CopyToTable):
             connection.cursor().execute(query)
 
 
-class StoreCentroidsToDatabase(CopyToTable):
+class StoreCentroidsToDatabase(CityDatabase, CopyToTable):
     """Read the cluster centroids from `DATADIR/<city>/clustering.h5` file and
     store them into `centroids`
 
@@ -575,10 +695,6 @@ class StoreCentroidsToDatabase(CopyToTable):
     start = luigi.DateParameter(default=yesterday())
     stop = luigi.DateParameter(default=date.today())
 
-    host = config['database']['host']
-    database = config['database']['dbname']
-    user = config['database']['user']
-    password = None
     first_columns = [('cluster_id', 'VARCHAR'),
                      ('start', 'DATE'),
                      ('stop', 'DATE')]
@@ -625,17 +741,12 @@ class StoreCentroidsToDatabase(CopyToTable):
             connection.cursor().execute(query)
 
 
-class StoreGeoClustersToDatabase(CopyToTable):
+class StoreGeoClustersToDatabase(CityDatabase, CopyToTable):
     """Read the cluster labels from `DATADIR/<city>/kmeans-geo.h5` file and store
     them into a dedicated tablename.
     """
     city = luigi.Parameter()
 
-    host = config['database']['host']
-    database = config['database']['dbname']
-    user = config['database']['user']
-    password = None
-
     columns = [('station_id', 'VARCHAR PRIMARY KEY'),
                ('cluster_id', 'INT')]
 
@@ -655,16 +766,12 @@ class StoreGeoClustersToDatabase(CopyToTable):
         return ComputeClustersGeo(self.city)
 
 
-class StoreGeoCentroidsToDatabase(CopyToTable):
+class StoreGeoCentroidsToDatabase(CityDatabase, CopyToTable):
     """Read the cluster centroids from `DATADIR/<city>/kmeans-geo.h5` file and
     store them into a dedicated table.
     """
     city = luigi.Parameter()
 
-    host = config['database']['host']
-    database = config['database']['dbname']
-    user = config['database']['user']
-    password = None
     columns = [('cluster_id', 'INT PRIMARY KEY'),
                ('lat', 'FLOAT'),
                ('lon', 'FLOAT')]
@@ -711,10 +818,52 @@ class ClusteringGeo(luigi.Task):
         yield StoreGeoCentroidsToDatabase(self.city)
 
 
+class BuildFeatures(luigi.Task):
+    """Features of the prediction model for one day, stored as a partition of
+    the feature store, see `jitenshea.features`
+
+    Attributes
+    ----------
+    city : luigi.Parameter
+        City of interest, *e.g.* Bordeaux or Lyon
+    date : luigi.DateParameter
+        Day of the partition, which should be over
+    freq : luigi.Parameter
+        Time resampling frequency
+    """
+    city = luigi.Parameter()
+    date = luigi.DateParameter(default=yesterday())
+    freq = luigi.Parameter(default="10T")
+
+    def output(self):
+        return luigi.LocalTarget(features.partition_path(DATADIR, self.city, self.freq,
+                                                         self.date),
+                                 format=MixedUnicodeBytes)
+
+    def run(self):
+        stop = self.date + timedelta(1)
+        cube = features.extract(self.city, self.date, stop, self.freq)
+        self.output().makedirs()
+        with self.output().temporary_path() as path:
+            features.write_partition(build_features(cube, self.freq), path)
+        logger.info("features of '%s' for %s, peak RSS %.1f MiB", self.city, self.date,
+                    features.peak_rss() / 2**20)
+
+
+def model_path(city, start, stop, validation, frequency):
+    """Path of the XGBoost model of `city` trained between `start` and `stop`
+    """
+    fname = "{}-to-{}-at-{}-freq-{}.model".format(start, stop, validation.isoformat(),
+                                                   frequency)
+    return os.path.join(registry.model_dir(city, DATADIR), fname)
+
+
 class TrainXGBoost(luigi.Task):
     """Train a XGBoost model between `start` and `stop` dates to predict bike
     availability at each station in `city`
 
+    The features are read from the daily partitions of the feature store.
+
     Attributes
     ----------
     city : luigi.Parameter
@@ -729,46 +878,109 @@ class TrainXGBoost(luigi.Task):
     XGBoost model training
     frequency : DateOffset, timedelta or str
         Indicates the prediction frequency
+    external_memory : luigi.BoolParameter
+        Stream the features of the window one day at a time, for the histories
+    larger than the memory, see `jitenshea.training`
     """
     city = luigi.Parameter()
     start = luigi.DateParameter(default=yesterday())
     stop = luigi.DateParameter(default=date.today())
     validation = luigi.DateMinuteParameter(default=dt.now() - timedelta(hours=1))
     frequency = luigi.Parameter(default="30T")
+    external_memory = luigi.BoolParameter(default=False, significant=False)
 
     def outputpath(self):
-        fname = "{}-to-{}-at-{}-freq-{}.model".format(self.start, self.stop,
-                                           self.validation.isoformat(),
-                                           self.frequency)
-        return os.path.join(DATADIR, self.city, 'xgboost-model', fname)
+        return model_path(self.city, self.start, self.stop, self.validation,
+                          self.frequency)
 
     def output(self):
         return luigi.LocalTarget(self.outputpath(), format=MixedUnicodeBytes)
 
+    def requires(self):
+        days = (self.stop - self.start).days
+        return [BuildFeatures(self.city, self.start + timedelta(i))
+                for i in range(days)]
+
     def run(self):
-        query = ("SELECT DISTINCT id AS station_id, timestamp AS ts, "
-                 "available_bikes AS nb_bikes, available_stands AS nb_stands, "
-                 "available_bikes::float / (available_bikes::float "
-                 "+ available_stands::float) AS probability "
-                 "FROM {schema}.{tablename} "
-                 "WHERE timestamp >= %(start)s "
-                 "AND timestamp < %(stop)s "
-                 "AND (available_bikes > 0 OR available_stands > 0) "
-                 "AND (status = 'open')"
-                 "ORDER BY id, timestamp"
-                 ";").format(schema=self.city,
-                             tablename='timeseries')
-        eng = db()
-        df = pd.io.sql.read_sql_query(query, eng,
-                                      params={"start": self.start,
-                                              "stop": self.stop})
-        df.station_id = df.station_id.astype(int)
-        if df.empty:
-            raise Exception("There is not any data to process in the DataFrame. "
-                            + "Please check the dates.")
-        prediction_model = train_prediction_model(df, self.validation, self.frequency)
+        prediction_model, metrics = training.train([x.path for x in self.input()],
+                                                   self.validation, self.frequency,
+                                                   external_memory=self.external_memory)
         self.output().makedirs()
         prediction_model.save_model(self.output().path)
+        info = dict(city=self.city, start=self.start, stop=self.stop,
+                    validation=self.validation.isoformat(), frequency=self.frequency,
+                    metrics=metrics, rounds=prediction_model.num_boosted_rounds(),
+                    parent=None, promoted=True)
+        training.write_metadata(self.output().path, **info)
+        registry.ModelRegistry(os.path.dirname(self.output().path)).register(
+            self.output().path, info, activate=True)
+        logger.info("training of '%s', peak RSS %.1f MiB", self.city,
+                    features.peak_rss() / 2**20)
+
+
+class RetrainXGBoost(luigi.Task):
+    """Retrain the latest promoted XGBoost model of `city` and `frequency` on
+    the data added since its cutoff only, see `jitenshea.training.retrain`
+
+    The new model keeps the training start of the previous one. It is promoted,
+    i.e. retrained next time, if it is not worse than the previous model on
+    the validation set; see its JSON sidecar.
+
+    Attributes
+    ----------
+    city : luigi.Parameter
+        City of interest, *e.g.* Bordeaux or Lyon
+    validation : luigi.DateMinuteParameter
+        New cutoff, that bounds the training set and the validation set
+    frequency : DateOffset, timedelta or str
+        Indicates the prediction frequency
+    mode : luigi.ChoiceParameter
+        'continue' adds boosting rounds, 'refresh' updates the leaf values
+    """
+    city = luigi.Parameter()
+    validation = luigi.DateMinuteParameter(default=dt.now() - timedelta(hours=1))
+    frequency = luigi.Parameter(default="30T")
+    mode = luigi.ChoiceParameter(choices=training.RETRAIN_MODES, default='continue')
+
+    def previous(self):
+        if not hasattr(self, '_previous'):
+            directory = registry.model_dir(self.city, DATADIR)
+            # the models trained before the registry have a sidecar only
+            self._previous = (registry.ModelRegistry(directory).active(self.frequency)
+                              or training.latest_model(directory, self.frequency))
+            if self._previous is None:
+                raise Exception("There is not any promoted model of '{}' to retrain. "
+                                "Please run TrainXGBoost.".format(self.city))
+        return self._previous
+
+    def outputpath(self):
+        info = training.read_metadata(self.previous())
+        return model_path(self.city, info['start'], self.validation.date() + timedelta(1),
+                          self.validation, self.frequency)
+
+    def output(self):
+        return luigi.LocalTarget(self.outputpath(), format=MixedUnicodeBytes)
+
+    def run(self):
+        previous = self.previous()
+        info = training.read_metadata(previous)
+        df = training.new_data(self.city, info['validation'], self.validation,
+                               self.frequency)
+        if df.empty:
+            raise Exception("There is not any data since {}.".format(info['validation']))
+        booster, metrics, reference, promoted = training.retrain(
+            previous, df, self.validation, self.frequency, self.mode)
+        self.output().makedirs()
+        booster.save_model(self.output().path)
+        info = dict(city=self.city, start=info['start'],
+                    stop=self.validation.date() + timedelta(1),
+                    validation=self.validation.isoformat(), frequency=self.frequency,
+                    metrics=metrics, previous_metrics=reference,
+                    rounds=booster.num_boosted_rounds(),
+                    parent=os.path.basename(previous), mode=self.mode, promoted=promoted)
+        training.write_metadata(self.output().path, **info)
+        registry.ModelRegistry(os.path.dirname(self.output().path)).register(
+            self.output().path, info, activate=promoted)
 
 
 class PredictBikeAvailability(luigi.Task):
@@ -818,15 +1030,13 @@ class PredictBikeAvailability(luigi.Task):
         if df.empty:
             raise Exception("There is not any data to process in the "
                             + "prediction DataFrame. Please check the dates.")
-        trained_model = load_model(self.input().path)
-        predictions = predict_bike_availability(df,
-                                                trained_model,
-                                                self.frequency.replace('T', 'm'))
+        trained_model = registry.MODELS.load(self.input().path)
+        predictions = predict_bike_availability(df, trained_model, self.frequency)
         with self.output().open('w') as fobj:
             predictions.reset_index().to_csv(fobj, index=False)
 
 
-class StorePredictionToDatabase(CopyToTable):
+class StorePredictionToDatabase(CityDatabase, CopyToTable):
     """Read the XGBoost predictions from `DATADIR/<city>/xgboost-model/.h5` file and
     store them into `predictions` table
 
@@ -839,10 +1049,6 @@ class StorePredictionToDatabase(CopyToTable):
     timestamp = luigi.DateMinuteParameter(default=dt.now(), interval=10)
     frequency = luigi.Parameter(default="30T")
 
-    host = config['database']['host']
-    database = config['database']['dbname']
-    user = config['database']['user']
-    password = None
     columns = [('timestamp', 'TIMESTAMP'),
                ('frequency', 'VARCHAR'),
                ('station_id', 'VARCHAR'),
@@ -876,3 +1082,202 @@ class StorePredictionToDatabase(CopyToTable):
             modified_row = list(row.values)
             modified_row.insert(1, self.frequency)
             yield modified_row
+
+
+class TrainMultiHorizon(luigi.Task):
+    """Train a XGBoost model by prediction horizon between `start` and `stop`
+    dates, with the features read and labelled once, see
+    `jitenshea.training.train_horizons`
+
+    The models are the ones of `TrainXGBoost` for each frequency.
+
+    Attributes
+    ----------
+    city : luigi.Parameter
+        City of interest, *e.g.* Bordeaux or Lyon
+    start : luigi.DateParameter
+        Training start date
+    stop : luigi.DataParameter
+        Training stop date upper bound
+    validation : luigi.DateMinuteParameter
+        Date that bounds the training set and the validation set
+    frequencies : luigi.ListParameter
+        Prediction horizons
+    """
+    city = luigi.Parameter()
+    start = luigi.DateParameter(default=yesterday())
+    stop = luigi.DateParameter(default=date.today())
+    validation = luigi.DateMinuteParameter(default=dt.now() - timedelta(hours=1))
+    frequencies = luigi.ListParameter(default=["15T", "30T", "1H", "2H"])
+
+    def output(self):
+        return {frequency: luigi.LocalTarget(model_path(self.city, self.start, self.stop,
+                                                        self.validation, frequency),
+                                             format=MixedUnicodeBytes)
+                for frequency in self.frequencies}
+
+    def requires(self):
+        days = (self.stop - self.start).days
+        return [BuildFeatures(self.city, self.start + timedelta(i))
+                for i in range(days)]
+
+    def run(self):
+        models = training.train_horizons([x.path for x in self.input()],
+                                         self.validation, list(self.frequencies))
+        for frequency, (prediction_model, metrics) in models.items():
+            output = self.output()[frequency]
+            output.makedirs()
+            prediction_model.save_model(output.path)
+            info = dict(city=self.city, start=self.start, stop=self.stop,
+                        validation=self.validation.isoformat(), frequency=frequency,
+                        metrics=metrics, rounds=prediction_model.num_boosted_rounds(),
+                        parent=None, promoted=True)
+            training.write_metadata(output.path, **info)
+            registry.ModelRegistry(os.path.dirname(output.path)).register(
+                output.path, info, activate=True)
+
+
+class PredictMultiHorizon(luigi.Task):
+    """Predict bike availability at several horizons, with the features built
+    once, from the models of `TrainMultiHorizon`
+
+    Attributes
+    ----------
+    city : luigi.Parameter
+        City of interest, *e.g.* Bordeaux or Lyon
+    train_start, train_stop, train_cut
+        Training window and validation date of the models
+    start, stop : luigi.DateMinuteParameter
+        Time window of the latest availability of the stations
+    frequencies : luigi.ListParameter
+        Prediction horizons
+    """
+    city = luigi.Parameter()
+    train_start = luigi.DateParameter()
+    train_stop = luigi.DateParameter()
+    train_cut = luigi.DateMinuteParameter()
+    start = luigi.DateMinuteParameter()
+    stop = luigi.DateMinuteParameter()
+    frequencies = luigi.ListParameter(default=["15T", "30T", "1H", "2H"])
+
+    def outputpath(self):
+        fname = ("{}-to-{}-at-{}-freq-{}.model.{}-to-{}.predictions.csv"
+                 "").format(self.train_start, self.train_stop,
+                            self.train_cut.isoformat(),
+                            '+'.join(self.frequencies), self.start, self.stop)
+        return os.path.join(DATADIR, self.city, 'xgboost-model', fname)
+
+    def output(self):
+        return luigi.LocalTarget(self.outputpath(), format=MixedUnicodeBytes)
+
+    def requires(self):
+        return TrainMultiHorizon(self.city, self.train_start, self.train_stop,
+                                 self.train_cut, self.frequencies)
+
+    def run(self):
+        df = latest_station_timewindow(self.city, self.start, self.stop)
+        df.station_id = df.station_id.astype(int)
+        if df.empty:
+            raise Exception("There is not any data to process in the "
+                            + "prediction DataFrame. Please check the dates.")
+        trained_models = {frequency: registry.MODELS.load(target.path)
+                          for frequency, target in self.input().items()}
+        predictions = predict_horizons(df, trained_models)
+        with self.output().open('w') as fobj:
+            predictions.reset_index().to_csv(fobj, index=False)
+
+
+class StoreMultiHorizonPredictions(CityDatabase, CopyToTable):
+    """Store the predictions of all the horizons of `PredictMultiHorizon` into
+    the `prediction` table, with one COPY
+    """
+    city = luigi.Parameter()
+    train_start = luigi.DateParameter()
+    train_stop = luigi.DateParameter()
+    train_cut = luigi.DateMinuteParameter()
+    predict_start = luigi.DateMinuteParameter(default=None, interval=10)
+    timestamp = luigi.DateMinuteParameter(default=dt.now(), interval=10)
+    frequencies = luigi.ListParameter(default=["15T", "30T", "1H", "2H"])
+
+    columns = StorePredictionToDatabase.columns
+
+    @property
+    def table(self):
+        return '{schema}.{tablename}'.format(
+            schema=self.city,
+            tablename='prediction')
+
+    @property
+    def start(self):
+        if self.predict_start is None:
+            return self.timestamp - pd.Timedelta('10m')
+        else:
+            return self.predict_start
+
+    def requires(self):
+        return PredictMultiHorizon(self.city, self.train_start, self.train_stop,
+                                   self.train_cut, self.start, self.timestamp,
+                                   self.frequencies)
+
+    def rows(self):
+        predictions = pd.read_csv(self.input().path)
+        # ts, frequency, station_id, pred_probability, pred_nb_bikes, pred_nb_stands
+        for row in predictions.itertuples(index=False):
+            yield list(row)
+
+
+class NightlyRetrain(luigi.Task):
+    """Train the models of several cities, prediction frequencies and rolling
+    windows ending at `date`, in parallel, see `jitenshea.orchestrator`
+
+    The features of each city are read once, for the widest window. The
+    validation cutoff of a model is the last one of its frequency before
+    `date`. The output is the list of the trained models, with their metrics.
+
+    Attributes
+    ----------
+    cities : luigi.ListParameter
+        Cities of interest, *e.g.* Bordeaux and Lyon
+    date : luigi.DateParameter
+        Upper bound of the training windows
+    windows : luigi.ListParameter
+        Length of the training windows, in days
+    frequencies : luigi.ListParameter
+        Prediction horizons
+    cores : luigi.IntParameter
+        Core budget, the [training] 'nthread' option by default
+    """
+    cities = luigi.ListParameter(default=["bordeaux", "lyon"])
+    date = luigi.DateParameter(default=date.today())
+    windows = luigi.ListParameter(default=[7, 28])
+    frequencies = luigi.ListParameter(default=["15T", "30T", "1H", "2H"])
+    cores = luigi.IntParameter(default=0, significant=False)
+
+    def output(self):
+        return luigi.LocalTarget(os.path.join(DATADIR, 'nightly-retrain',
+                                              '{}.json'.format(self.date)),
+                                 format=UTF8)
+
+    def requires(self):
+        days = max(self.windows)
+        return {city: [BuildFeatures(city, self.date - timedelta(i))
+                       for i in range(days, 0, -1)]
+                for city in self.cities}
+
+    def jobs(self):
+        for city in self.cities:
+            for days in self.windows:
+                start = self.date - timedelta(days)
+                for frequency in self.frequencies:
+                    validation = orchestrator.cutoff(self.date, frequency).to_pydatetime()
+                    yield orchestrator.Job(city, start, self.date, validation, frequency,
+                                           model_path(city, start, self.date, validation,
+                                                      frequency))
+
+    def run(self):
+        windows = {city: [x.path for x in targets]
+                   for city, targets in self.input().items()}
+        models = orchestrator.run(list(self.jobs()), windows, cores=self.cores or None)
+        self.output().makedirs()
+        with self.output().open('w') as fobj:
+            json.dump(models, fobj, indent=2, default=str)
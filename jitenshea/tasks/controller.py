@@ -45,7 +45,7 @@ def latest_station_timewindow(city, start, stop):
     where rk=1
     order by station_id;
     """.format(schema=city)
-    eng = db()
+    eng = db('analytics', city)
     return pd.io.sql.read_sql_query(query, eng,
                                     params={"start": start,
                                             "stop": stop})
@@ -0,0 +1,114 @@
+# coding: utf-8
+
+"""Vector tiles (Mapbox Vector Tile) of the station map layers
+
+The tiles are built by PostGIS (`ST_AsMVT`) for the stations within the tile,
+joined with their latest availability and cluster label, so that the maps
+only download their viewport.
+
+The tiles are cached by zoom level. A tile is computed for an ingestion tick,
+i.e. the date of the latest availability: it is stale, and recomputed, as soon
+as a newer availability is ingested.
+"""
+
+import math
+import threading
+from collections import OrderedDict
+
+import daiquiri
+
+
+logger = daiquiri.getLogger(__name__)
+
+# half of the Web Mercator (EPSG:3857) world width, in meters
+ORIGIN_SHIFT = 20037508.342789244
+MAX_ZOOM = 22
+EXTENT = 4096
+BUFFER = 64
+
+
+def check_tile(z, x, y):
+    """Raise a ValueError if (z, x, y) is not a tile of the Web Mercator grid
+    """
+    if not 0 <= z <= MAX_ZOOM:
+        raise ValueError("Zoom level {} not in [0, {}]".format(z, MAX_ZOOM))
+    size = 2 ** z
+    if not (0 <= x < size and 0 <= y < size):
+        raise ValueError("Tile {}/{}/{} out of the grid".format(z, x, y))
+
+
+def tile_envelope(z, x, y):
+    """Web Mercator bounds (xmin, ymin, xmax, ymax) of a tile (XYZ scheme,
+    y downwards)
+    """
+    size = 2 * ORIGIN_SHIFT / 2 ** z
+    xmin = -ORIGIN_SHIFT + x * size
+    ymax = ORIGIN_SHIFT - y * size
+    return xmin, ymax - size, xmin + size, ymax
+
+
+def tile_lonlat_bounds(z, x, y, buffer=BUFFER, extent=EXTENT):
+    """Longitude/latitude bounds of a tile, widened by its `buffer`, to
+    select the stations with the spatial index of their geometry
+    """
+    margin = buffer / extent
+
+    def lon(tile_x):
+        return tile_x / 2 ** z * 360. - 180.
+
+    def lat(tile_y):
+        n = math.pi - 2. * math.pi * tile_y / 2 ** z
+        return math.degrees(math.atan(math.sinh(n)))
+
+    return (max(lon(x - margin), -180.), max(lat(y + 1 + margin), -85.0511287798),
+            min(lon(x + 1 + margin), 180.), min(lat(y - margin), 85.0511287798))
+
+
+class TileCache:
+    """Tiles by zoom level, each level being a LRU cache
+
+    Parameters
+    ----------
+    size : int
+        Number of tiles by zoom level
+    """
+    def __init__(self, size=1024):
+        self.size = size
+        self._lock = threading.Lock()
+        self._zooms = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, city, z, x, y, tick):
+        """Cached tile computed for the ingestion `tick`, None otherwise
+        """
+        with self._lock:
+            tiles = self._zooms.get(z)
+            entry = tiles.get((city, x, y)) if tiles is not None else None
+            if entry is None or entry[0] != tick:
+                self.misses += 1
+                return None
+            tiles.move_to_end((city, x, y))
+            self.hits += 1
+            return entry[1]
+
+    def put(self, city, z, x, y, tick, tile):
+        with self._lock:
+            tiles = self._zooms.setdefault(z, OrderedDict())
+            tiles[(city, x, y)] = (tick, tile)
+            tiles.move_to_end((city, x, y))
+            while len(tiles) > self.size:
+                tiles.popitem(last=False)
+
+    def invalidate(self, city):
+        """Drop the tiles of `city`
+        """
+        with self._lock:
+            for tiles in self._zooms.values():
+                for key in [key for key in tiles if key[0] == city]:
+                    del tiles[key]
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'tiles': {z: len(tiles) for z, tiles in sorted(self._zooms.items())}}
@@ -0,0 +1,489 @@
+# coding: utf-8
+
+"""Training of the bike availability prediction model on the feature store
+
+The model is trained with the histogram-based tree construction of XGBoost,
+on all the available cores by default (see the [training] section of the
+configuration file). The features come from the daily partitions of the
+feature store (see `jitenshea.features`), in one of two modes:
+
+- in memory: the training and validation DMatrix are built once, then cached
+  as binary files by window, validation date and frequency, so that a new
+  training with other parameters loads them instead of reading and labelling
+  the features again; the cached files older than 'cache_max_age' hours are
+  removed, then the least recently used ones beyond 'cache_max_size' MiB, see
+  `evict`;
+- external memory: for histories larger than the RAM, the partitions are
+  streamed one day at a time by a `PartitionIter` and XGBoost keeps its
+  pages on disk, removed once the model is trained.
+
+The models of several horizons are trained together (see `train_horizons`):
+the features are read and labelled once, in a DMatrix shared by the horizons.
+
+A model file has a JSON sidecar (`<model>.json`) with its training window,
+its validation metrics and whether it was promoted. A model may be retrained
+from the previous one on the data since its cutoff only (see `retrain`),
+either by adding boosting rounds or by refreshing its leaf values; the new
+model is promoted if it does not get worse on the validation set.
+"""
+
+import os
+import json
+import glob
+import time
+
+import daiquiri
+
+import numpy as np
+import pandas as pd
+
+import xgboost as xgb
+
+from jitenshea import config, features
+from jitenshea.cube import bucket_size
+from jitenshea.hashing import key_hash
+from jitenshea.stats import (NUM_ROUND, add_future, add_futures, build_features,
+                             fit_matrices, future_column, load_model,
+                             prepare_data_for_training, xgb_params)
+
+
+logger = daiquiri.getLogger(__name__)
+
+# the validation set spans two prediction periods after the validation date
+VALIDATION_PERIODS = 2
+RETRAIN_MODES = ('continue', 'refresh')
+
+
+def settings():
+    """Read the [training] options from the configuration file
+
+    Returns
+    -------
+    dict
+        tree_method, nthread (0 for all the available cores), max_bin,
+    num_round, warm_rounds (rounds added by a retraining), cache_dir,
+    cache_max_age (hours), cache_max_size (MiB) and job_threads (threads of a job of `jitenshea.orchestrator`, 0 to share the
+    cores between the jobs)
+    """
+    section = (config['training']
+               if config is not None and config.has_section('training') else {})
+    datadir = config['main']['datadir'] if config is not None else 'datarepo'
+    return {'tree_method': section.get('tree_method') or 'hist',
+            'nthread': int(section.get('nthread') or 0),
+            'max_bin': int(section.get('max_bin') or 256),
+            'num_round': int(section.get('num_round') or NUM_ROUND),
+            'warm_rounds': int(section.get('warm_rounds') or 5),
+            'cache_dir': section.get('cache_dir') or os.path.join(datadir, 'dmatrix-cache'),
+            'cache_max_age': float(section.get('cache_max_age') or 24),
+            'cache_max_size': float(section.get('cache_max_size') or 4096),
+            'job_threads': int(section.get('job_threads') or 0)}
+
+
+def period(frequency):
+    """Prediction period of `frequency`, e.g. '30T' or '1H'
+    """
+    return bucket_size(frequency)
+
+
+def default_params(options=None):
+    """XGBoost parameters of the [training] options, see `settings`
+    """
+    options = options or settings()
+    return xgb_params(nthread=options['nthread'] or None,
+                      tree_method=options['tree_method'],
+                      max_bin=options['max_bin'])
+
+
+def partition_day(path):
+    """Day of a feature partition, from its file name
+    """
+    return pd.Timestamp(os.path.basename(path).split('.')[0])
+
+
+def split(df, validation, frequency):
+    """Training and validation sets of labelled features, see
+    `stats.prepare_data_for_training`
+    """
+    return prepare_data_for_training(df, validation, frequency=frequency,
+                                     periods=VALIDATION_PERIODS)
+
+
+def labelled_day(paths, i, frequency):
+    """Features of the partition `paths[i]` with their label: the label of the
+    end of the day is read from the next partition
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by date, with a `future` column, see `stats.add_future`
+    """
+    df = features.read_partitions(paths[i:i + 2])
+    if df.empty:
+        return df
+    day = partition_day(paths[i])
+    df = add_future(df, frequency)
+    return df[(df.index >= day) & (df.index < day + pd.Timedelta(days=1))]
+
+
+class PartitionIter(xgb.DataIter):
+    """Training rows of the feature partitions, one day at a time
+
+    Parameters
+    ----------
+    paths : list
+        Feature partitions, sorted by day
+    validation : datetime
+        Validation date, the training rows are before it
+    frequency : str
+        Prediction frequency
+    cache_prefix : str
+        Prefix of the external memory pages of XGBoost
+    """
+    def __init__(self, paths, validation, frequency, cache_prefix):
+        self.paths = paths
+        self.validation = pd.Timestamp(validation)
+        self.frequency = frequency
+        self.position = 0
+        super().__init__(cache_prefix=cache_prefix)
+
+    def next(self, input_data):
+        while self.position < len(self.paths):
+            df = labelled_day(self.paths, self.position, self.frequency)
+            self.position += 1
+            if df.empty:
+                continue
+            train_X, train_Y, _, _ = split(df, self.validation, self.frequency)
+            if len(train_X):
+                input_data(data=train_X, label=train_Y)
+                return True
+        return False
+
+    def reset(self):
+        self.position = 0
+
+
+def validation_matrix(paths, validation, frequency):
+    """In-memory DMatrix of the validation set, read from the partitions of its
+    days only
+    """
+    validation = pd.Timestamp(validation)
+    stop = validation + VALIDATION_PERIODS * period(frequency)
+    frames = []
+    for i, path in enumerate(paths):
+        day = partition_day(path)
+        if day + pd.Timedelta(days=1) <= validation or day > stop:
+            continue
+        df = labelled_day(paths, i, frequency)
+        if not df.empty:
+            frames.append(split(df, validation, frequency)[2:])
+    if not frames:
+        raise Exception("There is not any validation data. Please check the dates.")
+    return xgb.DMatrix(pd.concat([x for x, _ in frames]),
+                       label=pd.concat([y for _, y in frames]))
+
+
+def _cache_paths(cache_dir, paths, validation, frequency):
+    key = key_hash([(x, os.path.getmtime(x)) for x in paths], validation, frequency)
+    return (os.path.join(cache_dir, key + '.train.buffer'),
+            os.path.join(cache_dir, key + '.test.buffer'))
+
+
+def evict(cache_dir, max_age, max_size):
+    """Remove the files of `cache_dir` older than `max_age` seconds, then the
+    least recently used DMatrix files beyond `max_size` bytes
+
+    The external memory pages of a training in progress are recent: only the
+    age limit applies to them.
+
+    Returns
+    -------
+    int
+        Number of removed files
+    """
+    now = time.time()
+    removed, buffers = 0, []
+    for entry in os.scandir(cache_dir):
+        if not entry.is_file(follow_symlinks=False):
+            continue
+        mtime = entry.stat().st_mtime
+        if now - mtime > max_age:
+            removed += _remove(entry.path)
+        elif entry.name.endswith('.buffer'):
+            buffers.append((mtime, entry.stat().st_size, entry.path))
+    size = 0
+    for _, fsize, path in sorted(buffers, reverse=True):
+        size += fsize
+        if size > max_size:
+            removed += _remove(path)
+    if removed:
+        logger.info("remove %d files of the DMatrix cache '%s'", removed, cache_dir)
+    return removed
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        return 0
+    return 1
+
+
+def matrices(paths, validation, frequency, cache_dir=None):
+    """In-memory training and validation DMatrix of the feature partitions,
+    cached as binary files in `cache_dir`
+
+    Returns
+    -------
+    tuple
+        (training DMatrix, validation DMatrix)
+    """
+    if cache_dir is not None:
+        train_path, test_path = _cache_paths(cache_dir, paths, validation, frequency)
+        if os.path.exists(train_path) and os.path.exists(test_path):
+            logger.info("load the cached DMatrix %s", train_path)
+            # the most recently used files are kept by `evict`
+            os.utime(train_path)
+            os.utime(test_path)
+            return xgb.DMatrix(train_path), xgb.DMatrix(test_path)
+    df = features.read_partitions(paths)
+    if df.empty:
+        raise Exception("There is not any data to process in the DataFrame. "
+                        + "Please check the dates.")
+    df = add_future(df, frequency)
+    train_X, train_Y, test_X, test_Y = split(df, validation, frequency)
+    del df
+    xg_train = xgb.DMatrix(train_X, label=train_Y)
+    xg_test = xgb.DMatrix(test_X, label=test_Y)
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        for dmatrix, path in ((xg_train, train_path), (xg_test, test_path)):
+            dmatrix.save_binary(path + '.tmp')
+            os.replace(path + '.tmp', path)
+        options = settings()
+        evict(cache_dir, options['cache_max_age'] * 3600,
+              options['cache_max_size'] * 2**20)
+    return xg_train, xg_test
+
+
+def train(paths, validation, frequency, external_memory=False, params=None,
+          num_round=None, cache_dir=None):
+    """Train the prediction model on the feature partitions `paths`
+
+    Parameters
+    ----------
+    paths : list
+        Feature partitions, sorted by day
+    validation : datetime
+        Date that bounds the training set and the validation set
+    frequency : str
+        Prediction frequency
+    external_memory : bool
+        Stream the partitions instead of loading them, see `PartitionIter`
+    params : dict
+        XGBoost parameters, given by `settings` by default
+    num_round : int
+        Number of boosting rounds
+    cache_dir : str
+        Directory of the cached DMatrix and of the external memory pages
+
+    Returns
+    -------
+    tuple
+        (xgboost.Booster, metrics on the validation set, see `evaluate`)
+    """
+    options = settings()
+    params = params or default_params(options)
+    num_round = num_round or options['num_round']
+    cache_dir = cache_dir or options['cache_dir']
+    if external_memory:
+        os.makedirs(cache_dir, exist_ok=True)
+        prefix = os.path.join(cache_dir, key_hash(paths, validation, frequency))
+        xg_train = xgb.DMatrix(PartitionIter(paths, validation, frequency, prefix))
+        xg_test = validation_matrix(paths, validation, frequency)
+    else:
+        xg_train, xg_test = matrices(paths, validation, frequency, cache_dir)
+    logger.info("train on %d rows with %d threads ('%s')", xg_train.num_row(),
+                params['nthread'], params['tree_method'])
+    booster = fit_matrices(xg_train, xg_test, params, num_round)[0]
+    if external_memory:
+        del xg_train
+        for path in glob.glob(prefix + '*'):
+            _remove(path)
+    return booster, evaluate(booster, xg_test)
+
+
+def train_horizons(paths, validation, frequencies, params=None, num_round=None):
+    """Train a prediction model by horizon on the feature partitions `paths`
+
+    The features are read once, labelled for all the horizons at once (see
+    `stats.add_futures`) and stored in one DMatrix; the training and
+    validation sets of each horizon are slices of it.
+
+    Parameters
+    ----------
+    paths : list
+        Feature partitions, sorted by day
+    validation : datetime
+        Date that bounds the training set and the validation set
+    frequencies : list
+        Prediction frequencies, e.g. ['15T', '30T', '1H']
+    params : dict
+    num_round : int
+
+    Returns
+    -------
+    dict
+        Frequency -> (xgboost.Booster, metrics on the validation set)
+    """
+    options = settings()
+    params = params or default_params(options)
+    num_round = num_round or options['num_round']
+    df = features.read_partitions(paths)
+    if df.empty:
+        raise Exception("There is not any data to process in the DataFrame. "
+                        + "Please check the dates.")
+    df = add_futures(df, frequencies)
+    columns = [x for x in df.columns if x != "probability" and not x.startswith("future")]
+    matrix = xgb.DMatrix(df[columns])
+    validation = pd.Timestamp(validation)
+    models = {}
+    for frequency in frequencies:
+        # the sets of `split`, without the rows whose label is missing
+        label = df[future_column(frequency)].values
+        labelled = ~np.isnan(label)
+        cut = validation - period(frequency)
+        stop = validation + VALIDATION_PERIODS * period(frequency)
+        sets = []
+        for mask in (labelled & (df.index <= cut),
+                     labelled & (df.index >= validation) & (df.index <= stop)):
+            rows = np.flatnonzero(mask)
+            dmatrix = matrix.slice(rows)
+            dmatrix.set_label(label[rows])
+            sets.append(dmatrix)
+        logger.info("train the horizon %s on %d rows", frequency, sets[0].num_row())
+        booster = fit_matrices(sets[0], sets[1], params, num_round)[0]
+        models[frequency] = booster, evaluate(booster, sets[1])
+    return models
+
+
+def evaluate(booster, dmatrix):
+    """Metrics of `booster` on the labelled `dmatrix`
+
+    Returns
+    -------
+    dict
+        rmse, mae and the number of rows
+    """
+    error = booster.predict(dmatrix) - dmatrix.get_label()
+    if not len(error):
+        return {'rmse': None, 'mae': None, 'rows': 0}
+    return {'rmse': float(np.sqrt(np.mean(error ** 2))),
+            'mae': float(np.mean(np.abs(error))),
+            'rows': len(error)}
+
+
+def metadata_path(model_path):
+    """Path of the JSON sidecar of a model file
+    """
+    return model_path + '.json'
+
+
+def write_metadata(model_path, **info):
+    """Write the JSON sidecar of a model file, e.g. its training window,
+    metrics and promotion
+    """
+    path = metadata_path(model_path)
+    with open(path + '.tmp', 'w') as fobj:
+        json.dump(info, fobj, indent=2, sort_keys=True, default=str)
+    os.replace(path + '.tmp', path)
+
+
+def read_metadata(model_path):
+    """JSON sidecar of a model file, None if there is not any
+    """
+    try:
+        with open(metadata_path(model_path)) as fobj:
+            return json.load(fobj)
+    except FileNotFoundError:
+        return None
+
+
+def latest_model(directory, frequency):
+    """Path of the promoted model of `frequency` with the latest cutoff in
+    `directory`, None if there is not any
+    """
+    candidates = []
+    for path in glob.glob(os.path.join(directory, '*.model')):
+        info = read_metadata(path)
+        if info and info.get('promoted') and info.get('frequency') == frequency:
+            candidates.append((pd.Timestamp(info['validation']), path))
+    return max(candidates)[1] if candidates else None
+
+
+def new_data(city, since, validation, frequency, freq="10T"):
+    """Labelled features of `city` from the cutoff `since` to the end of the
+    validation set, streamed from the database, see `features.extract`
+    """
+    start = pd.Timestamp(since) - period(frequency)
+    stop = pd.Timestamp(validation) + (VALIDATION_PERIODS + 1) * period(frequency)
+    df = build_features(features.extract(city, start, stop, freq), freq)
+    if df.empty:
+        return df
+    return add_future(df, frequency)
+
+
+def retrain(previous_path, df, validation, frequency, mode='continue', params=None,
+            num_round=None):
+    """Update the model `previous_path` with the labelled features `df` added
+    since its cutoff
+
+    Parameters
+    ----------
+    previous_path : str
+        Model file, with its JSON sidecar
+    df : pandas.DataFrame
+        Labelled features (see `stats.add_future`), from the previous cutoff
+    validation : datetime
+        New validation date
+    frequency : str
+    mode : str
+        'continue': add boosting rounds to the previous model; 'refresh':
+    update the leaf values of its trees, without new trees
+    params : dict
+    num_round : int
+        Number of rounds added by 'continue'
+
+    Returns
+    -------
+    tuple
+        (xgboost.Booster, metrics of the new model, metrics of the previous
+    one on the same validation set, promoted)
+    """
+    if mode not in RETRAIN_MODES:
+        raise ValueError("Unknown retraining mode '{}'".format(mode))
+    options = settings()
+    params = params or default_params(options)
+    previous = load_model(previous_path)
+    info = read_metadata(previous_path) or {}
+    train_X, train_Y, test_X, test_Y = split(df, validation, frequency)
+    if 'validation' in info:
+        # only the rows which were not in the previous training set
+        new = train_X.index > pd.Timestamp(info['validation']) - period(frequency)
+        train_X, train_Y = train_X[new], train_Y[new]
+    if not len(train_X):
+        raise Exception("There is not any new data since {}.".format(info.get('validation')))
+    xg_train = xgb.DMatrix(train_X, label=train_Y)
+    xg_test = xgb.DMatrix(test_X, label=test_Y)
+    logger.info("retrain '%s' on %d new rows (%s)", previous_path, len(train_X), mode)
+    if mode == 'continue':
+        rounds = num_round or options['warm_rounds']
+    else:
+        params = dict(params, process_type='update', updater='refresh', refresh_leaf=True)
+        rounds = previous.num_boosted_rounds()
+    booster = xgb.train(params, xg_train, num_boost_round=rounds, xgb_model=previous)
+    metrics, reference = evaluate(booster, xg_test), evaluate(previous, xg_test)
+    promoted = (reference['rmse'] is None or metrics['rmse'] is not None
+                and metrics['rmse'] <= reference['rmse'])
+    logger.info("validation rmse %s (previous model: %s), promoted: %s",
+                metrics['rmse'], reference['rmse'], promoted)
+    return booster, metrics, reference, promoted
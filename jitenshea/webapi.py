@@ -3,25 +3,49 @@
 """Flask API for Jitenshea (Bicycle-sharing data)
 """
 
+import os
+import hmac
+import json
+
 import daiquiri
 
-from datetime import date, datetime
+from datetime import date, datetime, timedelta
+from contextlib import contextmanager
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from dateutil.parser import parse
 
 from werkzeug.routing import BaseConverter
+from werkzeug.exceptions import HTTPException
+from werkzeug.datastructures import MultiDict
 
-from flask import jsonify
+import flask
 from flask.json import JSONEncoder
 from flask_restplus import inputs
 from flask_restplus import Resource, Api
 
-from jitenshea import controller
+from jitenshea import config, controller, coalesce, export, metrics, iodb, jobs, stream
+from jitenshea.hexgrid import RESOLUTIONS
+from jitenshea.pagination import InvalidCursor
 from jitenshea.webapp import app
 
 
 ISO_DATE = '%Y-%m-%d'
 ISO_DATETIME = '%Y-%m-%dT%H:%M:%S'
 CITIES = ('lyon', 'bordeaux')
+# seconds between two keep-alive comments of the event streams
+HEARTBEAT = 15
+MAX_BATCH_SIZE = 20
+# longest animation of the heatmaps
+MAX_HEATMAP_RANGE = timedelta(days=7)
+# clients of the admin endpoints when no token is configured
+LOOPBACK = ('127.0.0.1', '::1')
+
+# the sub-requests of the batches run concurrently (not in the controller
+# executor, which they use themselves)
+BATCH_EXECUTOR = ThreadPoolExecutor(max_workers=8, thread_name_prefix='batch')
+# asynchronous jobs, e.g. the profiles over a long window
+JOBS = jobs.JobStore(**jobs.settings())
 
 logger = daiquiri.getLogger("jitenshea-webapi")
 
@@ -60,6 +84,18 @@ app.url_map.converters['list'] = ListConverter
 app.json_encoder = CustomJSONEncoder
 
 
+def jsonify(*args, **kwargs):
+    """Same as `flask.jsonify`, the JSON encoding time being recorded in the
+    request metrics
+
+    A JSON text built by the database (`controller.RawJSON`) is sent as is.
+    """
+    if len(args) == 1 and isinstance(args[0], controller.RawJSON):
+        return flask.Response(args[0], mimetype='application/json')
+    with metrics.timed('serialize'):
+        return flask.jsonify(*args, **kwargs)
+
+
 def parse_date(strdate):
     """Parse a string and convert it to a date
     """
@@ -91,6 +127,24 @@ def check_city(city):
         api.abort(404, "City {} not found".format(city))
 
 
+def check_admin():
+    """The admin endpoints must be enabled in the configuration file; the
+    request must give the configured token as 'Authorization: Bearer <token>',
+    or come from the loopback interface if there is no token
+    """
+    if config is None or not config.has_section('admin') \
+       or not config['admin'].getboolean('enabled', fallback=False):
+        api.abort(403, "Admin endpoints are disabled")
+    token = config['admin'].get('token')
+    if not token:
+        if flask.request.remote_addr not in LOOPBACK:
+            api.abort(403, "Admin endpoints are only available from the loopback interface")
+        return
+    scheme, _, given = flask.request.headers.get('Authorization', '').partition(' ')
+    if scheme.lower() != 'bearer' or not hmac.compare_digest(given.strip(), token):
+        api.abort(401, "Wrong or missing admin token")
+
+
 api = Api(title='Jitenshea: Bicycle-sharing data analysis',
           prefix='/api',
           doc=False,
@@ -103,6 +157,8 @@ station_list_parser.add_argument("limit", required=False, type=int, default=100,
                                  dest='limit', location='args', help='Limit')
 station_list_parser.add_argument("geojson", required=False, default=False, dest='geojson',
                                  location='args', help='GeoJSON format?')
+station_list_parser.add_argument("cursor", required=False, dest='cursor', location='args',
+                                 help="Page cursor, the 'next' value of the previous page")
 
 daily_parser = api.parser()
 daily_parser.add_argument("date", required=True, dest="date", location="args",
@@ -124,6 +180,8 @@ daily_list_parser.add_argument("window", required=False, type=int, default=0,
 daily_list_parser.add_argument("backward", required=False, type=inputs.boolean,
                                default=True, dest="backward", location="args",
                                help="Backward window of days or not?")
+daily_list_parser.add_argument("cursor", required=False, dest='cursor', location='args',
+                               help="Page cursor, the 'next' value of the previous page")
 
 timeseries_parser = api.parser()
 timeseries_parser.add_argument("start", required=True, dest="start", location="args",
@@ -142,6 +200,13 @@ predict_parser.add_argument("current", required=False, type=inputs.boolean, defa
 predict_parser.add_argument("predict_values", type=int,
                             dest="values_num", default=3, location="args",
                             help="Number of predict values")
+predict_parser.add_argument("freq", required=False, default='1H', dest="freq",
+                            location="args", help="Prediction horizon, e.g. '30T' or '1H'")
+
+predict_list_parser = station_list_parser.copy()
+predict_list_parser.add_argument("freq", required=False, default='1H', dest="freq",
+                                 location="args",
+                                 help="Prediction horizon, e.g. '30T' or '1H'")
 
 hourly_profile_parser = api.parser()
 hourly_profile_parser.add_argument("date", required=True, dest="date", location="args",
@@ -155,12 +220,200 @@ daily_profile_parser.add_argument("date", required=True, dest="date", location="
 daily_profile_parser.add_argument("window", required=False, type=int, default=30, dest="window",
                                   location="args", help="How many backward days?")
 
+nearest_parser = api.parser()
+nearest_parser.add_argument("lon", required=True, type=float, dest="lon",
+                            location="args", help="Longitude")
+nearest_parser.add_argument("lat", required=True, type=float, dest="lat",
+                            location="args", help="Latitude")
+nearest_parser.add_argument("n", required=False, type=int, default=5, dest="n",
+                            location="args", help="Number of stations")
+nearest_parser.add_argument("min_bikes", required=False, type=int, default=0,
+                            dest="min_bikes", location="args",
+                            help="Minimum number of available bikes")
+
+within_parser = api.parser()
+within_parser.add_argument("bbox", required=True, dest="bbox", location="args",
+                           help="Bounding box 'xmin,ymin,xmax,ymax' (lon/lat)")
+within_parser.add_argument("min_bikes", required=False, type=int, default=0,
+                           dest="min_bikes", location="args",
+                           help="Minimum number of available bikes")
+
+heatmap_parser = api.parser()
+heatmap_parser.add_argument("resolution", required=False, type=int, default=8,
+                            choices=sorted(RESOLUTIONS), dest="resolution",
+                            location="args", help="Size of the hexagonal cells")
+heatmap_parser.add_argument("start", required=False, dest="start", location="args",
+                            help="Start date YYYY-MM-DDThhmm, latest frame if missing")
+heatmap_parser.add_argument("stop", required=False, dest="stop", location="args",
+                            help="Stop date YYYY-MM-DDThhmm, for an animation")
+
+export_parser = api.parser()
+export_parser.add_argument("start", required=True, dest="start", location="args",
+                           help="Start date YYYY-MM-DD")
+export_parser.add_argument("stop", required=True, dest="stop", location="args",
+                           help="Stop date YYYY-MM-DD (excluded)")
+export_parser.add_argument("format", required=False, default='parquet',
+                           choices=sorted(export.FORMATS), dest="format",
+                           location="args", help="'parquet' or 'csv' (gzip)")
+export_parser.add_argument("ids", required=False, dest="ids", location="args",
+                           help="Station ids separated by a ',', all of them by default")
+
+forecast_parser = api.parser()
+forecast_parser.add_argument("ids", required=False, dest="ids", location="args",
+                             help="Station ids separated by a ',', all of them by default")
+forecast_parser.add_argument("horizons", required=False, dest="horizons", location="args",
+                             help=("Prediction frequencies separated by a ',', e.g. '30T', "
+                                   "all the ones with an active model by default"))
+
+query_stats_parser = api.parser()
+query_stats_parser.add_argument("sort", required=False, default='total', dest="sort",
+                                location="args",
+                                help="Sort by 'total', 'calls', 'mean', 'p95', 'max' or 'rows'")
+query_stats_parser.add_argument("limit", required=False, type=int, default=20, dest="limit",
+                                location="args", help="Limit")
+
 clustering_parser = api.parser()
 clustering_parser.add_argument("geojson", required=False, type=inputs.boolean,
                                default=False, dest='geojson', location='args',
                                help='GeoJSON format?')
 
 
+@contextmanager
+def invalid_cursor():
+    """Abort with a 400 status if the page cursor cannot be decoded
+    """
+    try:
+        yield
+    except InvalidCursor as e:
+        api.abort(400, str(e))
+
+
+# Resources, shared by the routes and by the batch endpoint. Each function
+# takes the city, the station ids (None for the lists of stations) and the
+# parsed arguments of its parser.
+BatchResource = namedtuple('BatchResource', ['func', 'parser', 'with_ids'])
+BATCH_RESOURCES = {}
+
+
+def batch_resource(name, parser=None, with_ids=True):
+    """Register a resource which can be fetched by the batch endpoint
+    """
+    def decorator(func):
+        BATCH_RESOURCES[name] = BatchResource(func, parser, with_ids)
+        return func
+    return decorator
+
+
+@batch_resource('availability', station_list_parser, with_ids=False)
+def availability_list(city, ids, args):
+    with invalid_cursor():
+        return controller.latest_availability(city, args['limit'], args['geojson'],
+                                              args['cursor'])
+
+
+@batch_resource('stations', station_list_parser, with_ids=False)
+def station_list(city, ids, args):
+    with invalid_cursor():
+        return controller.stations(city, args['limit'], args['geojson'], args['cursor'])
+
+
+@batch_resource('heatmap', heatmap_parser, with_ids=False)
+def city_heatmap(city, ids, args):
+    start = parse_timestamp(args['start']) if args['start'] else None
+    stop = parse_timestamp(args['stop']) if args['stop'] else None
+    if stop is not None and start is None:
+        api.abort(400, "'stop' parameter without 'start'")
+    if stop is not None and not timedelta(0) <= stop - start <= MAX_HEATMAP_RANGE:
+        api.abort(400, "'stop' should be after 'start', within {}".format(MAX_HEATMAP_RANGE))
+    return controller.heatmap(city, args['resolution'], start, stop)
+
+
+@batch_resource('station')
+def station_info(city, ids, args):
+    rset = controller.specific_stations(city, ids)
+    if not rset:
+        api.abort(404, "No such id: {}".format(ids))
+    return rset
+
+
+@batch_resource('daily', daily_parser)
+def station_daily(city, ids, args):
+    day = parse_date(args['date'])
+    rset = controller.daily_transaction(city, ids, day, args['window'],
+                                        args['backward'])
+    if not rset:
+        api.abort(404, "No such data for id: {} at {}".format(ids, day))
+    return rset
+
+
+@batch_resource('daily_list', daily_list_parser, with_ids=False)
+def daily_list(city, ids, args):
+    day = parse_date(args['date'])
+    order_by = args['order_by']
+    if order_by not in ('station', 'value'):
+        api.abort(400, "wrong 'by' value parameter. Should be 'station' of 'value'")
+    with invalid_cursor():
+        return controller.daily_transaction_list(city, day, args['limit'], order_by,
+                                                 args['window'], args['backward'],
+                                                 args['cursor'])
+
+
+@batch_resource('timeseries', timeseries_parser)
+def station_timeseries(city, ids, args):
+    start = parse_timestamp(args['start'])
+    stop = parse_timestamp(args['stop'])
+    rset = controller.timeseries(city, ids, start, stop)
+    if not rset:
+        api.abort(404, "No such data for id: {} between {} and {}".format(ids, start, stop))
+    return rset
+
+
+@batch_resource('prediction', predict_parser)
+def station_prediction(city, ids, args):
+    start = parse_timestamp(args['start'])
+    stop = parse_timestamp(args['stop'])
+    rset = controller.prediction_timeseries(
+        city, ids, start, stop, args['values_num'], args['current'], args['freq'])
+    if not rset:
+        api.abort(404, "No such prediction data for id: {} between {} and {}".format(ids, start, stop))
+    return rset
+
+
+@batch_resource('prediction_list', predict_list_parser, with_ids=False)
+def prediction_list(city, ids, args):
+    return controller.latest_predictions(city, args['limit'], args['geojson'],
+                                         freq=args['freq'])
+
+
+@batch_resource('forecast', forecast_parser, with_ids=False)
+def city_forecast(city, ids, args):
+    ids = args['ids'].split(',') if args['ids'] else None
+    horizons = args['horizons'].split(',') if args['horizons'] else None
+    rset = controller.forecast(city, ids, horizons)
+    if rset is None:
+        api.abort(404, "No active prediction model for the horizons: {}".format(
+            horizons or 'all'))
+    return rset
+
+
+@batch_resource('hourly_profile', hourly_profile_parser)
+def station_hourly_profile(city, ids, args):
+    day = parse_date(args['date'])
+    rset = controller.hourly_profile(city, ids, day, args['window'])
+    if not rset:
+        api.abort(404, "No such data for id: {} for {}".format(ids, day))
+    return rset
+
+
+@batch_resource('daily_profile', daily_profile_parser)
+def station_daily_profile(city, ids, args):
+    day = parse_date(args['date'])
+    rset = controller.daily_profile(city, ids, day, args['window'])
+    if not rset:
+        api.abort(404, "No such data for id: {} for {}".format(ids, day))
+    return rset
+
+
 @api.route("/city")
 class City(Resource):
     @api.doc("List of cities")
@@ -168,16 +421,47 @@ class City(Resource):
         return jsonify(controller.cities())
 
 
+@api.route("/coalescing")
+class Coalescing(Resource):
+    @api.doc("Number of calls, executed and avoided computations by coalesced function")
+    def get(self):
+        return jsonify(coalesce.stats())
+
+
+@api.route("/admin/queries")
+class AdminQueryStats(Resource):
+    @api.doc(parser=query_stats_parser,
+             description="SQL statements statistics by fingerprint and latest slow statements")
+    def get(self):
+        check_admin()
+        args = query_stats_parser.parse_args()
+        if args['sort'] not in ('total', 'calls', 'mean', 'p95', 'max', 'rows'):
+            api.abort(400, "wrong 'sort' value parameter")
+        return jsonify({"data": iodb.query_stats.summary(args['sort'])[:args['limit']],
+                        "slow": iodb.query_stats.slow()})
+
+
+@api.route("/admin/queries/slow/<int:slow_id>/explain")
+class AdminExplainSlowQuery(Resource):
+    @api.doc(description="Plan of a slow statement with EXPLAIN (ANALYZE, BUFFERS)")
+    def get(self, slow_id):
+        check_admin()
+        try:
+            plan = iodb.explain(slow_id)
+        except ValueError as e:
+            api.abort(400, str(e))
+        if plan is None:
+            api.abort(404, "No such slow query: {}".format(slow_id))
+        return jsonify({"id": slow_id, "plan": plan})
+
+
 @api.route("/<string:city>/station")
 class CityStationList(Resource):
     @api.doc(parser=station_list_parser,
              description="Bicycle-sharing stations")
     def get(self, city):
         check_city(city)
-        args = station_list_parser.parse_args()
-        limit = args['limit']
-        geojson = args['geojson']
-        return jsonify(controller.latest_availability(city, limit, geojson))
+        return jsonify(availability_list(city, None, station_list_parser.parse_args()))
 
 
 @api.route("/<string:city>/infostation")
@@ -186,10 +470,7 @@ class CityInfoStationList(Resource):
              description="Bicycle-sharing stations")
     def get(self, city):
         check_city(city)
-        args = station_list_parser.parse_args()
-        limit = args['limit']
-        geojson = args['geojson']
-        return jsonify(controller.stations(city, limit, geojson))
+        return jsonify(station_list(city, None, station_list_parser.parse_args()))
 
 
 @api.route("/<string:city>/station/<list:ids>")
@@ -197,10 +478,7 @@ class CityStation(Resource):
     @api.doc(description="Bicycle station(s)")
     def get(self, city, ids):
         check_city(city)
-        rset = controller.specific_stations(city, ids)
-        if not rset:
-            api.abort(404, "No such id: {}".format(ids))
-        return jsonify(rset)
+        return jsonify(station_info(city, ids, None))
 
 
 @api.route("/<string:city>/daily/station/<list:ids>")
@@ -209,13 +487,7 @@ class CityDailyStation(Resource):
              description="Bicycle station(s) daily transactions")
     def get(self, city, ids):
         check_city(city)
-        args = daily_parser.parse_args()
-        day = parse_date(args['date'])
-        rset = controller.daily_transaction(city, ids, day, args['window'],
-                                            args['backward'])
-        if not rset:
-            api.abort(404, "No such data for id: {} at {}".format(ids, day))
-        return jsonify(rset)
+        return jsonify(station_daily(city, ids, daily_parser.parse_args()))
 
 
 @api.route("/<string:city>/daily/station")
@@ -224,15 +496,7 @@ class CityDailyStationList(Resource):
              description="Daily transactions for all stations")
     def get(self, city):
         check_city(city)
-        args = daily_list_parser.parse_args()
-        day = parse_date(args['date'])
-        limit = args['limit']
-        order_by = args['order_by']
-        if order_by not in ('station', 'value'):
-            api.abort(400, "wrong 'by' value parameter. Should be 'station' of 'value'")
-        rset = controller.daily_transaction_list(city, day, limit, order_by,
-                                                 args['window'], args['backward'])
-        return jsonify(rset)
+        return jsonify(daily_list(city, None, daily_list_parser.parse_args()))
 
 
 @api.route("/<string:city>/timeseries/station/<list:ids>")
@@ -241,13 +505,7 @@ class CityTimeseriesStation(Resource):
              description="Bicycle station(s) timeseries")
     def get(self, city, ids):
         check_city(city)
-        args = timeseries_parser.parse_args()
-        start = parse_timestamp(args['start'])
-        stop = parse_timestamp(args['stop'])
-        rset = controller.timeseries(city, ids, start, stop)
-        if not rset:
-            api.abort(404, "No such data for id: {} between {} and {}".format(ids, start, stop))
-        return jsonify(rset)
+        return jsonify(station_timeseries(city, ids, timeseries_parser.parse_args()))
 
 
 @api.route("/<string:city>/predict/station/<list:ids>")
@@ -256,44 +514,347 @@ class PredictStation(Resource):
              description="Bicycle station(s) prediction")
     def get(self, city, ids):
         check_city(city)
-        args = predict_parser.parse_args()
-        start = parse_timestamp(args['start'])
-        stop = parse_timestamp(args['stop'])
-        values_num = args['values_num']
-        with_current_values = args['current']
-        rset = controller.prediction_timeseries(
-            city, ids, start, stop, values_num, with_current_values)
-        if not rset:
-            api.abort(404, "No such prediction data for id: {} between {} and {}".format(ids, start, stop))
-        return jsonify(rset)
+        return jsonify(station_prediction(city, ids, predict_parser.parse_args()))
 
 
 @api.route("/<string:city>/predict/station")
 class PredictStationList(Resource):
-    @api.doc(parser=station_list_parser,
+    @api.doc(parser=predict_list_parser,
              description="Bicycle stations prediction")
     def get(self, city):
         check_city(city)
-        args = station_list_parser.parse_args()
-        limit = args['limit']
-        geojson = args['geojson']
-        rset = controller.latest_predictions(city, limit, geojson, freq='1H')
+        return jsonify(prediction_list(city, None, predict_list_parser.parse_args()))
+
+
+@api.route("/<string:city>/forecast")
+class CityForecast(Resource):
+    @api.doc(parser=forecast_parser,
+             description=("Bike availability forecasts of the latest availability, "
+                          "computed on demand by the active models"))
+    def get(self, city):
+        check_city(city)
+        return jsonify(city_forecast(city, None, forecast_parser.parse_args()))
+
+
+@api.route("/<string:city>/nearest/station")
+class CityNearestStation(Resource):
+    @api.doc(parser=nearest_parser,
+             description="Nearest bicycle stations with some available bikes")
+    def get(self, city):
+        check_city(city)
+        args = nearest_parser.parse_args()
+        if args['n'] <= 0:
+            api.abort(400, "wrong 'n' value parameter. Should be positive")
+        rset = controller.nearest_stations(city, args['lon'], args['lat'],
+                                           args['n'], args['min_bikes'])
         return jsonify(rset)
 
 
+@api.route("/<string:city>/within/station")
+class CityWithinStation(Resource):
+    @api.doc(parser=within_parser,
+             description="Bicycle stations within a bounding box")
+    def get(self, city):
+        check_city(city)
+        args = within_parser.parse_args()
+        try:
+            xmin, ymin, xmax, ymax = [float(x) for x in args['bbox'].split(',')]
+        except ValueError as e:
+            api.abort(422, "bbox from the request cannot be parsed: {}".format(e))
+        rset = controller.stations_within(city, xmin, ymin, xmax, ymax,
+                                          args['min_bikes'])
+        return jsonify(rset)
+
+
+@api.route("/<string:city>/heatmap")
+class CityHeatmap(Resource):
+    @api.doc(parser=heatmap_parser,
+             description=("Bikes, stands and transactions by hexagonal cell, for the "
+                          "latest time bucket or each bucket between 'start' and 'stop'"))
+    def get(self, city):
+        check_city(city)
+        args = heatmap_parser.parse_args()
+        return jsonify(city_heatmap(city, None, args))
+
+
+@api.route("/<string:city>/stream")
+class CityStream(Resource):
+    @api.doc(description=("Live bike availability as server-sent events: a 'snapshot' "
+                          "event then a 'delta' event by ingestion tick with the "
+                          "[id, nb_bikes, nb_stands] of the changed stations"))
+    def get(self, city):
+        check_city(city)
+        broadcaster, subscription = controller.availability_stream(city)
+
+        def events():
+            try:
+                yield "retry: 10000\n\n"
+                while True:
+                    event = subscription.get(timeout=HEARTBEAT)
+                    if event is None:
+                        yield ": keep-alive\n\n"
+                    else:
+                        yield stream.format_event(event)
+            finally:
+                broadcaster.unsubscribe(subscription)
+
+        return flask.Response(events(), mimetype='text/event-stream',
+                              headers={'Cache-Control': 'no-cache',
+                                       'X-Accel-Buffering': 'no'})
+
+
+@api.route("/<string:city>/tiles/<int:z>/<int:x>/<int:y>.mvt")
+class CityStationTile(Resource):
+    @api.doc(description=("Vector tile (MVT) of the stations with their latest "
+                          "availability and cluster, layer 'stations'"))
+    def get(self, city, z, x, y):
+        check_city(city)
+        try:
+            tile = controller.station_tile(city, z, x, y)
+        except ValueError as e:
+            api.abort(404, str(e))
+        return flask.Response(tile, mimetype='application/vnd.mapbox-vector-tile',
+                              headers={'Cache-Control': 'public, max-age=60'})
+
+
+class BatchArguments:
+    """Request-like object with the arguments of a sub-request, for the parsers
+    """
+    def __init__(self, args):
+        self.args = MultiDict(args)
+
+
+def _batch_error(subrequest_id, exc):
+    data = getattr(exc, 'data', {})
+    response = {"id": subrequest_id, "status": exc.code,
+                "message": data.get('message', exc.description)}
+    if 'errors' in data:
+        response['errors'] = data['errors']
+    return response
+
+
+def _station_cache(city, subrequests):
+    """Stations of all the sub-requests, fetched with a single query
+
+    Returns
+    -------
+    dict
+        station id -> station
+    """
+    ids = set()
+    for subrequest in subrequests:
+        resource = BATCH_RESOURCES.get(subrequest.get('resource'))
+        if resource is not None and resource.with_ids:
+            ids.update(str(x) for x in subrequest.get('ids') or [])
+    if not ids:
+        return {}
+    rset = controller.specific_stations(city, sorted(ids))
+    return {str(x['id']): x for x in rset["data"]} if rset else {}
+
+
+def _prepare_subrequest(city, subrequest, stations):
+    """Parse a sub-request and return the function which computes its result
+    """
+    resource = BATCH_RESOURCES.get(subrequest.get('resource'))
+    if resource is None:
+        api.abort(400, "Unknown resource '{}'".format(subrequest.get('resource')))
+    args = None
+    if resource.parser is not None:
+        args = resource.parser.parse_args(req=BatchArguments(subrequest.get('args') or {}))
+    ids = None
+    if resource.with_ids:
+        ids = [str(x) for x in subrequest.get('ids') or []]
+        known = [x for x in ids if x in stations]
+        if not known:
+            api.abort(404, "No such id: {}".format(ids))
+        if resource.func is station_info:
+            # served by the station cache
+            return lambda: {"data": [stations[x] for x in known]}
+    return lambda: resource.func(city, ids, args)
+
+
+def _run_subrequest(subrequest_id, func):
+    with app.app_context():
+        try:
+            data = func()
+            if isinstance(data, controller.RawJSON):
+                # embedded in the batch response
+                data = json.loads(data)
+            return {"id": subrequest_id, "status": 200, "data": data}
+        except HTTPException as e:
+            return _batch_error(subrequest_id, e)
+        except Exception:
+            logger.exception("batch sub-request '%s' failed", subrequest_id)
+            return {"id": subrequest_id, "status": 500, "message": "Internal error"}
+
+
+def run_batch(city, subrequests):
+    """Results of the sub-requests, computed concurrently
+
+    Parameters
+    ----------
+    city : str
+    subrequests : list of dicts
+        With the keys 'id' (optional), 'resource' (see BATCH_RESOURCES), 'ids'
+        (station ids) and 'args' (the arguments of the resource route)
+
+    Returns
+    -------
+    list of dicts
+        One response by sub-request, in the same order, with the keys 'id',
+        'status' and 'data' (or 'message' for an error)
+    """
+    stations = _station_cache(city, subrequests)
+    responses = [None] * len(subrequests)
+    futures = {}
+    for i, subrequest in enumerate(subrequests):
+        subrequest_id = subrequest.get('id', i)
+        try:
+            func = _prepare_subrequest(city, subrequest, stations)
+        except HTTPException as e:
+            responses[i] = _batch_error(subrequest_id, e)
+            continue
+        futures[i] = BATCH_EXECUTOR.submit(metrics.propagate(_run_subrequest),
+                                           subrequest_id, func)
+    for i, future in futures.items():
+        responses[i] = future.result()
+    return responses
+
+
+@api.route("/<string:city>/batch")
+class CityBatch(Resource):
+    @api.doc(description=("Several resources in one round trip: the JSON body is "
+                          "{'requests': [{'id': ..., 'resource': ..., 'ids': [...], "
+                          "'args': {...}}, ...]}"))
+    def post(self, city):
+        check_city(city)
+        payload = flask.request.get_json(silent=True) or {}
+        subrequests = payload.get('requests')
+        if not isinstance(subrequests, list) or not subrequests \
+           or not all(isinstance(x, dict) for x in subrequests):
+            api.abort(400, "A non-empty list of 'requests' is expected")
+        if len(subrequests) > MAX_BATCH_SIZE:
+            api.abort(400, "Too many requests: {} (max {})".format(len(subrequests),
+                                                                 MAX_BATCH_SIZE))
+        return jsonify({"responses": run_batch(city, subrequests)})
+
+
+def _job_writer(func):
+    """Job function which writes the JSON result of a resource into a file
+    """
+    def write(path):
+        with app.app_context():
+            try:
+                data = func()
+            except HTTPException as e:
+                raise jobs.JobError(_batch_error(None, e)['message'], e.code)
+        with open(path, 'w') as fobj:
+            if isinstance(data, controller.RawJSON):
+                fobj.write(data)
+            else:
+                json.dump(data, fobj, cls=CustomJSONEncoder)
+    return write
+
+
+def job_status(city, status):
+    """Job status sent to the client, with the URLs of the job and its result
+    """
+    response = {k: status[k] for k in ('id', 'status', 'resource', 'size', 'error', 'code')
+                if k in status}
+    for key in ('submitted', 'finished'):
+        if key in status:
+            response[key] = datetime.fromtimestamp(status[key])
+    response['url'] = api.url_for(CityJob, city=city, job_id=status['id'])
+    if status['status'] == jobs.DONE:
+        response['result'] = api.url_for(CityJobResult, city=city, job_id=status['id'])
+    return response
+
+
+@api.route("/<string:city>/jobs")
+class CityJobs(Resource):
+    @api.doc(description=("Asynchronous computation of a resource: the JSON body is "
+                          "{'resource': ..., 'ids': [...], 'args': {...}} as a sub-request "
+                          "of the batch endpoint. Identical jobs are shared"))
+    def post(self, city):
+        check_city(city)
+        subrequest = flask.request.get_json(silent=True)
+        if not isinstance(subrequest, dict):
+            api.abort(400, "A JSON object with a 'resource' is expected")
+        func = _prepare_subrequest(city, subrequest, _station_cache(city, [subrequest]))
+        key = ('resource', city, subrequest.get('resource'),
+               sorted(str(x) for x in subrequest.get('ids') or []),
+               subrequest.get('args') or {})
+        status = JOBS.submit(key, _job_writer(func), resource=subrequest['resource'],
+                             city=city)
+        response = jsonify(job_status(city, status))
+        response.status_code = 202
+        return response
+
+
+@api.route("/<string:city>/export")
+class CityExport(Resource):
+    @api.doc(parser=export_parser,
+             description=("Bulk export of the bike availability as an asynchronous job, "
+                          "whose result is a Parquet or gzip CSV file"))
+    def post(self, city):
+        check_city(city)
+        args = export_parser.parse_args()
+        start, stop = parse_date(args['start']), parse_date(args['stop'])
+        if stop <= start:
+            api.abort(400, "'stop' should be after 'start'")
+        ids = sorted(args['ids'].split(',')) if args['ids'] else None
+        extension, mimetype = export.FORMATS[args['format']]
+        download = "{}-timeseries-{}-to-{}.{}".format(city, start, stop, extension)
+
+        def write(path):
+            export.export(city, start, stop, path, args['format'], ids)
+
+        status = JOBS.submit(('export', city, start, stop, args['format'], ids), write,
+                             extension, mimetype, resource='export', city=city,
+                             download=download)
+        response = jsonify(job_status(city, status))
+        response.status_code = 202
+        return response
+
+
+def _get_job(city, job_id):
+    status = JOBS.status(job_id)
+    if status is None or status.get('city') != city:
+        api.abort(404, "No such job: {}".format(job_id))
+    return status
+
+
+@api.route("/<string:city>/jobs/<string:job_id>")
+class CityJob(Resource):
+    @api.doc(description="Status of an asynchronous job: pending, running, done or failed")
+    def get(self, city, job_id):
+        check_city(city)
+        return jsonify(job_status(city, _get_job(city, job_id)))
+
+
+@api.route("/<string:city>/jobs/<string:job_id>/result")
+class CityJobResult(Resource):
+    @api.doc(description="Result of a done asynchronous job")
+    def get(self, city, job_id):
+        check_city(city)
+        status = _get_job(city, job_id)
+        if status['status'] == jobs.FAILED:
+            api.abort(status['code'], status['error'])
+        if status['status'] != jobs.DONE:
+            api.abort(409, "Job {} is {}".format(job_id, status['status']))
+        return flask.send_file(os.path.abspath(JOBS.result_path(status)),
+                               mimetype=status['mimetype'], conditional=True,
+                               as_attachment='download' in status,
+                               attachment_filename=status.get('download'))
+
+
 @api.route("/<string:city>/profile/hourly/station/<list:ids>")
 class CityHourlyStation(Resource):
     @api.doc(parser=hourly_profile_parser,
              description="Bicycle station(s) hourly profile")
     def get(self, city, ids):
         check_city(city)
-        args = hourly_profile_parser.parse_args()
-        day = parse_date(args['date'])
-        window = args['window']
-        rset = controller.hourly_profile(city, ids, day, window)
-        if not rset:
-            api.abort(404, "No such data for id: {} for {}".format(ids, day))
-        return jsonify(rset)
+        return jsonify(station_hourly_profile(city, ids, hourly_profile_parser.parse_args()))
 
 
 @api.route("/<string:city>/profile/daily/station/<list:ids>")
@@ -302,13 +863,7 @@ class CityDailyStation(Resource):
              description="Bicycle station(s) daily profile")
     def get(self, city, ids):
         check_city(city)
-        args = daily_profile_parser.parse_args()
-        day = parse_date(args['date'])
-        window = args['window']
-        rset = controller.daily_profile(city, ids, day, window)
-        if not rset:
-            api.abort(404, "No such data for id: {} for {}".format(ids, day))
-        return jsonify(rset)
+        return jsonify(station_daily_profile(city, ids, daily_profile_parser.parse_args()))
 
 
 @api.route("/<string:city>/clustering/stations")
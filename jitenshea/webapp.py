@@ -7,6 +7,8 @@ import daiquiri
 
 from flask import Flask, render_template, abort
 
+from jitenshea import config, metrics
+
 
 logger = daiquiri.getLogger("jitenshea-webapp")
 
@@ -14,6 +16,15 @@ app = Flask(__name__)
 app.config['ERROR_404_HELP'] = False
 app.config['SWAGGER_UI_DOC_EXPANSION'] = 'list'
 
+
+def _server_timing():
+    if config is None or not config.has_section('metrics'):
+        return False
+    return config['metrics'].getboolean('server_timing', fallback=False)
+
+
+metrics.install(app, with_server_timing=_server_timing())
+
 CITIES = ['bordeaux', 'lyon']
 CITIES_DESC = [{
                     'id': 'bordeaux',
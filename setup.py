@@ -9,7 +9,7 @@ with open("README.md") as fobj:
 INSTALL_REQUIRES = ["luigi", "numpy", "pandas", "requests", "psycopg2-binary",
                     'sqlalchemy', 'lxml', 'xgboost', 'daiquiri', 'Flask==1.0.2',
                     'flask-restplus==0.12.1', 'sh', 'seaborn', 'scikit-learn',
-                    'tables']
+                    'tables', 'pyarrow']
 
 
 setuptools.setup(
@@ -18,3 +18,28 @@ CREATE INDEX idx_lyon_transaction_date ON lyon.daily_transaction(date);
 
 
 
+
+
+-- nearest stations and bounding box queries (KNN with PostGIS)
+CREATE INDEX IF NOT EXISTS idx_bordeaux_station_geom ON bordeaux.station USING gist(geom);
+CREATE INDEX IF NOT EXISTS idx_lyon_station_geom ON lyon.station USING gist(geom);
+
+-- latest availability of a station
+CREATE INDEX IF NOT EXISTS idx_bordeaux_timeseries_id_ts ON bordeaux.timeseries(id, timestamp DESC);
+CREATE INDEX IF NOT EXISTS idx_lyon_timeseries_id_ts ON lyon.timeseries(id, timestamp DESC);
+
+-- latest predictions of a station
+CREATE INDEX IF NOT EXISTS idx_bordeaux_prediction_station_freq_ts ON bordeaux.prediction(station_id, frequency, timestamp DESC);
+CREATE INDEX IF NOT EXISTS idx_lyon_prediction_station_freq_ts ON lyon.prediction(station_id, frequency, timestamp DESC);
+
+-- keyset pagination of the stations and of the daily transactions
+CREATE INDEX IF NOT EXISTS idx_bordeaux_station_id ON bordeaux.station(id);
+CREATE INDEX IF NOT EXISTS idx_lyon_station_id ON lyon.station(id);
+CREATE INDEX IF NOT EXISTS idx_bordeaux_transaction_date_number_id ON bordeaux.daily_transaction(date, number DESC, id);
+CREATE INDEX IF NOT EXISTS idx_lyon_transaction_date_number_id ON lyon.daily_transaction(date, number DESC, id);
+CREATE INDEX IF NOT EXISTS idx_bordeaux_transaction_date_id ON bordeaux.daily_transaction(date, id);
+CREATE INDEX IF NOT EXISTS idx_lyon_transaction_date_id ON lyon.daily_transaction(date, id);
+
+-- bulk exports of the availability by date range
+CREATE INDEX IF NOT EXISTS idx_bordeaux_timeseries_ts_id ON bordeaux.timeseries(timestamp, id);
+CREATE INDEX IF NOT EXISTS idx_lyon_timeseries_ts_id ON lyon.timeseries(timestamp, id);
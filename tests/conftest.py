@@ -0,0 +1,78 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import pytest
+
+import xgboost as xgb
+
+from jitenshea import features
+from jitenshea.stats import build_features
+
+
+DAYS = ('2018-01-01', '2018-01-02', '2018-01-03')
+
+
+def make_availability(day, shift=0):
+    """Availability of two stations every 10 minutes of `day`, the number of
+    bikes changing every hour
+    """
+    ts = pd.date_range(day, periods=6 * 24, freq='10min')
+    bikes = (np.arange(len(ts)) // 6 + shift) % 10
+    return pd.DataFrame({"station_id": np.repeat([1, 2], len(ts)),
+                         "ts": np.tile(ts, 2),
+                         "nb_bikes": np.tile(bikes, 2),
+                         "nb_stands": np.tile(10 - bikes, 2),
+                         "probability": np.tile(bikes / 10, 2)})
+
+
+@pytest.fixture
+def availability():
+    """Factory of the availability of a day, see `make_availability`
+    """
+    return make_availability
+
+
+@pytest.fixture
+def feature_partitions(tmpdir):
+    """Factory of feature partitions, one by day, in a directory of `tmpdir`
+    """
+    def factory(directory='features', days=DAYS, shift=0):
+        pytest.importorskip('pyarrow')
+        directory = str(tmpdir.join(directory))
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for day in days:
+            paths.append(os.path.join(directory, '{}.parquet'.format(day)))
+            features.write_partition(build_features(make_availability(day, shift), '10min'),
+                                     paths[-1])
+        return paths
+    return factory
+
+
+def make_model_features():
+    """Features of three stations, with the columns of the prediction model
+    """
+    return pd.DataFrame({'station_id': [1, 2, 3], 'nb_bikes': [1., 5., 9.],
+                         'nb_stands': [9., 5., 1.], 'day': [0, 1, 2], 'hour': [8, 12, 18],
+                         'minute': [0, 10, 20]})
+
+
+@pytest.fixture
+def model_features():
+    return make_model_features()
+
+
+@pytest.fixture
+def save_model():
+    """Factory of model files, trained to predict the constant `value`
+    """
+    def factory(path, value):
+        dtrain = xgb.DMatrix(make_model_features(), label=np.full(3, value))
+        booster = xgb.train({'objective': 'reg:logistic', 'nthread': 1}, dtrain, 2)
+        # in the format of the '.model' files, without the warning of xgboost
+        # about the default format
+        with open(path, 'wb') as fobj:
+            fobj.write(booster.save_raw('ubj'))
+    return factory
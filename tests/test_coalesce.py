@@ -0,0 +1,102 @@
+import os
+import time
+import threading
+
+import pytest
+
+from jitenshea.coalesce import SingleFlight, coalesce, private_dir, sweep
+
+
+def test_concurrent_calls_share_one_computation():
+    group = SingleFlight('test')
+    calls = []
+
+    def slow(x):
+        calls.append(x)
+        time.sleep(0.1)
+        return {'value': x}
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(group.do('key', slow, 42)))
+               for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert calls == [42]
+    assert all(result == {'value': 42} for result in results)
+    # each caller gets its own copy
+    results[0]['value'] = 0
+    assert all(result == {'value': 42} for result in results[1:])
+    stats = group.stats()
+    assert stats['calls'] == 8
+    assert stats['executed'] == 1
+    assert stats['avoided'] == 7
+
+
+def test_sequential_calls_are_not_coalesced():
+    @coalesce
+    def double(x):
+        return 2 * x
+
+    assert double(2) == 4
+    assert double(x=2) == 4
+    assert double.group.stats()['executed'] == 2
+
+
+def test_error_is_raised_to_every_caller():
+    group = SingleFlight('error')
+
+    def fail():
+        time.sleep(0.05)
+        raise ValueError("no data")
+
+    errors = []
+
+    def call():
+        try:
+            group.do('key', fail)
+        except ValueError as exc:
+            errors.append(exc)
+
+    threads = [threading.Thread(target=call) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 4
+    assert group.stats()['errors'] == 1
+    # the failed call is not kept in flight
+    with pytest.raises(ValueError):
+        group.do('key', fail)
+
+
+def test_handover_directory(tmpdir):
+    with pytest.raises(ValueError):
+        SingleFlight('handover', advisory_lock=True)
+    shared = str(tmpdir.join('shared'))
+    group = SingleFlight('handover', advisory_lock=True, shared_dir=shared)
+    path = group._handover_path(-42)
+    assert os.stat(shared).st_mode & 0o777 == 0o700
+    since = time.time() - 1
+    assert group.read_handover(path, since) is None
+    group.write_handover(path, {'value': 42})
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    assert group.read_handover(path, since) == ({'value': 42},)
+    # written before the call
+    assert group.read_handover(path, time.time() + 10) is None
+    os.chmod(shared, 0o777)
+    with pytest.raises(PermissionError):
+        private_dir(shared)
+
+
+def test_sweep_handover_files(tmpdir):
+    shared = private_dir(str(tmpdir.join('shared')))
+    group = SingleFlight('sweep', advisory_lock=True, shared_dir=shared)
+    old, new = group._handover_path(1), group._handover_path(2)
+    for path in (old, new, old + '.1234'):
+        group.write_handover(path, [])
+    for path in (old, old + '.1234'):
+        os.utime(path, (time.time() - 120, time.time() - 120))
+    assert sweep(shared) == 2
+    assert os.listdir(shared) == [os.path.basename(new)]
@@ -0,0 +1,96 @@
+import numpy as np
+import pandas as pd
+
+import pytest
+
+from jitenshea.cube import CubeAccumulator, StationCube, bucket_size
+
+
+def availability():
+    return pd.DataFrame({
+        "station_id": [2, 1, 1, 1, 2, 1],
+        "ts": pd.to_datetime(['2018-01-01 08:12', '2018-01-01 08:01', '2018-01-01 08:04',
+                              '2018-01-01 08:31', '2018-01-01 08:45', '2018-01-01 08:07']),
+        "nb_bikes": [4., 2., 4., 6., 8., 9.],
+        "nb_stands": [6., 8., 6., 4., 2., 1.]})
+
+
+def test_bucket_size():
+    assert bucket_size('10T') == pd.Timedelta(minutes=10)
+    assert bucket_size('10min') == pd.Timedelta(minutes=10)
+    assert bucket_size('1H') == pd.Timedelta(hours=1)
+    assert bucket_size('H') == pd.Timedelta(hours=1)
+    with pytest.raises(ValueError):
+        bucket_size('ten minutes')
+
+
+def test_from_frame():
+    cube = StationCube.from_frame(availability(), '10T')
+    assert cube.shape == (2, 5, 2)
+    assert cube.stations.tolist() == [1, 2]
+    assert cube.times[0] == pd.Timestamp('2018-01-01 08:00')
+    assert cube.variables == ['nb_bikes', 'nb_stands']
+    bikes = cube.var('nb_bikes')
+    # mean by bucket, NaN out of the range of a station
+    np.testing.assert_allclose(bikes[0], [5., np.nan, np.nan, 6., np.nan])
+    np.testing.assert_allclose(bikes[1], [np.nan, 4., np.nan, np.nan, 8.])
+    assert cube.first.tolist() == [0, 1]
+    assert cube.last.tolist() == [3, 4]
+    last = StationCube.from_frame(availability(), '10T', ['nb_bikes'], agg='last')
+    assert last.var('nb_bikes')[0, 0] == 9.
+    total = StationCube.from_frame(availability(), '10T', ['nb_bikes'], agg='sum')
+    np.testing.assert_allclose(total.var('nb_bikes')[0], [15., 0., 0., 6., np.nan])
+
+
+def test_fill_and_frame():
+    cube = StationCube.from_frame(availability(), '10T').fill('bfill')
+    np.testing.assert_allclose(cube.var('nb_bikes')[0], [5., 6., 6., 6., np.nan])
+    np.testing.assert_allclose(cube.var('nb_bikes')[1], [np.nan, 4., 8., 8., 8.])
+    df = cube.to_frame()
+    assert list(df.columns) == ['station_id', 'ts', 'nb_bikes', 'nb_stands']
+    assert df['station_id'].tolist() == [1, 1, 1, 1, 2, 2, 2, 2]
+    assert df['ts'].iloc[4] == pd.Timestamp('2018-01-01 08:10')
+    sub = cube.select(stations=cube.stations == 2, times=cube.times >= '2018-01-01 08:20')
+    assert sub.shape == (1, 3, 2)
+    assert sub.first.tolist() == [0]
+    np.testing.assert_allclose(sub.var('nb_bikes')[0], [8., 8., 8.])
+
+
+def test_profile():
+    cube = StationCube.from_frame(availability(), '10T')
+    hours, sums, means, counts = cube.profile('nb_bikes')
+    assert hours.tolist() == list(range(24))
+    assert sums[:, 8].tolist() == [11., 12.]
+    assert counts[:, 8].tolist() == [2., 2.]
+    assert means[:, 8].tolist() == [5.5, 6.]
+    assert np.isnan(means[:, 9]).all()
+
+
+def test_memory_mapped(tmpdir):
+    path = str(tmpdir.join('cube.npy'))
+    cube = StationCube.from_frame(availability(), '10T', path=path)
+    loaded = StationCube.load(path)
+    assert isinstance(loaded.data, np.memmap)
+    assert loaded.stations.tolist() == [1, 2]
+    assert loaded.origin == cube.origin and loaded.freq == cube.freq
+    np.testing.assert_array_equal(loaded.data, cube.data)
+    np.testing.assert_array_equal(loaded.in_range(), cube.in_range())
+
+
+def test_accumulator():
+    df = availability()
+    expected = StationCube.from_frame(df, '10T', start='2018-01-01 08:00',
+                                      stop='2018-01-01 08:50')
+    acc = CubeAccumulator('2018-01-01 08:00', '2018-01-01 08:50', '10T',
+                          ['nb_bikes', 'nb_stands'])
+    # by chunks of two rows, the station 2 comes first
+    for i in range(0, len(df), 2):
+        chunk = df.iloc[i:i + 2]
+        acc.add(chunk['station_id'].values, chunk['ts'].values,
+                {x: chunk[x].values for x in ('nb_bikes', 'nb_stands')})
+    cube = acc.cube()
+    assert cube.stations.tolist() == [1, 2]
+    assert cube.origin == expected.origin
+    assert cube.first.tolist() == expected.first.tolist()
+    assert cube.last.tolist() == expected.last.tolist()
+    np.testing.assert_allclose(cube.data, expected.data)
@@ -0,0 +1,47 @@
+import gzip
+from datetime import datetime
+
+import pandas as pd
+
+import pytest
+
+from jitenshea import export
+
+
+def sample_chunks():
+    for day in (1, 2):
+        df = pd.DataFrame({"id": ['1', '2'],
+                           "timestamp": [datetime(2018, 1, day, 8), datetime(2018, 1, day, 9)],
+                           "available_bikes": [3, None],
+                           "available_stands": [7, 10],
+                           "status": ['open', 'closed']}, columns=export.COLUMNS)
+        yield df.astype(export.DTYPES)
+
+
+def test_write_csv(tmpdir):
+    path = str(tmpdir.join('export.csv.gz'))
+    assert export.write_csv(sample_chunks(), path) == 4
+    with gzip.open(path, 'rt') as fobj:
+        lines = fobj.read().splitlines()
+    assert lines[0] == 'id,timestamp,available_bikes,available_stands,status'
+    assert lines[1] == '1,2018-01-01 08:00:00,3,7,open'
+    assert lines[2] == '2,2018-01-01 09:00:00,,10,closed'
+    assert len(lines) == 5
+
+
+def test_write_parquet(tmpdir):
+    pq = pytest.importorskip('pyarrow.parquet')
+    path = str(tmpdir.join('export.parquet'))
+    assert export.write_parquet(sample_chunks(), path) == 4
+    parquet = pq.ParquetFile(path)
+    # one row group by chunk
+    assert parquet.num_row_groups == 2
+    df = parquet.read().to_pandas()
+    assert list(df.columns) == export.COLUMNS
+    assert df['available_bikes'].isnull().sum() == 2
+
+
+def test_unknown_format(tmpdir):
+    with pytest.raises(ValueError):
+        export.export('lyon', datetime(2018, 1, 1), datetime(2018, 1, 2),
+                      str(tmpdir.join('export.xls')), 'xls')
@@ -0,0 +1,39 @@
+import numpy as np
+import pandas as pd
+
+from jitenshea import features
+from jitenshea.stats import build_features
+
+
+def test_build_features(availability):
+    df = build_features(availability('2018-01-01'))
+    assert list(df.columns) == ['station_id', 'ts', 'nb_bikes', 'nb_stands', 'probability',
+                                'day', 'hour', 'minute']
+    assert len(df) == 2 * 6 * 24
+    assert df['hour'].max() == 23
+
+
+def test_accumulate_chunks(availability):
+    df = availability('2018-01-01')
+    chunks = ({'station_id': x['station_id'].values.astype(np.int32),
+               'ts': x['ts'].values.astype('datetime64[ns]').astype(np.int64),
+               'nb_bikes': x['nb_bikes'].values.astype(np.int16),
+               'nb_stands': x['nb_stands'].values.astype(np.int16)}
+              for x in (df.iloc[i:i + 50] for i in range(0, len(df), 50)))
+    cube = features.accumulate(chunks, pd.Timestamp('2018-01-01'),
+                               pd.Timestamp('2018-01-02'), '10T')
+    result = build_features(cube)
+    expected = build_features(df)
+    assert result['nb_bikes'].dtype == np.float32
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+    assert features.peak_rss() > 0
+
+
+def test_partitions(tmpdir, feature_partitions):
+    path = features.partition_path(str(tmpdir), 'lyon', '10T', '2018-01-01')
+    assert path.endswith('lyon/features/10T/2018-01-01.parquet')
+    df = features.read_partitions(feature_partitions(days=('2018-01-01', '2018-01-02')))
+    assert len(df) == 2 * 2 * 6 * 24
+    assert df['nb_bikes'].dtype == np.float32
+    assert df['station_id'].tolist() == sorted(df['station_id'])
+    assert df[df['station_id'] == 1]['ts'].is_monotonic_increasing
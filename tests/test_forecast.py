@@ -0,0 +1,37 @@
+import os
+from datetime import datetime
+
+from jitenshea import controller
+from jitenshea.registry import ModelCache, ModelRegistry, model_dir
+
+
+def test_forecast(tmpdir, monkeypatch, save_model):
+    directory = model_dir('lyon', str(tmpdir))
+    os.makedirs(directory)
+    registry = ModelRegistry(directory)
+    for frequency, value in (('30T', 0.2), ('1H', 0.8)):
+        path = os.path.join(directory, '{}.model'.format(frequency))
+        save_model(path, value)
+        registry.register(path, {'frequency': frequency,
+                                 'validation': '2018-01-02T12:00:00'}, activate=True)
+    monkeypatch.setattr(controller, 'MODELS', ModelCache(str(tmpdir)))
+    monkeypatch.setattr(controller, '_FORECAST_SNAPSHOTS', {})
+    snapshot = (datetime(2018, 1, 3, 8, 14), {'1': (4, 6), '2': (10, 0), '3': (0, 0)})
+    monkeypatch.setattr(controller, '_stream_snapshot', lambda city: snapshot)
+
+    result = controller.forecast('lyon')
+    assert result['date'] == snapshot[0]
+    assert result['models'] == {'1H': '1H.model', '30T': '30T.model'}
+    # the station without any bike nor stand is skipped
+    assert sorted((x['at'], x['id']) for x in result['data']) == [
+        ('1H', '1'), ('1H', '2'), ('30T', '1'), ('30T', '2')]
+    first = [x for x in result['data'] if x['id'] == '1' and x['at'] == '30T'][0]
+    assert first['timestamp'] == datetime(2018, 1, 3, 8, 40)
+    assert first['nb_bikes'] + first['nb_stands'] == 10
+    assert 0 < first['probability'] < 0.5
+
+    result = controller.forecast('lyon', ['2'], ['1H', '2H'])
+    assert list(result['models']) == ['1H']
+    assert [(x['id'], x['at']) for x in result['data']] == [('2', '1H')]
+    assert result['data'][0]['probability'] > 0.5
+    assert controller.forecast('lyon', None, ['2H']) is None
@@ -0,0 +1,62 @@
+import numpy as np
+import pandas as pd
+
+import pytest
+
+from jitenshea.hexgrid import (hex_cells, hex_centers, hex_polygons, hex_rollup,
+                               RESOLUTIONS)
+
+
+def test_hex_cells_of_centers():
+    q = np.array([0, 1, -3, 120, 157])
+    r = np.array([0, -1, 2, 3800, 4120])
+    for resolution in RESOLUTIONS:
+        lon, lat = hex_centers(q, r, resolution)
+        cq, cr = hex_cells(lon, lat, resolution)
+        assert cq.tolist() == q.tolist()
+        assert cr.tolist() == r.tolist()
+
+
+def test_hex_polygons():
+    lon, lat = 4.8357, 45.7640
+    for resolution in RESOLUTIONS:
+        q, r = hex_cells([lon], [lat], resolution)
+        ring = hex_polygons(q, r, resolution)[0]
+        assert ring.shape == (7, 2)
+        assert ring[0].tolist() == pytest.approx(ring[-1].tolist())
+        # the point is within the bounds of its cell
+        assert ring[:, 0].min() <= lon <= ring[:, 0].max()
+        assert ring[:, 1].min() <= lat <= ring[:, 1].max()
+    # finer resolutions, smaller cells
+    cells = [len(set(zip(*hex_cells(np.linspace(4.8, 4.9, 200), np.full(200, 45.76), res))))
+             for res in sorted(RESOLUTIONS)]
+    assert cells == sorted(cells)
+
+
+def test_hex_rollup():
+    stations = pd.DataFrame({"id": ['a', 'b', 'c'],
+                             "x": [4.8357, 4.8358, 4.95],
+                             "y": [45.7640, 45.7641, 45.70]})
+    timestamps = pd.to_datetime(['2018-01-01 08:01', '2018-01-01 08:07',
+                                 '2018-01-01 08:13', '2018-01-01 08:16'])
+    df = pd.concat([
+        pd.DataFrame({"id": 'a', "timestamp": timestamps,
+                      "available_bikes": [5, 3, 4, 4], "available_stands": [5, 7, 6, 6]}),
+        pd.DataFrame({"id": 'b', "timestamp": timestamps,
+                      "available_bikes": [1, 1, 2, 0], "available_stands": [9, 9, 8, 10]}),
+        pd.DataFrame({"id": 'c', "timestamp": timestamps,
+                      "available_bikes": [2, 2, 2, 2], "available_stands": [2, 2, 2, 2]})])
+    rollup = hex_rollup(df, stations, freq='15min', resolutions=[9])
+    assert list(rollup.columns) == ['resolution', 'bucket', 'q', 'r', 'nb_bikes',
+                                    'nb_stands', 'transactions', 'nb_stations']
+    first = rollup[rollup['bucket'] == pd.Timestamp('2018-01-01 08:00')]
+    # stations 'a' and 'b' share a cell, 'c' is far away
+    assert sorted(first['nb_stations']) == [1, 2]
+    shared = first[first['nb_stations'] == 2].iloc[0]
+    # last values of the bucket, transactions: |3 - 5| + |4 - 3| + |2 - 1|
+    assert shared['nb_bikes'] == 4 + 2
+    assert shared['nb_stands'] == 6 + 8
+    assert shared['transactions'] == 4
+    second = rollup[rollup['bucket'] == pd.Timestamp('2018-01-01 08:15')]
+    assert second['transactions'].sum() == 2
+    assert hex_rollup(df.iloc[:0], stations).empty
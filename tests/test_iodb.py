@@ -0,0 +1,130 @@
+import configparser
+from types import SimpleNamespace
+
+import pytest
+
+from jitenshea import iodb, queries
+from jitenshea.iodb import fingerprint, QueryStats
+
+
+def test_fingerprint():
+    query = """SELECT id, available_bikes::float / 2.5 AS ratio
+    FROM lyon.timeseries -- availability
+    WHERE id IN ('1001', '1002') AND timestamp >= %(start)s
+    LIMIT 10;"""
+    expected = ("select id, available_bikes::float / ? as ratio "
+                "from lyon.timeseries where id in (?) and timestamp >= ? limit ?")
+    assert expected == fingerprint(query)
+    assert fingerprint("SELECT * FROM t WHERE id = :id") == fingerprint("select * from t where id = 12")
+
+
+def test_query_stats():
+    stats = QueryStats(slow_threshold=0.1)
+    for i in range(20):
+        stats.record("SELECT * FROM t WHERE id = {}".format(i), {}, 0.01 * (i + 1), 1)
+    stats.record("SELECT count(*) FROM t", {}, 0.001, 1)
+    summary = stats.summary()
+    assert [x['calls'] for x in summary] == [20, 1]
+    assert summary[0]['rows'] == 20
+    assert abs(summary[0]['p95'] - 0.19) < 1e-9
+    # 0.1s and more
+    assert len(stats.slow()) == 11
+    assert stats.slow()[0]['statement'] == "SELECT * FROM t WHERE id = 19"
+
+
+def test_engine_routing(monkeypatch):
+    settings = configparser.ConfigParser(allow_no_value=True)
+    settings.read_string("""
+[database]
+dbname = jitenshea
+user = dag
+host = primary
+port = 5432
+password
+
+[database:bordeaux]
+dbname = bordeaux
+
+[replica:api]
+host = replica1
+
+[replica:training]
+host = replica2
+intents = analytics
+cities = lyon
+""")
+    monkeypatch.setattr(iodb, 'config', settings)
+    host = lambda eng: eng.url.host
+    assert host(iodb.db()) == 'primary'
+    assert iodb.db('write', 'bordeaux').url.database == 'bordeaux'
+    assert host(iodb.db('read', 'lyon')) == 'replica1'
+    assert iodb.db('read', 'bordeaux').url.database == 'bordeaux'
+    assert {host(iodb.db('analytics', 'lyon')) for _ in range(2)} == {'replica1', 'replica2'}
+    assert host(iodb.db('analytics', 'bordeaux')) == 'replica1'
+    # the engines are created once
+    assert iodb.db('read', 'lyon') is iodb.db('read', 'lyon')
+    # lagging replica
+    monkeypatch.setattr(iodb, 'replica_lag', lambda eng: 120.)
+    assert host(iodb.db('read', 'lyon')) == 'replica1'
+    assert host(iodb.db('read', 'lyon', fresh=True)) == 'primary'
+
+
+def test_slow_query_engine(monkeypatch):
+    settings = configparser.ConfigParser(allow_no_value=True)
+    settings.read_string("""
+[database]
+dbname = jitenshea
+user = dag
+host = primary
+port = 5432
+password = secret
+
+[database:bordeaux]
+dbname = bordeaux
+""")
+    monkeypatch.setattr(iodb, 'config', settings)
+    bordeaux = iodb.db('write', 'bordeaux')
+    iodb.db('write', 'lyon')
+    stats = QueryStats(slow_threshold=0.1)
+    stats.record("SELECT * FROM bordeaux.station", {}, 1., 1, iodb.database_url(bordeaux))
+    query = stats.slow()[0]
+    assert 'secret' not in query['database']
+    # explained on the database where it ran, not the default one
+    assert iodb.slow_query_engine(query) is bordeaux
+    with pytest.raises(ValueError):
+        iodb.slow_query_engine(dict(query, database='postgresql://dag@elsewhere/db'))
+
+
+def test_explain_prepared_statement(monkeypatch):
+    _, _, execute = queries.prepare_statement('specific_stations', 'lyon')
+    stats = QueryStats(slow_threshold=0.1)
+    stats.record(execute, {'ids': ['1001']}, 1., 1, 'postgresql://dag@primary/jitenshea')
+    query = stats.slow()[0]
+    assert query['statement'].startswith('SELECT id')
+    assert query['statement'].endswith('WHERE id = ANY(%(ids)s)')
+    assert stats.summary()[0]['fingerprint'].startswith('select id')
+
+    executed = []
+
+    class Cursor:
+        def execute(self, sql, parameters):
+            executed.append((sql, parameters))
+
+        def fetchall(self):
+            return [('Seq Scan on station',)]
+
+    class Connection:
+        connection = SimpleNamespace(cursor=Cursor)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+    monkeypatch.setattr(iodb, 'query_stats', stats)
+    monkeypatch.setattr(iodb, 'slow_query_engine',
+                        lambda query: SimpleNamespace(connect=Connection))
+    assert iodb.explain(query['id']) == ['Seq Scan on station']
+    assert executed == [('EXPLAIN (ANALYZE, BUFFERS) ' + query['statement'],
+                         {'ids': ['1001']})]
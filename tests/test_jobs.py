@@ -0,0 +1,135 @@
+import os
+import time
+import threading
+
+from jitenshea import jobs
+
+
+def wait(store, jid, timeout=5):
+    stop = time.time() + timeout
+    while time.time() < stop:
+        status = store.status(jid)
+        if status['status'] in (jobs.DONE, jobs.FAILED):
+            return status
+        time.sleep(0.01)
+    raise AssertionError("job {} not finished".format(jid))
+
+
+def test_identical_jobs_are_shared(tmpdir):
+    store = jobs.JobStore(str(tmpdir), ttl=60)
+    release = threading.Event()
+    calls = []
+
+    def write(path):
+        calls.append(path)
+        release.wait(5)
+        with open(path, 'w') as fobj:
+            fobj.write('{"data": []}')
+
+    first = store.submit(('profile', 'lyon', ['1', '2']), write, city='lyon')
+    second = store.submit(('profile', 'lyon', ['1', '2']), write, city='lyon')
+    assert first['id'] == second['id']
+    assert first['city'] == 'lyon'
+    release.set()
+    status = wait(store, first['id'])
+    assert status['status'] == jobs.DONE
+    assert status['size'] == 12
+    with open(store.result_path(status)) as fobj:
+        assert fobj.read() == '{"data": []}'
+    # a done job is shared as well
+    assert store.submit(('profile', 'lyon', ['1', '2']), write)['status'] == jobs.DONE
+    assert len(calls) == 1
+    assert store.submit(('profile', 'lyon', ['1']), write)['id'] != first['id']
+
+
+def test_failed_job(tmpdir):
+    store = jobs.JobStore(str(tmpdir), ttl=60)
+
+    def fail(path):
+        raise jobs.JobError("No such id", 404)
+
+    status = wait(store, store.submit(('missing',), fail)['id'])
+    assert status['status'] == jobs.FAILED
+    assert (status['error'], status['code']) == ("No such id", 404)
+    assert not os.path.exists(store.result_path(status))
+
+    def crash(path):
+        raise RuntimeError("boom")
+
+    status = wait(store, store.submit(('crash',), crash)['id'])
+    assert (status['error'], status['code']) == ("Internal error", 500)
+    # a failed job is computed again
+    assert store.submit(('crash',), crash)['status'] == jobs.PENDING
+
+
+def test_expired_job(tmpdir):
+    store = jobs.JobStore(str(tmpdir), ttl=0.1)
+
+    def write(path):
+        with open(path, 'w') as fobj:
+            fobj.write('[]')
+
+    status = wait(store, store.submit(('expired',), write)['id'])
+    time.sleep(0.2)
+    store.cleanup()
+    assert store.status(status['id']) is None
+    assert os.listdir(str(tmpdir)) == [jobs.LOCK_FILE]
+    assert store.status('../etc') is None
+
+
+def test_dead_job_is_submitted_again(tmpdir):
+    store = jobs.JobStore(str(tmpdir), ttl=60, stale=0.2)
+    release = threading.Event()
+
+    def write(path):
+        release.wait(5)
+        with open(path, 'w') as fobj:
+            fobj.write('[]')
+
+    # a long job keeps its heartbeat
+    status = store.submit(('long',), write)
+    time.sleep(0.5)
+    assert store.status(status['id'])['status'] in (jobs.PENDING, jobs.RUNNING)
+    release.set()
+    assert wait(store, status['id'])['status'] == jobs.DONE
+
+    # job of a dead process, without heartbeat
+    dead = dict(status, id=jobs.job_id('dead'), status=jobs.RUNNING,
+                submitted=time.time() - 1, heartbeat=time.time() - 1)
+    store._write_status(dead)
+    status = store.status(dead['id'])
+    assert (status['status'], status['code']) == (jobs.FAILED, 500)
+    assert store.submit(('dead',), write)['status'] == jobs.PENDING
+    assert wait(store, dead['id'])['status'] == jobs.DONE
+
+
+def test_job_is_claimed_by_one_process(tmpdir):
+    # two worker processes of the Web API, sharing the jobs directory
+    first = jobs.JobStore(str(tmpdir), ttl=60, stale=0.2)
+    second = jobs.JobStore(str(tmpdir), ttl=60, stale=0.2)
+    release = threading.Event()
+    calls = []
+
+    def write(path):
+        calls.append(path)
+        release.wait(5)
+        with open(path, 'w') as fobj:
+            fobj.write('[]')
+
+    statuses = []
+    threads = [threading.Thread(target=lambda store=store: statuses.append(
+        store.submit(('shared',), write))) for store in (first, second)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert statuses[0]['id'] == statuses[1]['id']
+    assert statuses[0]['owner'] == statuses[1]['owner']
+    release.set()
+    assert wait(second, statuses[0]['id'])['status'] == jobs.DONE
+    assert len(calls) == 1
+    # the status is not overwritten by the heartbeat of another process
+    time.sleep(0.3)
+    assert first.status(statuses[0]['id'])['status'] == jobs.DONE
+    assert second.submit(('shared',), write)['status'] == jobs.DONE
+    assert len(calls) == 1
@@ -0,0 +1,64 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+import pytest
+
+from jitenshea import features, orchestrator
+from jitenshea.registry import ModelRegistry
+from jitenshea.stats import load_model
+
+
+pytest.importorskip('pyarrow')
+
+
+def test_core_budget():
+    assert orchestrator.core_budget(8, cores=16) == (8, 2)
+    assert orchestrator.core_budget(2, cores=16) == (2, 8)
+    assert orchestrator.core_budget(32, cores=16) == (16, 1)
+    assert orchestrator.core_budget(8, cores=16, threads=4) == (4, 4)
+    assert orchestrator.core_budget(1, cores=16, threads=4) == (1, 4)
+    assert orchestrator.core_budget(3, cores=2, threads=4) == (1, 2)
+
+
+def test_shared_window(tmpdir, feature_partitions):
+    paths = feature_partitions(days=['2018-01-01', '2018-01-02'])
+    window = orchestrator.SharedWindow.create(str(tmpdir.join('window')),
+                                              features.read_partitions(paths),
+                                              ['30min', '1H'])
+    assert window.features == ['station_id', 'nb_bikes', 'nb_stands', 'day', 'hour',
+                               'minute']
+    assert isinstance(window.columns['ts'], np.memmap)
+    validation = pd.Timestamp('2018-01-02 12:00')
+    xg_train, xg_test = window.matrices('2018-01-01', '2018-01-03', validation, '30min')
+    # rows until 11:30 and from 12:00 to 13:00, by station
+    assert xg_train.num_row() == 2 * 6 * (24 + 11) + 2 * 4
+    assert xg_test.num_row() == 2 * 7
+    xg_train, _ = window.matrices('2018-01-02', '2018-01-03', validation, '1H')
+    assert xg_train.num_row() == 2 * (6 * 11 + 1)
+
+
+def test_run(tmpdir, feature_partitions):
+    windows = {'lyon': feature_partitions('lyon'),
+               'bordeaux': feature_partitions('bordeaux', shift=3)}
+    stop = pd.Timestamp('2018-01-04').date()
+    jobs = []
+    for city in windows:
+        for start in (pd.Timestamp('2018-01-01').date(), pd.Timestamp('2018-01-03').date()):
+            validation = orchestrator.cutoff(stop, '30min')
+            path = str(tmpdir.join('models', city, '{}.model'.format(start)))
+            jobs.append(orchestrator.Job(city, start, stop, validation, '30min', path))
+    tmpdir.join('work', 'keep.txt').write('kept', ensure=True)
+    models = orchestrator.run(jobs, windows, cores=2, num_round=2,
+                              workdir=str(tmpdir.join('work')))
+    assert len(models) == 4
+    # the shared windows are removed, not the other files of the directory
+    assert os.listdir(str(tmpdir.join('work'))) == ['keep.txt']
+    for city in windows:
+        registry = ModelRegistry(str(tmpdir.join('models', city)))
+        assert len(registry.versions('30min')) == 2
+        promoted = [x for x in models if x['city'] == city and x['promoted']]
+        assert len(promoted) == 1
+        assert registry.active('30min') == promoted[0]['path']
+        assert load_model(promoted[0]['path']).num_boosted_rounds() == 2
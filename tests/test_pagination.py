@@ -0,0 +1,26 @@
+import pytest
+
+from jitenshea.pagination import encode_cursor, decode_cursor, next_cursor, InvalidCursor
+
+
+def test_cursor_roundtrip():
+    cursor = encode_cursor('daily_by_value', 12.5, '1024')
+    assert '=' not in cursor
+    assert decode_cursor(cursor, 'daily_by_value') == (12.5, '1024')
+
+
+def test_invalid_cursor():
+    with pytest.raises(InvalidCursor):
+        decode_cursor('not a cursor', 'stations')
+    with pytest.raises(InvalidCursor):
+        decode_cursor(encode_cursor('stations', '1024'), 'availability')
+
+
+def test_next_cursor():
+    rows = [{'id': str(i)} for i in range(10)]
+    key = lambda x: (x['id'],)
+    assert decode_cursor(next_cursor('stations', rows, 10, key), 'stations') == ('9',)
+    # last page
+    assert next_cursor('stations', rows, 20, key) is None
+    assert next_cursor('stations', [], 10, key) is None
+    assert next_cursor('stations', rows, None, key) is None
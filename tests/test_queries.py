@@ -0,0 +1,72 @@
+import pytest
+
+from jitenshea import controller, queries
+
+
+def test_registered_queries_are_built_by_city():
+    for name in queries.QUERIES:
+        statement = queries.statement(name, 'lyon')
+        assert '{city}' not in statement.text
+        assert 'lyon.' in statement.text
+    with pytest.raises(ValueError):
+        queries.statement('stations', 'paris')
+
+
+def test_prepare_statement():
+    prepared_name, prepare, execute = queries.prepare_statement('specific_stations', 'bordeaux')
+    assert prepared_name == 'jitenshea_specific_stations_bordeaux'
+    assert prepare.startswith('PREPARE jitenshea_specific_stations_bordeaux (varchar[]) AS SELECT')
+    assert prepare.endswith('WHERE id = ANY($1)')
+    assert execute == 'EXECUTE jitenshea_specific_stations_bordeaux(%(ids)s)'
+    # casts are not parameters
+    _, prepare, execute = queries.prepare_statement('nearest_stations', 'lyon')
+    assert '::geography' in prepare
+    assert 'st_makepoint($1, $2)' in prepare
+    assert execute.endswith('(%(lon)s, %(lat)s, %(min_date)s, %(min_bikes)s, %(n)s)')
+    _, prepare, execute = queries.prepare_statement('cluster_profiles', 'lyon')
+    assert prepare.startswith('PREPARE jitenshea_cluster_profiles_lyon AS WITH')
+    assert execute == 'EXECUTE jitenshea_cluster_profiles_lyon'
+
+
+def test_undeclared_parameter():
+    with pytest.raises(ValueError):
+        queries.register('wrong', "SELECT * FROM {city}.station WHERE id = :id", [])
+    assert 'wrong' not in queries.QUERIES
+
+
+def test_geojson_variant():
+    source = queries.QUERIES['latest_availability']
+    query = queries.QUERIES['latest_availability_geojson']
+    assert query.params == source.params
+    assert query.fresh
+    assert source.sql in query.sql
+    assert "'nb_bikes', F.nb_bikes" in query.sql
+    assert "'timestamp', to_char(F.timestamp, " in query.sql
+    _, prepare, _ = queries.prepare_statement('stations_geojson', 'lyon')
+    assert '::json' in prepare
+    assert 'LIMIT $2' in prepare
+
+
+def test_latest_values_by_station():
+    # the truncation is done for each station, in a lateral subquery
+    for name, limit in (('prediction', ':values_num'), ('current_values', '1')):
+        sql = queries.QUERIES[name].sql
+        assert 'DISTINCT' not in sql
+        lateral = sql.split('CROSS JOIN LATERAL')[1].split(') AS')[0]
+        assert '= S.id' in lateral
+        assert 'ORDER BY T.timestamp DESC' in lateral
+        assert lateral.strip().endswith('LIMIT {}'.format(limit))
+
+
+def test_prediction_timeseries(monkeypatch):
+    def fetch(name, city, **params):
+        # rows of the database: `values_num` predictions by station, one
+        # current value by station
+        count = params['values_num'] if name == 'prediction' else 1
+        return [{'id': station, 'timestamp': i} for station in params['ids']
+                for i in range(count)]
+
+    monkeypatch.setattr(controller, '_fetch_dicts', fetch)
+    result = controller.prediction_timeseries('lyon', [1, 2], None, None, 3, True, '30T')
+    assert [(x['id'], x['at']) for x in result] == (
+        [('1', '0'), ('2', '0')] + [('1', '30T')] * 3 + [('2', '30T')] * 3)
@@ -0,0 +1,51 @@
+import os
+
+import xgboost as xgb
+
+from jitenshea.registry import ModelCache, ModelRegistry, model_dir
+
+
+def test_registry(tmpdir):
+    registry = ModelRegistry(str(tmpdir))
+    assert registry.active('30T') is None
+    first = str(tmpdir.join('first.model'))
+    registry.register(first, {'frequency': '30T', 'validation': '2018-01-02T12:00:00'},
+                      activate=True)
+    assert registry.active('30T') == first
+    assert registry.active('1H') is None
+    # a backfill is registered but not activated
+    backfill = str(tmpdir.join('backfill.model'))
+    registry.register(backfill, {'frequency': '30T', 'validation': '2017-12-01T12:00:00'},
+                      activate=True)
+    assert registry.active('30T') == first
+    assert sorted(registry.versions('30T')) == ['backfill.model', 'first.model']
+    registry.activate('backfill.model', '30T')
+    assert registry.active('30T') == backfill
+
+
+def test_model_cache(tmpdir, save_model, model_features):
+    directory = model_dir('lyon', str(tmpdir))
+    os.makedirs(directory)
+    registry = ModelRegistry(directory)
+    cache = ModelCache(str(tmpdir))
+    assert cache.active('lyon', '30T') == (None, None)
+
+    first = os.path.join(directory, 'first.model')
+    save_model(first, 0.2)
+    registry.register(first, {'frequency': '30T', 'validation': '2018-01-02T12:00:00'},
+                      activate=True)
+    path, booster = cache.active('lyon', '30T')
+    assert path == first
+    # loaded once
+    assert cache.active('lyon', '30T')[1] is booster
+    assert cache.load(first) is booster
+
+    second = os.path.join(directory, 'second.model')
+    save_model(second, 0.8)
+    registry.register(second, {'frequency': '30T', 'validation': '2018-01-03T12:00:00'},
+                      activate=True)
+    path, swapped = cache.active('lyon', '30T')
+    assert path == second
+    assert swapped is not booster
+    X = xgb.DMatrix(model_features)
+    assert swapped.predict(X)[0] > booster.predict(X)[0]
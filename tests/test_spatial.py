@@ -0,0 +1,55 @@
+from datetime import datetime
+
+import numpy as np
+
+from jitenshea.spatial import StationIndex, EARTH_RADIUS
+
+
+def stations(size=200, seed=0):
+    rng = np.random.RandomState(seed)
+    lon = 4.80 + 0.1 * rng.rand(size)
+    lat = 45.70 + 0.1 * rng.rand(size)
+    return [{'id': str(1000 + i), 'name': 'station {}'.format(i), 'nb_stands': 20,
+             'x': x, 'y': y} for i, (x, y) in enumerate(zip(lon, lat))]
+
+
+def haversine(lon0, lat0, lon, lat):
+    lon0, lat0, lon, lat = map(np.radians, (lon0, lat0, lon, lat))
+    a = (np.sin((lat - lat0) / 2) ** 2
+         + np.cos(lat0) * np.cos(lat) * np.sin((lon - lon0) / 2) ** 2)
+    return 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+
+
+def test_nearest_stations_with_bikes():
+    data = stations()
+    index = StationIndex(data)
+    now = datetime(2018, 6, 1, 12)
+    index.set_availability([{'id': x['id'], 'nb_bikes': i % 4, 'timestamp': now}
+                            for i, x in enumerate(data)], now)
+    result = index.nearest(4.85, 45.75, n=5, min_bikes=3)
+    assert len(result) == 5
+    assert all(x['nb_bikes'] >= 3 for x in result)
+    # brute force
+    lon = np.array([x['x'] for x in data])
+    lat = np.array([x['y'] for x in data])
+    distance = haversine(4.85, 45.75, lon, lat)
+    candidates = [i for i in np.argsort(distance) if i % 4 >= 3][:5]
+    assert [data[i]['id'] for i in candidates] == [x['id'] for x in result]
+    np.testing.assert_allclose(distance[candidates], [x['distance'] for x in result])
+
+
+def test_stations_within_bbox():
+    data = stations()
+    index = StationIndex(data)
+    index.set_availability([{'id': x['id'], 'nb_bikes': 1, 'timestamp': None}
+                            for x in data])
+    result = index.within(4.82, 45.72, 4.85, 45.76)
+    expected = sorted(x['id'] for x in data
+                      if 4.82 <= x['x'] <= 4.85 and 45.72 <= x['y'] <= 45.76)
+    assert expected == [x['id'] for x in result]
+    assert index.within(4.82, 45.72, 4.85, 45.76, min_bikes=2) == []
+
+
+def test_stations_without_availability_are_skipped():
+    index = StationIndex(stations(10))
+    assert index.nearest(4.85, 45.75, n=3) == []
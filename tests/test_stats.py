@@ -1,9 +1,10 @@
 import os.path as osp
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
-from jitenshea.stats import find_cluster
+from jitenshea.stats import add_future, complete_data, find_cluster, future_positions
 
 
 _here = Path(osp.dirname(osp.abspath(__file__)))
@@ -17,3 +18,50 @@ def test_find_cluster():
     cluster = find_cluster(df)
     expected = {3: 'evening', 1: 'high', 0: 'morning', 2: 'noon'}
     assert expected == cluster
+
+
+def legacy_add_future(df, frequency):
+    # set_index/shift/merge implementation of add_future
+    df = df.set_index(["ts", "station_id"])
+    label = df["probability"].copy()
+    label.name = "future"
+    label = (label.reset_index(level=1)
+             .shift(-1, freq=frequency)
+             .reset_index()
+             .set_index(["ts", "station_id"]))
+    df = df.merge(label, left_index=True, right_index=True)
+    df.reset_index(level=1, inplace=True)
+    return df
+
+
+def availability():
+    rng = np.random.default_rng(0)
+    ts = pd.date_range('2018-01-05 22:00', periods=60, freq='10min')
+    df = pd.DataFrame({"station_id": np.repeat([3, 1, 2], len(ts)),
+                       "ts": np.tile(ts, 3),
+                       "nb_bikes": rng.integers(0, 10, 3 * len(ts)).astype('float32'),
+                       "nb_stands": np.float32(5),
+                       "probability": rng.random(3 * len(ts)).astype('float32')})
+    # unsorted, with some missing observations
+    return df.sample(frac=0.8, random_state=1)
+
+
+def test_complete_data():
+    df = complete_data(availability())
+    assert df['day'].tolist() == [x.weekday() for x in df['ts']]
+    assert df['hour'].tolist() == [x.hour for x in df['ts']]
+    assert df['minute'].tolist() == [x.minute for x in df['ts']]
+    assert df['hour'].dtype == np.int64
+
+
+def test_add_future():
+    df = availability()
+    for frequency in ('10min', '30min', '15min', '1h'):
+        pd.testing.assert_frame_equal(add_future(df, frequency),
+                                      legacy_add_future(df, frequency))
+    assert future_positions(df['ts'], df['station_id'], pd.Timedelta('10min')) is not None
+    # duplicated observations
+    twice = pd.concat([df, df.iloc[:5]])
+    assert future_positions(twice['ts'], twice['station_id'], pd.Timedelta('10min')) is None
+    pd.testing.assert_frame_equal(add_future(twice, '30min'),
+                                  legacy_add_future(twice, '30min'))
@@ -0,0 +1,55 @@
+import json
+from datetime import datetime
+
+from jitenshea.stream import Broadcaster, Subscription, delta, format_event
+
+
+def test_delta():
+    previous = {'1': (2, 8), '2': (5, 5)}
+    current = {'1': (2, 8), '2': (4, 6), '3': (0, 10)}
+    assert delta(previous, current) == [['2', 4, 6], ['3', 0, 10]]
+    assert delta(current, current) == []
+
+
+def test_format_event():
+    text = format_event({'event': 'delta', 'id': 3,
+                         'data': {'date': datetime(2018, 6, 1, 12), 'stations': [['1', 2, 8]]}})
+    lines = text.split("\n")
+    assert lines[:2] == ["event: delta", "id: 3"]
+    assert json.loads(lines[2][len("data: "):]) == {'date': '2018-06-01T12:00:00',
+                                                    'stations': [['1', 2, 8]]}
+    assert text.endswith("\n\n")
+
+
+def test_fan_out_one_load_by_tick():
+    states = iter([{'1': (2, 8), '2': (5, 5)},
+                   {'1': (2, 8), '2': (4, 6)},
+                   {'1': (2, 8), '2': (4, 6)}])
+    broadcaster = Broadcaster('lyon', lambda city: (datetime.now(), next(states)))
+    # subscribe without starting the background thread
+    broadcaster._thread = 'test'
+    subscriptions = [broadcaster.subscribe() for _ in range(3)]
+    assert broadcaster.update() == 2
+    assert broadcaster.update() == 1
+    assert broadcaster.update() == 0
+    assert broadcaster.loads == 3
+    for subscription in subscriptions:
+        first, second = subscription.get(0), subscription.get(0)
+        assert first['event'] == 'snapshot'
+        assert second['event'] == 'delta'
+        assert second['data']['stations'] == [['2', 4, 6]]
+        assert subscription.get(0) is None
+    # a late subscriber starts with the current snapshot
+    late = broadcaster.subscribe().get(0)
+    assert late['event'] == 'snapshot'
+    assert late['data']['stations'] == [['1', 2, 8], ['2', 4, 6]]
+
+
+def test_slow_subscriber_is_resynced():
+    subscription = Subscription(2)
+    snapshot = lambda: {'event': 'snapshot', 'id': 3}
+    for i in range(3):
+        subscription.put({'event': 'delta', 'id': i}, snapshot)
+    assert subscription.resyncs == 1
+    assert subscription.get(0) == snapshot()
+    assert subscription.get(0) is None
@@ -0,0 +1,71 @@
+import math
+from types import SimpleNamespace
+
+import pytest
+
+from jitenshea import controller
+from jitenshea.tiles import (TileCache, check_tile, tile_envelope, tile_lonlat_bounds,
+                             ORIGIN_SHIFT)
+
+
+def lonlat_to_tile(lon, lat, z):
+    n = 2 ** z
+    x = int((lon + 180.) / 360. * n)
+    lat = math.radians(lat)
+    y = int((1. - math.log(math.tan(lat) + 1. / math.cos(lat)) / math.pi) / 2. * n)
+    return x, y
+
+
+def test_tile_envelope():
+    assert tile_envelope(0, 0, 0) == pytest.approx((-ORIGIN_SHIFT, -ORIGIN_SHIFT,
+                                                    ORIGIN_SHIFT, ORIGIN_SHIFT))
+    # north-west quarter
+    assert tile_envelope(1, 0, 0) == pytest.approx((-ORIGIN_SHIFT, 0, 0, ORIGIN_SHIFT))
+
+
+def test_tile_lonlat_bounds():
+    lon, lat = 4.8357, 45.7640
+    x, y = lonlat_to_tile(lon, lat, 14)
+    lon_min, lat_min, lon_max, lat_max = tile_lonlat_bounds(14, x, y, buffer=0)
+    assert lon_min <= lon <= lon_max
+    assert lat_min <= lat <= lat_max
+    # the buffer widens the bounds
+    wide = tile_lonlat_bounds(14, x, y, buffer=64)
+    assert wide[0] < lon_min and wide[1] < lat_min and wide[2] > lon_max and wide[3] > lat_max
+
+
+def test_check_tile():
+    check_tile(3, 7, 0)
+    with pytest.raises(ValueError):
+        check_tile(3, 8, 0)
+    with pytest.raises(ValueError):
+        check_tile(30, 0, 0)
+
+
+def test_tile_cache():
+    cache = TileCache(size=2)
+    cache.put('lyon', 12, 1, 1, 'tick1', b'tile')
+    assert cache.get('lyon', 12, 1, 1, 'tick1') == b'tile'
+    # new ingestion tick
+    assert cache.get('lyon', 12, 1, 1, 'tick2') is None
+    # LRU by zoom level
+    cache.put('lyon', 12, 1, 2, 'tick1', b'other')
+    cache.get('lyon', 12, 1, 1, 'tick1')
+    cache.put('lyon', 12, 1, 3, 'tick1', b'third')
+    cache.put('lyon', 13, 1, 1, 'tick1', b'zoom')
+    assert cache.get('lyon', 12, 1, 2, 'tick1') is None
+    assert cache.get('lyon', 12, 1, 1, 'tick1') == b'tile'
+    assert cache.stats()['tiles'] == {12: 2, 13: 1}
+    cache.invalidate('lyon')
+    assert cache.get('lyon', 13, 1, 1, 'tick1') is None
+
+
+def test_cached_tile_is_not_coalesced(monkeypatch):
+    tick = object()
+    monkeypatch.setattr(controller, 'TILES', TileCache(4))
+    monkeypatch.setattr(controller.SPATIAL_INDEXES, 'get',
+                        lambda city: SimpleNamespace(date=tick))
+    controller.TILES.put('lyon', 3, 4, 2, tick, b'tile')
+    calls = controller.render_tile.group.stats()['calls']
+    assert controller.station_tile('lyon', 3, 4, 2) == b'tile'
+    assert controller.render_tile.group.stats()['calls'] == calls
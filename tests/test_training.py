@@ -0,0 +1,130 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import pytest
+
+from jitenshea import features, training
+from jitenshea.stats import add_future, add_futures, predict_horizons, xgb_params
+
+
+pytest.importorskip('pyarrow')
+
+
+def test_xgb_params():
+    params = xgb_params(max_depth=3)
+    assert params['tree_method'] == 'hist'
+    assert params['nthread'] >= 1
+    assert params['max_depth'] == 3
+    assert xgb_params(nthread=2)['nthread'] == 2
+
+
+def test_cached_matrices(tmpdir, feature_partitions):
+    paths = feature_partitions()
+    cache = str(tmpdir.join('cache'))
+    validation = pd.Timestamp('2018-01-03 12:00')
+    xg_train, xg_test = training.matrices(paths, validation, '30min', cache)
+    assert len(os.listdir(cache)) == 2
+    cached_train, cached_test = training.matrices(paths, validation, '30min', cache)
+    assert cached_train.num_row() == xg_train.num_row()
+    assert cached_test.num_row() == xg_test.num_row()
+    np.testing.assert_array_equal(cached_train.get_label(), xg_train.get_label())
+
+
+def test_evict(tmpdir):
+    cache = str(tmpdir)
+    now = time.time()
+    for name, age, size in (('old.train.buffer', 7200, 10), ('old.page', 7200, 10),
+                            ('used.train.buffer', 60, 100), ('new.train.buffer', 10, 100),
+                            ('new.page', 10, 100)):
+        path = os.path.join(cache, name)
+        with open(path, 'wb') as fobj:
+            fobj.write(b'0' * size)
+        os.utime(path, (now - age, now - age))
+    assert training.evict(cache, 3600, 150) == 3
+    # the pages of a training in progress are only removed by age
+    assert sorted(os.listdir(cache)) == ['new.page', 'new.train.buffer']
+
+
+def test_external_memory(tmpdir, feature_partitions):
+    paths = feature_partitions()
+    cache = str(tmpdir.join('cache'))
+    validation = pd.Timestamp('2018-01-03 12:00')
+    xg_train, xg_test = training.matrices(paths, validation, '30min')
+    iterator = training.PartitionIter(paths, validation, '30min',
+                                      os.path.join(cache, 'pages'))
+    labels = []
+    while iterator.next(lambda data, label: labels.append(label)):
+        pass
+    # the labels of the end of a day come from the next partition
+    np.testing.assert_allclose(np.sort(np.concatenate(labels)),
+                               np.sort(xg_train.get_label()))
+    os.makedirs(cache)
+    model, _ = training.train(paths, validation, '30min', external_memory=True,
+                              params=xgb_params(nthread=2), num_round=2, cache_dir=cache)
+    assert model.num_boosted_rounds() == 2
+    # the external memory pages are removed once the model is trained
+    assert os.listdir(cache) == []
+    test = training.validation_matrix(paths, validation, '30min')
+    assert test.num_row() == xg_test.num_row()
+
+
+def test_retrain(tmpdir, feature_partitions):
+    paths = feature_partitions()
+    params = xgb_params(nthread=2)
+    model, metrics = training.train(paths, pd.Timestamp('2018-01-02 12:00'), '30min',
+                                    params=params, num_round=3,
+                                    cache_dir=str(tmpdir.join('cache')))
+    assert metrics['rows'] > 0
+    path = str(tmpdir.join('first.model'))
+    model.save_model(path)
+    training.write_metadata(path, start='2018-01-01', validation='2018-01-02T12:00:00',
+                            frequency='30min', metrics=metrics, promoted=True)
+    assert training.latest_model(str(tmpdir), '30min') == path
+    assert training.latest_model(str(tmpdir), '1H') is None
+
+    df = add_future(features.read_partitions(paths[1:]), '30min')
+    validation = pd.Timestamp('2018-01-03 12:00')
+    booster, metrics, reference, promoted = training.retrain(path, df, validation,
+                                                             '30min', params=params,
+                                                             num_round=2)
+    assert booster.num_boosted_rounds() == 5
+    assert metrics['rows'] == reference['rows'] > 0
+    assert promoted == (metrics['rmse'] <= reference['rmse'])
+    booster, _, _, _ = training.retrain(path, df, validation, '30min', mode='refresh',
+                                        params=params)
+    assert booster.num_boosted_rounds() == 3
+    with pytest.raises(ValueError):
+        training.retrain(path, df, validation, '30min', mode='restart')
+    # nothing new since the cutoff
+    with pytest.raises(Exception):
+        training.retrain(path, df, pd.Timestamp('2018-01-02 12:00'), '30min')
+
+
+def test_add_futures(tmpdir, feature_partitions):
+    df = features.read_partitions(feature_partitions())
+    futures = add_futures(df, ['30min', '1h'])
+    assert len(futures) == len(df)
+    single = add_future(df, '30min')
+    labelled = futures.dropna(subset=['future_30min'])
+    assert len(labelled) == len(single)
+    np.testing.assert_allclose(labelled['future_30min'].values, single['future'].values)
+    # a missing label of the longer horizon is kept as NaN
+    assert futures['future_1h'].isna().sum() > futures['future_30min'].isna().sum()
+
+
+def test_train_horizons(tmpdir, feature_partitions):
+    paths = feature_partitions()
+    validation = pd.Timestamp('2018-01-03 12:00')
+    models = training.train_horizons(paths, validation, ['30min', '1h'],
+                                     params=xgb_params(nthread=2), num_round=2)
+    assert sorted(models) == ['1h', '30min']
+    _, xg_test = training.matrices(paths, validation, '30min')
+    assert models['30min'][1]['rows'] == xg_test.num_row()
+    df = pd.DataFrame({"station_id": [1, 2], "ts": pd.Timestamp('2018-01-03 12:04'),
+                       "nb_bikes": [2, 8], "nb_stands": [8, 2], "probability": [.2, .8]})
+    predictions = predict_horizons(df, {k: v[0] for k, v in models.items()})
+    assert predictions['frequency'].tolist() == ['30min', '30min', '1h', '1h']
+    assert predictions.index[-1] == pd.Timestamp('2018-01-03 13:00')
@@ -1,9 +1,11 @@
 import json
+import configparser
 from datetime import date, datetime, timedelta
 
 import pytest
 
 from jitenshea.webapp import app
+from jitenshea import webapi
 from jitenshea.webapi import api, ISO_DATE, ISO_DATETIME
 
 
@@ -26,6 +28,15 @@ def test_app_index(client):
     assert resp.status_code == 200
 
 
+def test_app_metrics(client):
+    client.get('/api/city')
+    resp = client.get('/metrics')
+    assert resp.status_code == 200
+    content = resp.data.decode('utf-8')
+    assert 'jitenshea_request_duration_seconds_bucket{city="",method="GET",route="/api/city"' in content
+    assert 'jitenshea_request_phase_seconds_count' in content
+
+
 def test_api_city_list(client):
     resp = client.get('/api/city')
     assert resp.status_code == 200
@@ -191,3 +202,91 @@ def test_api_latest_prediction(client):
     data = resp.get_json()
     assert len(data['features']) == 5
     assert data['features'][0]['geometry']['type'] == 'Point'
+
+
+def test_api_nearest_stations(client):
+    resp = client.get('/api/lyon/nearest/station',
+                      query_string={'lon': 4.8357, 'lat': 45.7640, 'n': 3,
+                                    'min_bikes': 1})
+    assert resp.status_code == 200
+    data = resp.get_json()['data']
+    assert len(data) == 3
+    assert all(x['nb_bikes'] >= 1 for x in data)
+    distances = [x['distance'] for x in data]
+    assert distances == sorted(distances)
+
+
+def test_api_stations_within_bbox(client):
+    resp = client.get('/api/lyon/within/station',
+                      query_string={'bbox': '4.82,45.75,4.85,45.77'})
+    assert resp.status_code == 200
+    data = resp.get_json()['data']
+    assert all(4.82 <= x['x'] <= 4.85 and 45.75 <= x['y'] <= 45.77 for x in data)
+    resp = client.get('/api/lyon/within/station', query_string={'bbox': '4.82,45.75'})
+    assert resp.status_code == 422
+
+
+def test_api_batch(client):
+    day = yesterday().strftime(ISO_DATE)
+    requests = [{'id': 'info', 'resource': 'station', 'ids': ['93']},
+                {'id': 'daily', 'resource': 'daily', 'ids': ['93'],
+                 'args': {'date': day, 'window': 7}},
+                {'id': 'profile', 'resource': 'hourly_profile', 'ids': ['93'],
+                 'args': {'date': day}},
+                {'id': 'missing', 'resource': 'timeseries', 'ids': ['93'],
+                 'args': {'start': day}},
+                {'id': 'unknown', 'resource': 'station', 'ids': ['nope']}]
+    resp = client.post('/api/bordeaux/batch', json={'requests': requests})
+    assert resp.status_code == 200
+    responses = json.loads(resp.data)['responses']
+    assert [x['id'] for x in responses] == ['info', 'daily', 'profile', 'missing', 'unknown']
+    assert [x['status'] for x in responses] == [200, 200, 200, 400, 404]
+    assert responses[0]['data']['data'][0]['id'] == '93'
+    assert 'stop' in responses[3]['errors']
+    resp = client.post('/api/bordeaux/batch', json={'requests': []})
+    assert resp.status_code == 400
+
+
+def test_api_city_stations_pages(client):
+    resp = client.get('/api/lyon/infostation', query_string={'limit': 5})
+    first = json.loads(resp.data)
+    assert first['next'] is not None
+    resp = client.get('/api/lyon/infostation',
+                      query_string={'limit': 5, 'cursor': first['next']})
+    second = json.loads(resp.data)
+    assert len(second['data']) == 5
+    assert first['data'][-1]['id'] < second['data'][0]['id']
+    resp = client.get('/api/lyon/infostation', query_string={'limit': 10})
+    assert json.loads(resp.data)['data'] == first['data'] + second['data']
+    resp = client.get('/api/lyon/infostation', query_string={'cursor': 'wrong'})
+    assert resp.status_code == 400
+
+
+def test_api_daily_transaction_pages(client):
+    date = yesterday().strftime(ISO_DATE)
+    query = {"limit": 10, "date": date, "by": "value"}
+    resp = client.get('/api/bordeaux/daily/station', query_string=query)
+    first = json.loads(resp.data)
+    resp = client.get('/api/bordeaux/daily/station',
+                      query_string=dict(query, cursor=first['next']))
+    second = json.loads(resp.data)
+    assert first['data'][-1]['value'][0] >= second['data'][0]['value'][0]
+    resp = client.get('/api/bordeaux/daily/station', query_string=dict(query, limit=20))
+    assert [x['id'] for x in json.loads(resp.data)['data']] \
+        == [x['id'] for x in first['data'] + second['data']]
+
+
+@pytest.mark.parametrize('token,remote_addr,headers,status_code', [
+    ('', '127.0.0.1', {}, 200),
+    ('', '10.0.0.2', {}, 403),
+    ('secret', '10.0.0.2', {}, 401),
+    ('secret', '127.0.0.1', {'Authorization': 'Bearer wrong'}, 401),
+    ('secret', '10.0.0.2', {'Authorization': 'Bearer secret'}, 200),
+])
+def test_api_admin_access(client, monkeypatch, token, remote_addr, headers, status_code):
+    settings = configparser.ConfigParser()
+    settings.read_dict({'admin': {'enabled': 'true', 'token': token}})
+    monkeypatch.setattr(webapi, 'config', settings)
+    resp = client.get('/api/admin/queries', headers=headers,
+                      environ_base={'REMOTE_ADDR': remote_addr})
+    assert resp.status_code == status_code